@@ -3,9 +3,11 @@ from typing import Optional
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from database.database import SessionLocal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import get_db
 from database.models import User
+from auth.session_manager import Principal, principal_cache
 import hashlib
 
 # to get a string like this run:
@@ -16,19 +18,12 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 def verify_password(plain_password, hashed_password):
     """Verify password using SHA-256 hash"""
     return hashlib.sha256(plain_password.encode()).hexdigest() == hashed_password
 
-def authenticate_user(db, username: str, password: str):
-    user = db.query(User).filter(User.username == username).first()
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if not user:
         return False
     if not verify_password(password, user.password_hash):
@@ -43,16 +38,35 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    # iat keys the principal cache, so a fresh login never sees an old snapshot
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    return await get_user_from_token(db, token)
+
+async def resolve_principal(db: AsyncSession, username: str, issued_at: Optional[int] = None) -> Optional[Principal]:
+    """The cached principal for a token's subject, loading it on a miss"""
+    key = (username, issued_at)
+    principal = principal_cache.get(key)
+    if principal is None:
+        user = (await db.execute(select(User).where(User.username == username))).scalars().first()
+        if user is None:
+            return None
+        principal = Principal.from_user(user)
+        principal_cache.put(key, principal)
+    return principal
+
+async def get_user_from_token(db: AsyncSession, token: Optional[str]) -> Principal:
+    """Resolve a bearer token to its principal; shared by HTTP routes and websockets"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    if not token:
+        raise credentials_exception
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -60,7 +74,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.username == username).first()
+    user = await resolve_principal(db, username, payload.get("iat"))
     if user is None:
         raise credentials_exception
     return user
\ No newline at end of file
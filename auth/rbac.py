@@ -7,4 +7,82 @@ This file defines:
 3. Access control logic
 4. Role validation
 5. Permission checking
-""" 
\ No newline at end of file
+
+PERMISSIONS is the declarative table: for each permission, the roles that
+hold it, whether the account must be approved, and the denial message. It
+is compiled once at import into one bitmask per role plus a mask of
+approval-gated permissions, so a check is two AND operations. Routes
+declare `Depends(require(Permission.X))`, which resolves the principal
+(role, approval and ban state) once per request and returns it for
+downstream services to reuse.
+"""
+
+from enum import IntFlag
+from typing import Callable, Dict, NamedTuple, Tuple
+from fastapi import Depends, HTTPException, status
+from auth.jwt_auth import get_current_user
+from auth.session_manager import Principal
+
+ROLES = ("sender", "receiver", "moderator", "admin")
+
+class Permission(IntFlag):
+    SEND_MESSAGES = 1
+    LIST_RECEIVERS = 2
+    READ_INBOX = 4
+    FLAG_MESSAGES = 8
+    VIEW_FLAGGED = 16
+    MODERATE = 32
+
+class Rule(NamedTuple):
+    roles: Tuple[str, ...]
+    requires_approval: bool
+    denied: str
+
+PERMISSIONS: Dict[Permission, Rule] = {
+    Permission.SEND_MESSAGES: Rule(("sender",), True, "Only approved senders can send messages"),
+    Permission.LIST_RECEIVERS: Rule(("sender",), True, "You must be an approved sender to view receivers"),
+    Permission.READ_INBOX: Rule(("receiver",), True, "Only approved receivers can access the inbox"),
+    Permission.FLAG_MESSAGES: Rule(("receiver",), True, "Not authorized to flag messages"),
+    Permission.VIEW_FLAGGED: Rule(("moderator",), False, "Only moderators can view flagged messages"),
+    Permission.MODERATE: Rule(("moderator",), True, "Not authorized as moderator"),
+}
+
+def compile_permissions(table: Dict[Permission, Rule]) -> Tuple[Dict[str, int], int]:
+    """Fold the table into (bitmask per role, mask of approval-gated permissions)"""
+    role_masks = {role: 0 for role in ROLES}
+    approval_mask = 0
+    for permission, rule in table.items():
+        for role in rule.roles:
+            if role not in role_masks:
+                raise ValueError(f"Unknown role in permission table: {role}")
+            role_masks[role] |= permission
+        if rule.requires_approval:
+            approval_mask |= permission
+    return role_masks, approval_mask
+
+ROLE_MASKS, APPROVAL_MASK = compile_permissions(PERMISSIONS)
+
+def is_approved(principal: Principal) -> bool:
+    return principal.is_approved and principal.status == "approved"
+
+def has_permission(principal: Principal, permission: Permission) -> bool:
+    if not ROLE_MASKS.get(principal.role, 0) & permission:
+        return False
+    return not (APPROVAL_MASK & permission) or is_approved(principal)
+
+def require(permission: Permission) -> Callable:
+    """
+    Dependency that resolves the caller once and checks one permission.
+    Returns the Principal; ban state is on it for callers that need it.
+    """
+    denied = PERMISSIONS[permission].denied
+
+    async def dependency(principal: Principal = Depends(get_current_user)) -> Principal:
+        if not has_permission(principal, permission):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=denied
+            )
+        return principal
+
+    return dependency
@@ -7,4 +7,105 @@ This file implements:
 3. Session expiration
 4. Token management
 5. Security checks
-""" 
\ No newline at end of file
+
+Authenticated requests resolve to a Principal: an immutable snapshot of the
+user fields authorization needs. Principals are cached per (username, token
+iat), so steady-state authentication never touches the database. Approval,
+rejection, ban and unban invalidate a user's entries explicitly; the TTL
+bounds staleness for changes made by other workers.
+"""
+
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+PrincipalKey = Tuple[str, Optional[int]]
+
+class Principal(NamedTuple):
+    """Immutable snapshot of the authenticated user"""
+    id: int
+    username: str
+    role: str
+    is_approved: bool
+    status: str
+    is_banned: bool
+    active_ban_until: Optional[datetime.datetime]
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(
+            user.id,
+            user.username,
+            user.role,
+            bool(user.is_approved),
+            user.status,
+            bool(user.is_banned),
+            user.active_ban_until
+        )
+
+    def has_active_ban(self, now: Optional[datetime.datetime] = None) -> bool:
+        """Same rule as User.has_active_ban; temporary bans lapse without invalidation"""
+        if not self.is_banned:
+            return False
+        if self.active_ban_until is None:
+            return True
+        return self.active_ban_until > (now or datetime.datetime.now())
+
+class PrincipalCache:
+    """Bounded TTL/LRU map of (username, iat) to Principal"""
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 60.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[PrincipalKey, Tuple[Principal, float]]" = OrderedDict()
+        self._by_user: Dict[int, Set[PrincipalKey]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, key: PrincipalKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._by_user.get(entry[0].id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[entry[0].id]
+
+    def get(self, key: PrincipalKey) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: PrincipalKey, principal: Principal) -> None:
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (principal, time.monotonic() + self.ttl_seconds)
+            self._by_user.setdefault(principal.id, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Drop every cached session of a user; call after committing a change to them"""
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+principal_cache = PrincipalCache()
@@ -15,20 +15,30 @@ import os
 # Add parent directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from fastapi import FastAPI, HTTPException, Depends, status, Header
+from fastapi import FastAPI, HTTPException, Depends, Query, Response, status, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, validator
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 import hashlib
-from database.database import SessionLocal, engine, Base, get_db
+from database.database import engine, Base, get_db
+from database.pagination import Page, NEXT_CURSOR_HEADER
 from database.models import User, AuditLog
-from encryption.key_utils import generate_rsa_key_pair
+from encryption.key_utils import generate_x25519_key_pair, key_pair_pool
+from encryption.key_management import unlocked_key_cache
+from auth.session_manager import Principal, principal_cache
+from auth.rbac import Permission, require
+from encryption.crypto_executor import crypto_executor
 from auth.jwt_auth import create_access_token, SECRET_KEY, ALGORITHM, authenticate_user, get_current_user
 from jose import jwt, JWTError
 import re
 from typing import List, Optional
 from backend.routes import message_routes, moderator_routes, user_routes
+from backend.services.token_service import RoundScheduler
+from backend.services.moderation_service import ban_index
+from backend.services.container import services
+from backend.services.audit_service import MAX_VERIFY_RANGE, audit_ledger, audit_writer
 
 app = FastAPI(title="User Registration API")
 
@@ -39,6 +49,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, message_routes.INBOX_SEQ_HEADER],
 )
 
 # Include routes
@@ -53,12 +64,35 @@ ADMIN_PASSWORD = "admin123"
 # Database setup
 Base.metadata.create_all(bind=engine)
 
+# Mint each round's tokens ahead of its boundary
+round_scheduler = RoundScheduler(services.token_manager)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    await services.start()
+    await audit_writer.start()
+    round_scheduler.start()
+    ban_index.start()
+    key_pair_pool.start()
+    audit_ledger.start()
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await round_scheduler.stop()
+    await ban_index.stop()
+    await key_pair_pool.stop()
+    await audit_ledger.stop()
+    await audit_writer.stop()
+    await services.stop()
+    crypto_executor.shutdown()
+
 # Hash password using SHA-256
 def hash_password(password: str) -> str:
     """Hash password using SHA-256"""
     return hashlib.sha256(password.encode()).hexdigest()
 
-async def verify_admin_token(authorization: str = Header(None), db: Session = Depends(get_db)):
+async def verify_admin_token(authorization: str = Header(None)) -> dict:
+    """The claims of a token issued by /admin/login; the admin has no users row"""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -78,15 +112,7 @@ async def verify_admin_token(authorization: str = Header(None), db: Session = De
                 detail="Not authorized",
             )
         
-        # Get the admin user from database
-        admin_user = db.query(User).filter(User.username == username).first()
-        if not admin_user:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Admin user not found",
-            )
-        
-        return admin_user
+        return payload
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -94,11 +120,14 @@ async def verify_admin_token(authorization: str = Header(None), db: Session = De
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+KEY_TYPES = ("rsa", "x25519")
+
 class UserCreate(BaseModel):
     username: str
     password: str
     role: str = "sender"  # Default role is sender
     key_password: Optional[str] = None
+    key_type: str = "rsa"  # "rsa" or "x25519"
 
     @validator('username')
     def username_must_contain_number(cls, v):
@@ -112,10 +141,17 @@ class UserCreate(BaseModel):
             raise ValueError('Role must be either "sender", "receiver", or "moderator"')
         return v
 
+    @validator('key_type')
+    def validate_key_type(cls, v):
+        if v not in KEY_TYPES:
+            raise ValueError('Key type must be either "rsa" or "x25519"')
+        return v
+
 class ModeratorCreate(BaseModel):
     username: str
     password: str
     key_password: str
+    key_type: str = "rsa"  # "rsa" or "x25519"
 
     @validator('username')
     def username_must_contain_number(cls, v):
@@ -123,6 +159,12 @@ class ModeratorCreate(BaseModel):
             raise ValueError('Username must contain at least one number')
         return v
 
+    @validator('key_type')
+    def validate_key_type(cls, v):
+        if v not in KEY_TYPES:
+            raise ValueError('Key type must be either "rsa" or "x25519"')
+        return v
+
 class AdminLogin(BaseModel):
     username: str
     password: str
@@ -136,16 +178,20 @@ class Token(BaseModel):
     token_type: str
 
 @app.post("/register")
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     # Check if username exists
-    if db.query(User).filter(User.username == user.username).first():
+    if (await db.execute(select(User).where(User.username == user.username))).scalars().first():
         raise HTTPException(status_code=400, detail="Username already exists")
     
     # Hash password using SHA-256
     hashed_password = hash_password(user.password)
     
-    # Generate keys
-    public_key, private_key = generate_rsa_key_pair()
+    # X25519 keys are generated inline in microseconds; RSA pairs come
+    # pre-generated from the pool, or on demand if it is empty
+    if user.key_type == "x25519":
+        public_key, private_key = generate_x25519_key_pair()
+    else:
+        public_key, private_key = await key_pair_pool.get()
     
     # Create user with pending approval
     db_user = User(
@@ -157,8 +203,8 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
         status="pending"  # Add status field
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     return {
         "id": db_user.id,
@@ -170,16 +216,20 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
     }
 
 @app.post("/register/moderator")
-def register_moderator(moderator: ModeratorCreate, db: Session = Depends(get_db)):
+async def register_moderator(moderator: ModeratorCreate, db: AsyncSession = Depends(get_db)):
     # Check if username exists
-    if db.query(User).filter(User.username == moderator.username).first():
+    if (await db.execute(select(User).where(User.username == moderator.username))).scalars().first():
         raise HTTPException(status_code=400, detail="Username already exists")
     
     # Hash password using SHA-256
     hashed_password = hash_password(moderator.password)
     
-    # Generate keys
-    public_key, private_key = generate_rsa_key_pair()
+    # X25519 keys are generated inline in microseconds; RSA pairs come
+    # pre-generated from the pool, or on demand if it is empty
+    if moderator.key_type == "x25519":
+        public_key, private_key = generate_x25519_key_pair()
+    else:
+        public_key, private_key = await key_pair_pool.get()
     
     # Create moderator with pending approval
     db_user = User(
@@ -191,8 +241,8 @@ def register_moderator(moderator: ModeratorCreate, db: Session = Depends(get_db)
         status="pending"
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     return {
         "id": db_user.id,
@@ -222,8 +272,12 @@ def admin_login(admin: AdminLogin):
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/admin/pending-users")
-async def get_pending_users(db: Session = Depends(get_db)):
-    pending_users = db.query(User).filter(User.status == "pending").all()
+async def get_pending_users(response: Response, page: Page = Depends(), db: AsyncSession = Depends(get_db)):
+    pending_users = (await db.execute(page.apply(
+        select(User).where(User.status == "pending"),
+        User.created_at, User.id
+    ))).scalars().all()
+    pending_users = page.paginate(pending_users, response.headers)
     return [
         {
             "id": user.id,
@@ -234,18 +288,22 @@ async def get_pending_users(db: Session = Depends(get_db)):
         for user in pending_users
     ]
 
+@app.get("/admin/key-pool")
+async def get_key_pool_stats(admin: dict = Depends(verify_admin_token)):
+    """Depth and hit/miss counters of the registration key pair pool"""
+    return key_pair_pool.stats()
+
 @app.post("/admin/approve-user/{user_id}")
-async def approve_user(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def approve_user(user_id: int, db: AsyncSession = Depends(get_db)):
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Update both is_approved and status fields
     user.is_approved = True
     user.status = "approved"
-    db.commit()
     
-    # Create audit log for user approval
+    # Create audit log for user approval; it lands in the same commit
     audit_log = AuditLog(
         action_type="user_approved",
         token_hash="admin_action",  # Using a placeholder since this is an admin action
@@ -254,13 +312,14 @@ async def approve_user(user_id: int, db: Session = Depends(get_db)):
         action_details=f"User {user.id} approved by admin"
     )
     db.add(audit_log)
-    db.commit()
+    await db.commit()
+    principal_cache.invalidate_user(user.id)
     
     return {"message": "User approved successfully"}
 
 @app.post("/admin/reject-user/{user_id}")
-async def reject_user(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def reject_user(user_id: int, db: AsyncSession = Depends(get_db)):
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -273,17 +332,17 @@ async def reject_user(user_id: int, db: Session = Depends(get_db)):
         action_details=f"User {user.id} rejected by admin"
     )
     db.add(audit_log)
-    db.commit()
     
-    # Delete the user
-    db.delete(user)
-    db.commit()
+    # Delete the user in the same commit
+    await db.delete(user)
+    await db.commit()
+    principal_cache.invalidate_user(user_id)
     
     return {"message": "User rejected and deleted successfully"}
 
 @app.get("/status")
-def check_user_status(username: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == username).first()
+async def check_user_status(username: str, db: AsyncSession = Depends(get_db)):
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -294,8 +353,8 @@ def check_user_status(username: str, db: Session = Depends(get_db)):
     }
 
 @app.post("/login", response_model=Token)
-def login_user(user_credentials: UserLogin, db: Session = Depends(get_db)):
-    user = authenticate_user(db, user_credentials.username, user_credentials.password)
+async def login_user(user_credentials: UserLogin, db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(db, user_credentials.username, user_credentials.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -311,21 +370,24 @@ def login_user(user_credentials: UserLogin, db: Session = Depends(get_db)):
     
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.post("/logout")
+async def logout_user(current_user: Principal = Depends(get_current_user)):
+    """Wipe the caller's unlocked private key; the client discards its token"""
+    unlocked_key_cache.clear(current_user.id)
+    return {"message": "Logged out"}
+
 @app.get("/users/receivers")
-async def get_receivers(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Check if user is approved and is a sender
-    if not current_user.is_approved or current_user.role != "sender":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You must be an approved sender to view receivers"
-        )
-    
+async def get_receivers(response: Response, page: Page = Depends(), db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require(Permission.LIST_RECEIVERS))):
     # Get all approved receivers
-    receivers = db.query(User).filter(
-        User.role == "receiver",
-        User.is_approved == True,
-        User.status == "approved"
-    ).all()
+    receivers = (await db.execute(page.apply(
+        select(User).where(
+            User.role == "receiver",
+            User.is_approved == True,
+            User.status == "approved"
+        ),
+        User.created_at, User.id
+    ))).scalars().all()
+    receivers = page.paginate(receivers, response.headers)
     
     return [
         {
@@ -336,7 +398,7 @@ async def get_receivers(db: Session = Depends(get_db), current_user: User = Depe
     ]
 
 @app.get("/debug/token")
-async def debug_token(current_user: User = Depends(get_current_user)):
+async def debug_token(current_user: Principal = Depends(get_current_user)):
     """Debug endpoint to check token and user info"""
     return {
         "user_id": current_user.id,
@@ -347,8 +409,15 @@ async def debug_token(current_user: User = Depends(get_current_user)):
     }
 
 @app.get("/admin/audit-logs")
-async def get_admin_audit_logs(db: Session = Depends(get_db)):
-    logs = db.query(AuditLog).order_by(AuditLog.created_at.desc()).all()
+async def get_admin_audit_logs(response: Response, page: Page = Depends(), db: AsyncSession = Depends(get_db)):
+    # Show entries still waiting in the audit buffer
+    await audit_writer.flush()
+    logs = (await db.execute(page.apply(
+        select(AuditLog),
+        AuditLog.created_at, AuditLog.id,
+        descending=True
+    ))).scalars().all()
+    logs = page.paginate(logs, response.headers)
     return [
         {
             "id": log.id,
@@ -357,7 +426,37 @@ async def get_admin_audit_logs(db: Session = Depends(get_db)):
             "moderator_id": log.moderator_id,
             "user_id": log.user_id,
             "action_details": log.action_details,
-            "created_at": log.created_at
+            "created_at": log.created_at,
+            "entry_hash": log.entry_hash
         }
         for log in logs
-    ] 
\ No newline at end of file
+    ]
+
+@app.get("/admin/audit-logs/verify")
+async def verify_audit_logs(
+    first_id: int = Query(1, ge=1),
+    last_id: Optional[int] = Query(None, ge=1),
+    admin: dict = Depends(verify_admin_token),
+    db: AsyncSession = Depends(get_db)
+):
+    """Recompute the hash chain and checkpoint roots over an id range"""
+    if last_id is None:
+        last_id = first_id + MAX_VERIFY_RANGE - 1
+    elif last_id - first_id + 1 > MAX_VERIFY_RANGE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_VERIFY_RANGE} entries can be verified per request"
+        )
+    return await audit_ledger.verify_range(first_id, last_id, db=db)
+
+@app.get("/admin/audit-logs/{log_id}/proof")
+async def get_audit_log_proof(
+    log_id: int,
+    admin: dict = Depends(verify_admin_token),
+    db: AsyncSession = Depends(get_db)
+):
+    """Merkle inclusion proof of one entry against its checkpoint root"""
+    proof = await audit_ledger.prove_inclusion(log_id, db=db)
+    if proof is None:
+        raise HTTPException(status_code=404, detail="Audit log entry is not checkpointed yet")
+    return proof 
\ No newline at end of file
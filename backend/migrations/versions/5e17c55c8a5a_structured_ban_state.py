@@ -0,0 +1,57 @@
+"""structured ban state
+
+Revision ID: 5e17c55c8a5a
+Revises: cf34d8ac8c32
+Create Date: 2026-10-16 09:12:41.318207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e17c55c8a5a'
+down_revision: Union[str, None] = 'cf34d8ac8c32'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('user_bans', sa.Column('ban_type', sa.String(), nullable=False, server_default='unknown'))
+    # Move the "type: reason" prefix into its own column
+    op.execute(
+        "UPDATE user_bans "
+        "SET ban_type = trim(substr(ban_reason, 1, instr(ban_reason, ':') - 1)), "
+        "ban_reason = trim(substr(ban_reason, instr(ban_reason, ':') + 1)) "
+        "WHERE instr(ban_reason, ':') > 0"
+    )
+    op.create_index(op.f('ix_user_bans_ban_type'), 'user_bans', ['ban_type'], unique=False)
+    op.create_index('ix_user_bans_user_id_is_active', 'user_bans', ['user_id', 'is_active'], unique=False)
+    op.create_index('ix_user_bans_banned_token_hash_is_active', 'user_bans', ['banned_token_hash', 'is_active'], unique=False)
+
+    op.add_column('users', sa.Column('is_banned', sa.Boolean(), nullable=False, server_default=sa.false()))
+    op.create_index(op.f('ix_users_is_banned'), 'users', ['is_banned'], unique=False)
+    # Backfill the denormalized state from the currently active bans
+    op.execute(
+        "UPDATE users SET is_banned = 1, banned_until = ("
+        "  SELECT CASE WHEN count(*) = count(ban_end_time) THEN max(ban_end_time) END"
+        "  FROM user_bans WHERE user_bans.user_id = users.id AND user_bans.is_active = 1"
+        ") WHERE id IN (SELECT user_id FROM user_bans WHERE is_active = 1)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_users_is_banned'), table_name='users')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('is_banned')
+
+    op.drop_index('ix_user_bans_banned_token_hash_is_active', table_name='user_bans')
+    op.drop_index('ix_user_bans_user_id_is_active', table_name='user_bans')
+    op.drop_index(op.f('ix_user_bans_ban_type'), table_name='user_bans')
+    op.execute("UPDATE user_bans SET ban_reason = ban_type || ': ' || ban_reason WHERE ban_type != 'unknown'")
+    with op.batch_alter_table('user_bans') as batch_op:
+        batch_op.drop_column('ban_type')
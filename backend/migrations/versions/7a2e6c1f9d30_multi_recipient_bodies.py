@@ -0,0 +1,44 @@
+"""multi-recipient message bodies
+
+Revision ID: 7a2e6c1f9d30
+Revises: d41c7e9a0b58
+Create Date: 2026-10-16 21:40:12.503117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7a2e6c1f9d30'
+down_revision: Union[str, None] = 'd41c7e9a0b58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'message_bodies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('encrypted_body', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_message_bodies_id'), 'message_bodies', ['id'], unique=False)
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.add_column(sa.Column('body_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_messages_body_id_message_bodies', 'message_bodies', ['body_id'], ['id'])
+    op.create_index(op.f('ix_messages_body_id'), 'messages', ['body_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_messages_body_id'), table_name='messages')
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_constraint('fk_messages_body_id_message_bodies', type_='foreignkey')
+        batch_op.drop_column('body_id')
+    op.drop_index(op.f('ix_message_bodies_id'), table_name='message_bodies')
+    op.drop_table('message_bodies')
@@ -0,0 +1,37 @@
+"""keyset pagination indexes
+
+Revision ID: 9b3f0d2e7a41
+Revises: 5e17c55c8a5a
+Create Date: 2026-10-16 11:02:17.540913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b3f0d2e7a41'
+down_revision: Union[str, None] = '5e17c55c8a5a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_messages_recipient_id_created_at_id', 'messages', ['recipient_id', 'created_at', 'id'], unique=False)
+    op.create_index('ix_messages_is_flagged_created_at_id', 'messages', ['is_flagged', 'created_at', 'id'], unique=False)
+    op.create_index('ix_user_bans_is_active_created_at_id', 'user_bans', ['is_active', 'created_at', 'id'], unique=False)
+    op.create_index('ix_users_status_created_at_id', 'users', ['status', 'created_at', 'id'], unique=False)
+    op.create_index('ix_users_role_created_at_id', 'users', ['role', 'created_at', 'id'], unique=False)
+    op.create_index('ix_audit_logs_created_at_id', 'audit_logs', ['created_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_audit_logs_created_at_id', table_name='audit_logs')
+    op.drop_index('ix_users_role_created_at_id', table_name='users')
+    op.drop_index('ix_users_status_created_at_id', table_name='users')
+    op.drop_index('ix_user_bans_is_active_created_at_id', table_name='user_bans')
+    op.drop_index('ix_messages_is_flagged_created_at_id', table_name='messages')
+    op.drop_index('ix_messages_recipient_id_created_at_id', table_name='messages')
@@ -0,0 +1,48 @@
+"""audit log hash chain and merkle checkpoints
+
+Revision ID: b8d4f2a61c07
+Revises: 7a2e6c1f9d30
+Create Date: 2026-10-16 23:12:47.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8d4f2a61c07'
+down_revision: Union[str, None] = '7a2e6c1f9d30'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Existing rows are sealed by the audit ledger on its first pass
+    with op.batch_alter_table('audit_logs') as batch_op:
+        batch_op.add_column(sa.Column('entry_hash', sa.String(length=64), nullable=True))
+    op.create_table(
+        'audit_checkpoints',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('first_id', sa.Integer(), nullable=False),
+        sa.Column('last_id', sa.Integer(), nullable=False),
+        sa.Column('entry_count', sa.Integer(), nullable=False),
+        sa.Column('prev_hash', sa.String(length=64), nullable=False),
+        sa.Column('chain_hash', sa.String(length=64), nullable=False),
+        sa.Column('merkle_root', sa.String(length=64), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('first_id'),
+        sa.UniqueConstraint('last_id')
+    )
+    op.create_index(op.f('ix_audit_checkpoints_id'), 'audit_checkpoints', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_audit_checkpoints_id'), table_name='audit_checkpoints')
+    op.drop_table('audit_checkpoints')
+    with op.batch_alter_table('audit_logs') as batch_op:
+        batch_op.drop_column('entry_hash')
@@ -0,0 +1,49 @@
+"""inbox sequence numbers
+
+Revision ID: d41c7e9a0b58
+Revises: 9b3f0d2e7a41
+Create Date: 2026-10-16 12:24:05.118374
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41c7e9a0b58'
+down_revision: Union[str, None] = '9b3f0d2e7a41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('users', sa.Column('inbox_seq', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('messages', sa.Column('seq', sa.Integer(), nullable=True))
+    op.add_column('messages', sa.Column('change_seq', sa.Integer(), nullable=True))
+    # Number existing messages per recipient in delivery order
+    op.execute(
+        "UPDATE messages SET seq = ("
+        "  SELECT count(*) FROM messages AS earlier"
+        "  WHERE earlier.recipient_id = messages.recipient_id AND earlier.id <= messages.id"
+        ")"
+    )
+    op.execute("UPDATE messages SET change_seq = seq")
+    op.execute(
+        "UPDATE users SET inbox_seq = ("
+        "  SELECT coalesce(max(seq), 0) FROM messages WHERE messages.recipient_id = users.id"
+        ")"
+    )
+    op.create_index('ix_messages_recipient_id_change_seq', 'messages', ['recipient_id', 'change_seq'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_recipient_id_change_seq', table_name='messages')
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('change_seq')
+        batch_op.drop_column('seq')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('inbox_seq')
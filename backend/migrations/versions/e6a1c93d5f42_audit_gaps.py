@@ -0,0 +1,45 @@
+"""audit gaps for late committed logs
+
+Revision ID: e6a1c93d5f42
+Revises: b8d4f2a61c07
+Create Date: 2026-10-16 23:58:05.114872
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6a1c93d5f42'
+down_revision: Union[str, None] = 'b8d4f2a61c07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'audit_gaps',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('log_id', sa.Integer(), nullable=False),
+        sa.Column('entry_hash', sa.String(length=64), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['log_id'], ['audit_logs.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('log_id')
+    )
+    op.create_index(op.f('ix_audit_gaps_id'), 'audit_gaps', ['id'], unique=False)
+    op.create_index(
+        'ix_audit_logs_unsealed_id', 'audit_logs', ['id'], unique=False,
+        sqlite_where=sa.text('entry_hash IS NULL'),
+        postgresql_where=sa.text('entry_hash IS NULL')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_audit_logs_unsealed_id', table_name='audit_logs')
+    op.drop_index(op.f('ix_audit_gaps_id'), table_name='audit_gaps')
+    op.drop_table('audit_gaps')
@@ -8,64 +8,60 @@ Moderation Service for handling token-related actions:
 
 import datetime
 from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from database.models import User, TokenMapping, Message
-from database.database import SessionLocal
+from database.db_session import session_scope
+from auth.session_manager import principal_cache
 from encryption.token_manager import TokenManager
 
 class ModerationService:
     def __init__(self, token_manager: TokenManager):
         self.token_manager = token_manager
     
-    def flag_message(self, message_id: int, reason: str) -> bool:
+    async def flag_message(self, message_id: int, reason: str, db: Optional[AsyncSession] = None) -> bool:
         """Flag a message as abusive (recipient action)"""
-        db = SessionLocal()
-        try:
-            message = db.query(Message).filter(Message.id == message_id).first()
+        async with session_scope(db) as db:
+            message = await db.get(Message, message_id)
             if message:
                 message.is_flagged = True
                 message.flag_reason = reason
-                db.commit()
+                await db.flush()
                 return True
             return False
-        finally:
-            db.close()
     
-    def freeze_token(self, token_hash: str) -> bool:
+    async def freeze_token(self, token_hash: str, db: Optional[AsyncSession] = None) -> bool:
         """Freeze a token (moderator action)"""
-        return self.token_manager.freeze_token(token_hash)
+        return await self.token_manager.freeze_token(token_hash, db=db)
     
-    def issue_temporary_ban(self, token_hash: str, duration_hours: int) -> bool:
+    async def issue_temporary_ban(self, token_hash: str, duration_hours: int, db: Optional[AsyncSession] = None) -> bool:
         """Issue a temporary ban based on token hash (moderator action)"""
-        db = SessionLocal()
-        try:
-            user = self.token_manager.get_user_from_token(token_hash)
+        async with session_scope(db) as db:
+            user = await self.token_manager.get_user_from_token(token_hash, db=db)
             if user:
-                user.banned_until = datetime.datetime.utcnow() + datetime.timedelta(hours=duration_hours)
-                db.commit()
+                user.set_ban_state(True, datetime.datetime.now() + datetime.timedelta(hours=duration_hours))
+                await db.flush()
+                principal_cache.invalidate_user(user.id)
                 return True
             return False
-        finally:
-            db.close()
     
-    def issue_warning(self, token_hash: str) -> bool:
+    async def issue_warning(self, token_hash: str, db: Optional[AsyncSession] = None) -> bool:
         """Issue a warning based on token hash (moderator action)"""
         # In a real system, you might want to store warnings in a separate table
         # For now, we'll just freeze the token as a warning
-        return self.freeze_token(token_hash)
+        return await self.freeze_token(token_hash, db=db)
     
-    def get_flagged_messages(self) -> list:
+    async def get_flagged_messages(self, db: Optional[AsyncSession] = None) -> list:
         """Get all flagged messages (moderator view)"""
-        db = SessionLocal()
-        try:
-            return db.query(Message).filter(Message.is_flagged == True).all()
-        finally:
-            db.close()
+        async with session_scope(db) as db:
+            return (await db.execute(select(Message).where(Message.is_flagged == True))).scalars().all()
     
-    def get_token_status(self, token_hash: str) -> dict:
+    async def get_token_status(self, token_hash: str, db: Optional[AsyncSession] = None) -> dict:
         """Get status of a token (moderator view)"""
-        db = SessionLocal()
-        try:
-            token = db.query(TokenMapping).filter(TokenMapping.token_hash == token_hash).first()
+        async with session_scope(db) as db:
+            token = (await db.execute(
+                select(TokenMapping).where(TokenMapping.token_hash == token_hash)
+            )).scalars().first()
             if token:
                 return {
                     "is_used": token.is_used,
@@ -73,6 +69,4 @@ class ModerationService:
                     "expires_at": token.expires_at,
                     "created_at": token.created_at
                 }
-            return None
-        finally:
-            db.close() 
\ No newline at end of file
+            return None
\ No newline at end of file
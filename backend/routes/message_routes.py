@@ -2,27 +2,51 @@
 Message handling routes for WhisperChain+.
 
 This file contains endpoints for:
-1. Sending encrypted messages
+1. Sending encrypted messages, to one recipient or many
 2. Receiving messages
 3. Message flagging
 4. Message deletion
 5. Message history
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, WebSocket, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from database.database import get_db
-from database.models import User, Message, TokenMapping, AuditLog, UserBan
-from encryption.message_crypto import encrypt_message, decrypt_message
-from auth.jwt_auth import get_current_user
+from database.db_session import session_scope
+from database.pagination import Page, MAX_PAGE_SIZE
+from database.models import User, Message, MessageBody, TokenMapping, UserBan
+from encryption.message_crypto import encrypt_message, decrypt_message, decrypt_message_async, decrypt_message_with_key_async, decrypt_messages_async, join_envelope
+from encryption.crypto_executor import CryptoExecutorBusy
+from auth.jwt_auth import get_current_user, get_user_from_token
+from auth.session_manager import Principal
+from auth.rbac import Permission, has_permission, require
 from encryption.key_management import KeyManager
-from encryption.token_manager import TokenManager
+from encryption.token_manager import TokenManager, current_round_id
+from backend.services.moderation_service import ban_index
+from backend.services.container import get_key_manager, get_token_manager
+from backend.services.audit_service import audit_writer
+from backend.services.message_service import (
+    inbox_query,
+    inbox_changes_query,
+    inbox_hub,
+    message_content,
+    next_inbox_seq,
+    record_inbox_change,
+    serialize_change_row,
+    stream_json_array,
+)
 from datetime import datetime, timedelta
 
 router = APIRouter(prefix="/messages", tags=["messages"])
 
+INBOX_SEQ_HEADER = "X-Inbox-Seq"
+
 def format_datetime(dt: Optional[datetime]) -> str:
     """Format datetime consistently across the application in 24-hour format"""
     if dt is None:
@@ -34,88 +58,147 @@ class MessageCreate(BaseModel):
     encrypted_content: str
     token_hash: Optional[str] = None  # Make token_hash optional with a default of None
 
+class RecipientKey(BaseModel):
+    recipient_id: int
+    encrypted_key: str  # This recipient's envelope header, base64
+
+class MultiMessageCreate(BaseModel):
+    encrypted_body: str  # Encrypted once for every recipient, base64
+    recipients: List[RecipientKey]
+    token_hash: Optional[str] = None
+
+    @validator('recipients')
+    def distinct_recipients(cls, v):
+        if not v:
+            raise ValueError('At least one recipient is required')
+        if len(v) > MAX_PAGE_SIZE:
+            raise ValueError(f'At most {MAX_PAGE_SIZE} recipients per message')
+        if len({recipient.recipient_id for recipient in v}) != len(v):
+            raise ValueError('Recipients must be distinct')
+        return v
+
 class MessageResponse(BaseModel):
     id: int
     sender_name: str
     encrypted_content: str
     created_at: str
     read: bool
+    seq: Optional[int] = None
 
 class DecryptRequest(BaseModel):
     encrypted_message: str
     key_password: str
     private_key: Optional[str] = None  # Add optional private key field
 
+class DecryptBatchRequest(BaseModel):
+    private_key: str
+    message_ids: Optional[List[int]] = None  # Messages from the caller's inbox...
+    encrypted_messages: Optional[List[str]] = None  # ...or raw ciphertexts
+
+    @validator('encrypted_messages', always=True)
+    def exactly_one_source(cls, v, values):
+        items = v if v is not None else values.get('message_ids')
+        if (v is None) == (values.get('message_ids') is None):
+            raise ValueError('Provide either message_ids or encrypted_messages')
+        if len(items) > MAX_PAGE_SIZE:
+            raise ValueError(f'At most {MAX_PAGE_SIZE} messages per batch')
+        return v
+
 class FlagMessageRequest(BaseModel):
     reason: str
 
 @router.get("/current-round")
 async def get_current_round(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
 ):
     """Get the current round ID for token generation"""
-    # Round changes every 2 minutes (120 seconds)
-    current_round = int(datetime.now().timestamp() / 120)
-    return {"round_id": current_round}
+    return {"round_id": current_round_id()}
 
-@router.post("/send")
-async def send_message(
-    message: MessageCreate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
-    token_manager: TokenManager = Depends(lambda: TokenManager(
-        secret_key="your-secret-key",
-        encryption_key="your-encryption-key-string"
-    ))
-):
-    # Verify user is approved and is a sender
-    if not current_user.is_approved or current_user.role != "sender":
+async def authorize_send(
+    token_hash: Optional[str],
+    db: AsyncSession,
+    current_user: Principal,
+    token_manager: TokenManager
+) -> str:
+    """
+    Run the ban and token checks shared by every send endpoint and consume
+    the sender's token. Role and approval were already checked by
+    require(Permission.SEND_MESSAGES). Returns the token hash the message
+    is sent with; nothing is committed.
+    """
+    # Check for active bans on the principal and in the ban index. The principal
+    # may be up to a cache TTL old; the index sees other workers' bans on reload.
+    current_time = datetime.now()
+    await ban_index.ensure_loaded(db)
+    user_ban = ban_index.user_ban(current_user.id, current_time)
+    
+    if user_ban or current_user.has_active_ban(current_time):
+        ban_until = user_ban.ban_end_time if user_ban else current_user.active_ban_until
+        print(f"Ban is still active. End time: {ban_until}")
+        # Ban details come from the ban index, or the database if it has not seen the ban yet
+        active_ban = user_ban or (await db.execute(
+            select(UserBan).where(
+                UserBan.user_id == current_user.id,
+                UserBan.is_active == True
+            ).order_by(UserBan.created_at.desc())
+        )).scalars().first()
+        
+        # Ban is still active, format ban time and create user-friendly message
+        ban_end_time = format_datetime(ban_until)
+        ban_type = active_ban.ban_type if active_ban else "unknown"
+        ban_reason = active_ban.ban_reason if active_ban else "No reason recorded"
+        
+        # Create user-friendly message based on ban type
+        if ban_type == 'freeze':
+            ban_message = "Your account has been permanently banned"
+        elif ban_type == 'temp_5min':
+            ban_message = f"You are temporarily banned for 5 minutes"
+        elif ban_type == 'temp_1hour':
+            ban_message = f"You are temporarily banned for 1 hour"
+        else:
+            ban_message = "You are currently banned"
+        
+        error_message = {
+            "status": "banned",
+            "ban_type": ban_type,
+            "ban_end_time": ban_end_time,
+            "ban_reason": ban_reason,
+            "message": f"{ban_message}. You can send messages again after {ban_end_time}. Reason: {ban_reason}"
+        }
+        
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
-            detail="Only approved senders can send messages"
+            detail=error_message
         )
-
-    # Check for active bans
-    current_time = datetime.now()
-    print(f"Checking bans at current time: {current_time}")
-    
-    active_ban = db.query(UserBan).filter(
-        UserBan.user_id == current_user.id,
-        UserBan.is_active == True
-    ).first()
-    
-    if active_ban:
-        print(f"Found ban: end_time={active_ban.ban_end_time}, current_time={current_time}")
-        # Check if ban has expired
-        if active_ban.ban_end_time is not None and active_ban.ban_end_time <= current_time:
-            print(f"Ban has expired, marking as inactive. Ban end time: {active_ban.ban_end_time}")
-            active_ban.is_active = False
-            db.commit()
-            db.refresh(active_ban)  # Refresh to ensure changes are reflected
-        else:
-            print(f"Ban is still active. End time: {active_ban.ban_end_time}")
-            # Ban is still active, format ban time and create user-friendly message
-            ban_end_time = format_datetime(active_ban.ban_end_time)
-            ban_type = active_ban.ban_reason.split(":")[0] if ":" in active_ban.ban_reason else "unknown"
-            ban_reason = active_ban.ban_reason.split(":", 1)[1].strip() if ":" in active_ban.ban_reason else active_ban.ban_reason
+    
+    # Check for token bans against the in-memory ban index
+    if token_hash:
+        token_ban = ban_index.token_ban(token_hash, current_time)
+        
+        if token_ban:
+            print(f"Token ban is still active. End time: {token_ban.ban_end_time}")
+            # Token ban is still active, format ban time and create user-friendly message
+            ban_end_time = format_datetime(token_ban.ban_end_time)
+            ban_type = token_ban.ban_type
+            ban_reason = token_ban.ban_reason
             
             # Create user-friendly message based on ban type
             if ban_type == 'freeze':
-                ban_message = "Your account has been permanently banned"
+                ban_message = "This token has been permanently banned"
             elif ban_type == 'temp_5min':
-                ban_message = f"You are temporarily banned for 5 minutes"
+                ban_message = f"This token is temporarily banned for 5 minutes"
             elif ban_type == 'temp_1hour':
-                ban_message = f"You are temporarily banned for 1 hour"
+                ban_message = f"This token is temporarily banned for 1 hour"
             else:
-                ban_message = "You are currently banned"
+                ban_message = "This token is currently banned"
             
             error_message = {
-                "status": "banned",
+                "status": "token_banned",
                 "ban_type": ban_type,
                 "ban_end_time": ban_end_time,
                 "ban_reason": ban_reason,
-                "message": f"{ban_message}. You can send messages again after {ban_end_time}. Reason: {ban_reason}"
+                "message": f"{ban_message}. You can use this token again after {ban_end_time}. Reason: {ban_reason}"
             }
             
             raise HTTPException(
@@ -123,56 +206,11 @@ async def send_message(
                 detail=error_message
             )
     
-    # Check for token bans
-    if message.token_hash:
-        token_ban = db.query(UserBan).filter(
-            UserBan.banned_token_hash == message.token_hash,
-            UserBan.is_active == True
-        ).first()
-        
-        if token_ban:
-            print(f"Found token ban: end_time={token_ban.ban_end_time}, current_time={current_time}")
-            # Check if token ban has expired
-            if token_ban.ban_end_time is not None and token_ban.ban_end_time <= current_time:
-                print(f"Token ban has expired, marking as inactive. Ban end time: {token_ban.ban_end_time}")
-                token_ban.is_active = False
-                db.commit()
-                db.refresh(token_ban)  # Refresh to ensure changes are reflected
-            else:
-                print(f"Token ban is still active. End time: {token_ban.ban_end_time}")
-                # Token ban is still active, format ban time and create user-friendly message
-                ban_end_time = format_datetime(token_ban.ban_end_time)
-                ban_type = token_ban.ban_reason.split(":")[0] if ":" in token_ban.ban_reason else "unknown"
-                ban_reason = token_ban.ban_reason.split(":", 1)[1].strip() if ":" in token_ban.ban_reason else token_ban.ban_reason
-                
-                # Create user-friendly message based on ban type
-                if ban_type == 'freeze':
-                    ban_message = "This token has been permanently banned"
-                elif ban_type == 'temp_5min':
-                    ban_message = f"This token is temporarily banned for 5 minutes"
-                elif ban_type == 'temp_1hour':
-                    ban_message = f"This token is temporarily banned for 1 hour"
-                else:
-                    ban_message = "This token is currently banned"
-                
-                error_message = {
-                    "status": "token_banned",
-                    "ban_type": ban_type,
-                    "ban_end_time": ban_end_time,
-                    "ban_reason": ban_reason,
-                    "message": f"{ban_message}. You can use this token again after {ban_end_time}. Reason: {ban_reason}"
-                }
-                
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail=error_message
-                )
-    
     # Check if token is frozen
-    token = db.query(TokenMapping).filter(
-        TokenMapping.token_hash == message.token_hash,
+    token = (await db.execute(select(TokenMapping).where(
+        TokenMapping.token_hash == token_hash,
         TokenMapping.is_frozen == True
-    ).first()
+    ))).scalars().first()
     
     if token:
         # Get the freeze time in a consistent format
@@ -186,16 +224,14 @@ async def send_message(
         )
     
     # Validate token
-    is_valid, error_message = token_manager.validate_token_for_message(message.token_hash, current_user.id)
+    is_valid, error_message = await token_manager.validate_token_for_message(token_hash, current_user.id, db=db, principal=current_user)
     if not is_valid:
         # If token is invalid, try to create a new one
         try:
-            # Calculate current round ID (2 minutes)
-            current_round = int(datetime.now().timestamp() / 120)
+            current_round = current_round_id()
             
-            token_hash, is_new = token_manager.get_or_create_token(current_user.id, current_round)
-            message.token_hash = token_hash
-            is_valid, error_message = token_manager.validate_token_for_message(token_hash, current_user.id)
+            token_hash, is_new = await token_manager.get_or_create_token(current_user.id, current_round, db=db, principal=current_user)
+            is_valid, error_message = await token_manager.validate_token_for_message(token_hash, current_user.id, db=db, principal=current_user)
             if not is_valid:
                 # Create user-friendly error message
                 if "already been used" in error_message:
@@ -215,88 +251,228 @@ async def send_message(
                 detail={"status": "token_error", "message": str(e)}
             )
     
+    return token_hash
+
+@router.post("/send")
+async def send_message(
+    message: MessageCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(require(Permission.SEND_MESSAGES)),
+    token_manager: TokenManager = Depends(get_token_manager)
+):
+    message.token_hash = await authorize_send(message.token_hash, db, current_user, token_manager)
+    
+    # Take the next slot in the recipient's inbox sequence
+    seq = await next_inbox_seq(db, message.recipient_id)
+    if seq is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Recipient not found"
+        )
+    
     # Create message
     db_message = Message(
         encrypted_content=message.encrypted_content,
         sender_id=current_user.id,
         recipient_id=message.recipient_id,
-        token_hash=message.token_hash
+        token_hash=message.token_hash,
+        seq=seq,
+        change_seq=seq
     )
     
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.flush()  # Assigns the message id without ending the transaction
 
-    # Add audit log for message sending
-    audit_log = AuditLog(
+    # Record token usage for this message
+    await token_manager.record_message_token(db_message.id, message.token_hash, db=db)
+    
+    # Token consumption, message and token usage land in one commit
+    response = {
+        "id": db_message.id,
+        "created_at": db_message.created_at,
+        "token_hash": message.token_hash  # Return the token hash so frontend can store it
+    }
+    await db.commit()
+    
+    # The audit entry is batched with other sends
+    audit_writer.submit(
         action_type="message_sent",
         token_hash=message.token_hash,
-        moderator_id=None,
         user_id=current_user.id,
         action_details=f"Message sent from user {current_user.id} to {message.recipient_id}"
     )
-    db.add(audit_log)
-    db.commit()
-    
-    # Record token usage for this message
-    token_manager.record_message_token(db_message.id, message.token_hash)
     
-    return {
+    # Push to the recipient's open /messages/stream connections
+    inbox_hub.publish(message.recipient_id, {
+        "type": "message",
         "id": db_message.id,
-        "created_at": db_message.created_at,
-        "token_hash": message.token_hash  # Return the token hash so frontend can store it
-    }
+        "sender_name": current_user.username,
+        "encrypted_content": db_message.encrypted_content,
+        "created_at": db_message.created_at.isoformat(),
+        "read": False,
+        "seq": seq
+    })
+    
+    return response
 
-@router.get("/inbox", response_model=List[MessageResponse])
-async def get_inbox(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+@router.post("/send-multi")
+async def send_multi_message(
+    message: MultiMessageCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(require(Permission.SEND_MESSAGES)),
+    token_manager: TokenManager = Depends(get_token_manager)
 ):
-    # Check if user is approved
-    if not current_user.is_approved or current_user.status != "approved":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Your account is not approved to receive messages"
-        )
+    """
+    Send one encrypted body to several recipients.
+    The body is stored once; each recipient's message row holds only its
+    wrapped key. One token is consumed and everything lands in one commit.
+    """
+    token_hash = await authorize_send(message.token_hash, db, current_user, token_manager)
     
-    # Check if user is a receiver
-    if current_user.role != "receiver":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Only users with 'receiver' role can access inbox"
-        )
+    body = MessageBody(encrypted_body=message.encrypted_body)
+    db.add(body)
+    await db.flush()
     
-    # Get all messages for the user
-    messages = db.query(Message).filter(Message.recipient_id == current_user.id).all()
-    
-    # Format messages for response
-    message_responses = []
-    for msg in messages:
-        sender = db.query(User).filter(User.id == msg.sender_id).first()
-        message_responses.append(
-            MessageResponse(
-                id=msg.id,
-                sender_name=sender.username if sender else "Unknown",
-                encrypted_content=msg.encrypted_content,  # Frontend will decrypt this
-                created_at=msg.created_at.isoformat(),
-                read=msg.read or False
+    db_messages = []
+    for recipient in message.recipients:
+        seq = await next_inbox_seq(db, recipient.recipient_id)
+        if seq is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recipient {recipient.recipient_id} not found"
             )
-        )
+        db_messages.append(Message(
+            encrypted_content=recipient.encrypted_key,
+            body_id=body.id,
+            sender_id=current_user.id,
+            recipient_id=recipient.recipient_id,
+            token_hash=token_hash,
+            seq=seq,
+            change_seq=seq
+        ))
+    db.add_all(db_messages)
+    await db.flush()
+    
+    await token_manager.record_message_tokens([db_message.id for db_message in db_messages], token_hash, db=db)
+    
+    response = {
+        "ids": [db_message.id for db_message in db_messages],
+        "body_id": body.id,
+        "token_hash": token_hash
+    }
+    await db.commit()
+    
+    recipient_ids = [recipient.recipient_id for recipient in message.recipients]
+    audit_writer.submit(
+        action_type="message_sent",
+        token_hash=token_hash,
+        user_id=current_user.id,
+        action_details=f"Message sent from user {current_user.id} to {', '.join(map(str, recipient_ids))}"
+    )
+    
+    for db_message in db_messages:
+        inbox_hub.publish(db_message.recipient_id, {
+            "type": "message",
+            "id": db_message.id,
+            "sender_name": current_user.username,
+            "encrypted_content": join_envelope(db_message.encrypted_content, message.encrypted_body),
+            "created_at": db_message.created_at.isoformat(),
+            "read": False,
+            "seq": db_message.seq
+        })
+    
+    return response
+
+@router.websocket("/stream")
+async def stream_inbox(websocket: WebSocket, token: Optional[str] = Query(None)):
+    """
+    Push new messages to a receiver as they are sent.
+
+    Authenticates with the same JWT as the HTTP routes, taken from the
+    Authorization header or, for browsers, the `token` query parameter.
+    A {"type": "resync"} event means events were dropped; fetch
+    /messages/inbox/changes to catch up.
+    """
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    try:
+        # Short-lived session; an idle socket must not pin a pooled connection
+        async with session_scope() as db:
+            current_user = await get_user_from_token(db, token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not has_permission(current_user, Permission.READ_INBOX):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept()
+    subscription = inbox_hub.subscribe(current_user.id)
+    
+    async def forward_events():
+        while True:
+            await websocket.send_json(await subscription.get())
     
-    # Return the list directly
-    return message_responses
+    async def wait_for_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    
+    tasks = [asyncio.ensure_future(forward_events()), asyncio.ensure_future(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        inbox_hub.unsubscribe(subscription)
+
+@router.get("/inbox", response_model=List[MessageResponse])
+async def get_inbox(
+    page: Page = Depends(),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(require(Permission.READ_INBOX))
+):
+    # One joined, column-projected query per page; rows are plain tuples.
+    # The page (at most MAX_PAGE_SIZE + 1 rows) is fetched with .all() because
+    # the next-cursor header must be known before the body starts streaming.
+    rows = (await db.execute(page.apply(inbox_query(current_user.id), Message.created_at, Message.id))).all()
+    headers = {}
+    rows = page.paginate(rows, headers)
+    # Starting point for /messages/inbox/changes; not part of the cached principal
+    inbox_seq = (await db.execute(select(User.inbox_seq).where(User.id == current_user.id))).scalar()
+    headers[INBOX_SEQ_HEADER] = str(inbox_seq)
+    return StreamingResponse(stream_json_array(rows), media_type="application/json", headers=headers)
+
+@router.get("/inbox/changes")
+async def get_inbox_changes(
+    since: int = Query(0, ge=0, description="Highest change_seq the client has seen"),
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(require(Permission.READ_INBOX))
+):
+    """
+    Get messages delivered or changed (read, flagged) since the client's last sync.
+    Call again with `since` set to the returned value while `has_more` is true.
+    """
+    rows = (await db.execute(inbox_changes_query(current_user.id, since, limit))).all()
+    return {
+        "changes": [serialize_change_row(row) for row in rows],
+        "since": rows[-1].change_seq if rows else since,
+        "has_more": len(rows) == limit
+    }
 
 @router.get("/{message_id}/mark-read")
 async def mark_message_read(
     message_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
 ):
     # Find the message
-    message = db.query(Message).filter(
+    message = (await db.execute(select(Message).where(
         Message.id == message_id,
         Message.recipient_id == current_user.id
-    ).first()
+    ))).scalars().first()
     
     if not message:
         raise HTTPException(
@@ -305,65 +481,125 @@ async def mark_message_read(
         )
     
     # Mark as read
-    message.read = True
-    db.commit()
+    if not message.read:
+        message.read = True
+        await record_inbox_change(db, message)
+        await db.commit()
     
     return {"status": "success"}
 
 @router.post("/decrypt")
 async def decrypt_message_content(
     decrypt_request: DecryptRequest,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+    key_manager: KeyManager = Depends(get_key_manager)
 ):
     try:
         # If private key is provided by the frontend
         if decrypt_request.private_key:
             try:
-                # Load the private key
-                from cryptography.hazmat.primitives import serialization
-                private_key = serialization.load_pem_private_key(
-                    decrypt_request.private_key.encode('utf-8'),
-                    password=None
-                )
-                
-                # Decrypt the message
-                decrypted_message = decrypt_message(
+                # Parse the key and decrypt off the event loop
+                decrypted_message = await decrypt_message_async(
                     decrypt_request.encrypted_message,
-                    private_key
+                    decrypt_request.private_key
                 )
                 
                 return {"decrypted_message": decrypted_message}
+            except CryptoExecutorBusy:
+                raise
             except Exception as e:
                 print(f"Error decrypting with provided key: {str(e)}")
                 # Fall back to returning the message as-is
                 return {"decrypted_message": decrypt_request.encrypted_message}
+        key_data = key_manager.get_user_key(current_user.id)
+        if key_data is not None:
+            # Unlock the caller's stored key; PBKDF2 runs once per session, not per message
+            private_key = await key_manager.decrypt_private_key_async(
+                key_data["encrypted_private_key"],
+                decrypt_request.key_password,
+                user_id=current_user.id
+            )
+            return {"decrypted_message": await decrypt_message_with_key_async(decrypt_request.encrypted_message, private_key)}
         else:
             # For now, we're bypassing decryption and just returning the message as is
             # This is because we may be storing plain text for now
             return {"decrypted_message": decrypt_request.encrypted_message}
+    except CryptoExecutorBusy as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Failed to process message: {str(e)}"
         )
 
+@router.post("/decrypt-batch")
+async def decrypt_message_batch(
+    batch: DecryptBatchRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    """
+    Decrypt many messages with one private key.
+    The key is parsed once and the batch is decrypted in parallel; results
+    come back in request order, each with either decrypted_message or error.
+    """
+    if batch.message_ids is not None:
+        rows = (await db.execute(
+            select(Message.id, Message.encrypted_content, MessageBody.encrypted_body)
+            .outerjoin(MessageBody, MessageBody.id == Message.body_id)
+            .where(
+                Message.id.in_(batch.message_ids),
+                Message.recipient_id == current_user.id
+            )
+        )).all()
+        contents = {message_id: join_envelope(content, body) for message_id, content, body in rows}
+        found = [message_id for message_id in batch.message_ids if message_id in contents]
+        ciphertexts = [contents[message_id] for message_id in found]
+    else:
+        found = list(range(len(batch.encrypted_messages)))
+        ciphertexts = batch.encrypted_messages
+    
+    try:
+        decrypted = dict(zip(found, await decrypt_messages_async(ciphertexts, batch.private_key)))
+    except CryptoExecutorBusy as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to load private key: {str(e)}"
+        )
+    
+    results = []
+    keys = batch.message_ids if batch.message_ids is not None else range(len(batch.encrypted_messages))
+    for key in keys:
+        result = {"id": key} if batch.message_ids is not None else {"index": key}
+        if key not in decrypted:
+            result["error"] = "Message not found"
+        else:
+            plaintext, error = decrypted[key]
+            if error is None:
+                result["decrypted_message"] = plaintext
+            else:
+                result["error"] = error
+        results.append(result)
+    return {"results": results}
+
 @router.post("/{message_id}/flag")
 async def flag_message(
     message_id: int,
     flag_request: FlagMessageRequest,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(require(Permission.FLAG_MESSAGES))
 ):
-    # Verify user is approved and is a receiver
-    if not current_user.is_approved or current_user.role != "receiver":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not authorized to flag messages"
-        )
-    
     # Get message
-    message = db.query(Message).filter(Message.id == message_id).first()
+    message = await db.get(Message, message_id)
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
@@ -374,32 +610,34 @@ async def flag_message(
     # Flag the message
     message.is_flagged = True
     message.flag_reason = flag_request.reason
+    await record_inbox_change(db, message)
     
-    db.commit()
+    await db.commit()
     
     return {"status": "message flagged successfully"}
 
 @router.get("/flagged")
 async def get_flagged_messages(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    response: Response,
+    page: Page = Depends(),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(require(Permission.VIEW_FLAGGED))
 ):
     """Get all flagged messages (moderator only)"""
-    if current_user.role != "moderator":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Only moderators can view flagged messages"
-        )
-    
-    flagged_messages = db.query(Message).filter(
-        Message.is_flagged == True
-    ).order_by(Message.created_at.desc()).all()  # Order by newest first
+    flagged_messages = (await db.execute(page.apply(
+        select(Message)
+        .options(selectinload(Message.sender), selectinload(Message.body))
+        .where(Message.is_flagged == True),
+        Message.created_at, Message.id,
+        descending=True  # Newest first
+    ))).scalars().all()
+    flagged_messages = page.paginate(flagged_messages, response.headers)
     
     return [
         {
             "id": msg.id,
             "sender_name": msg.sender.username,
-            "encrypted_content": msg.encrypted_content,
+            "encrypted_content": message_content(msg),
             "created_at": msg.created_at,
             "token_hash": msg.token_hash
         }
@@ -409,37 +647,25 @@ async def get_flagged_messages(
 @router.get("/token-status/{token_hash}")
 async def get_token_status(
     token_hash: str,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
 ):
     """Get the current status of a token"""
-    current_time = datetime.now()
-    
-    # Check for token bans
-    token_ban = db.query(UserBan).filter(
-        UserBan.banned_token_hash == token_hash,
-        UserBan.is_active == True
-    ).first()
+    # Check for token bans; expired bans are deactivated by the ban sweeper
+    await ban_index.ensure_loaded(db)
+    token_ban = ban_index.token_ban(token_hash)
     
     if token_ban:
-        # Check if ban has expired
-        if token_ban.ban_end_time is not None and token_ban.ban_end_time <= current_time:
-            # Ban has expired, mark as inactive
-            token_ban.is_active = False
-            db.commit()
-            return {"status": "active"}
-        else:
-            # Ban is still active
-            return {
-                "status": "banned",
-                "message": f"Token banned until {format_datetime(token_ban.ban_end_time)}. Reason: {token_ban.ban_reason}"
-            }
+        return {
+            "status": "banned",
+            "message": f"Token banned until {format_datetime(token_ban.ban_end_time)}. Reason: {token_ban.ban_reason}"
+        }
     
     # Check if token is frozen
-    token = db.query(TokenMapping).filter(
+    token = (await db.execute(select(TokenMapping).where(
         TokenMapping.token_hash == token_hash,
         TokenMapping.is_frozen == True
-    ).first()
+    ))).scalars().first()
     
     if token:
         return {
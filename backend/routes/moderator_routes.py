@@ -6,15 +6,23 @@ Moderator routes for handling:
 4. Audit logging
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session, joinedload
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from database.database import get_db
+from database.pagination import Page
+from backend.services.message_service import message_content, record_inbox_change
 from database.models import User, Message, TokenMapping, AuditLog, UserBan
-from auth.jwt_auth import get_current_user
 from datetime import datetime, timedelta
 from typing import List, Optional
 from pydantic import BaseModel
 from encryption.token_manager import TokenManager
+from backend.services.moderation_service import ban_index
+from backend.services.container import get_token_manager
+from backend.services.audit_service import audit_writer
+from auth.session_manager import Principal, principal_cache
+from auth.rbac import Permission, require
 import os
 
 router = APIRouter(prefix="/moderator", tags=["moderator"])
@@ -25,12 +33,6 @@ def format_datetime(dt: Optional[datetime]) -> str:
         return "permanently"
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
-def get_token_manager():
-    return TokenManager(
-        secret_key="your-secret-key",
-        encryption_key="your-encryption-key-string"
-    )
-
 class TokenStatus(BaseModel):
     is_used: bool
     is_frozen: bool
@@ -50,46 +52,45 @@ class BanResponse(BaseModel):
     banned_token_hash: str
     ban_type: str
 
-async def verify_moderator(current_user: User = Depends(get_current_user)):
-    """Verify that the current user is an approved moderator"""
-    if current_user.role != "moderator" or not current_user.is_approved:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not authorized as moderator"
-        )
-    return current_user
+# Verify that the current user is an approved moderator
+verify_moderator = require(Permission.MODERATE)
 
-def create_audit_log(
-    db: Session,
+async def create_audit_log(
     action_type: str,
     token_hash: str,
     moderator_id: int,
     user_id: int = None,
     action_details: str = None
 ):
-    """Create an audit log entry"""
-    audit_log = AuditLog(
+    """
+    Persist a standalone audit entry before returning. Entries from
+    concurrent moderator actions share one group commit.
+    """
+    await audit_writer.write(
         action_type=action_type,
         token_hash=token_hash,
         moderator_id=moderator_id,
         user_id=user_id,
         action_details=action_details
     )
-    db.add(audit_log)
-    db.commit()
-    return audit_log
 
 @router.get("/flagged-messages")
 async def get_flagged_messages(
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    response: Response,
+    page: Page = Depends(),
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
-    """Get all flagged messages"""
-    messages = db.query(Message).filter(Message.is_flagged == True).all()
+    """Get a page of flagged messages"""
+    messages = (await db.execute(page.apply(
+        select(Message).options(selectinload(Message.body)).where(Message.is_flagged == True),
+        Message.created_at, Message.id
+    ))).scalars().all()
+    messages = page.paginate(messages, response.headers)
     return [
         {
             "id": message.id,
-            "encrypted_content": message.encrypted_content,
+            "encrypted_content": message_content(message),
             "created_at": message.created_at,
             "flag_reason": message.flag_reason,
             "token_hash": message.token_hash
@@ -100,15 +101,15 @@ async def get_flagged_messages(
 @router.get("/token-status/{token_hash}")
 async def get_token_status(
     token_hash: str,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
     """Get status of a token"""
     # First try to find the token in TokenMapping
-    token = db.query(TokenMapping).filter(TokenMapping.token_hash == token_hash).first()
+    token = (await db.execute(select(TokenMapping).where(TokenMapping.token_hash == token_hash))).scalars().first()
     if not token:
         # If not found in TokenMapping, check if it's a message token
-        message = db.query(Message).filter(Message.token_hash == token_hash).first()
+        message = (await db.execute(select(Message).where(Message.token_hash == token_hash))).scalars().first()
         if not message:
             raise HTTPException(status_code=404, detail="Token not found")
         
@@ -130,21 +131,20 @@ async def get_token_status(
 @router.post("/freeze-token/{token_hash}")
 async def freeze_token(
     token_hash: str,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
     """Freeze a token"""
     # First try to find the token in TokenMapping
-    token = db.query(TokenMapping).filter(TokenMapping.token_hash == token_hash).first()
+    token = (await db.execute(select(TokenMapping).where(TokenMapping.token_hash == token_hash))).scalars().first()
     if not token:
         # If not found in TokenMapping, check if it's a message token
-        message = db.query(Message).filter(Message.token_hash == token_hash).first()
+        message = (await db.execute(select(Message).where(Message.token_hash == token_hash))).scalars().first()
         if not message:
             raise HTTPException(status_code=404, detail="Token not found")
         
         # For message tokens, we'll just create an audit log
-        create_audit_log(
-            db=db,
+        await create_audit_log(
             action_type="freeze",
             token_hash=token_hash,
             moderator_id=moderator.id,
@@ -155,104 +155,84 @@ async def freeze_token(
     if token.is_frozen:
         raise HTTPException(status_code=400, detail="Token is already frozen")
     
-    # Freeze the token
+    # Freeze the token; the audit log lands in the same commit
     token.is_frozen = True
-    db.commit()
-    
-    # Create audit log
-    create_audit_log(
-        db=db,
+    db.add(AuditLog(
         action_type="freeze",
         token_hash=token_hash,
         moderator_id=moderator.id,
         action_details="Token frozen by moderator"
-    )
+    ))
+    await db.commit()
     
     return {"message": "Token frozen successfully"}
 
 @router.post("/unfreeze-token/{token_hash}")
 async def unfreeze_token(
     token_hash: str,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
     """Unfreeze a token"""
-    token = db.query(TokenMapping).filter(TokenMapping.token_hash == token_hash).first()
+    token = (await db.execute(select(TokenMapping).where(TokenMapping.token_hash == token_hash))).scalars().first()
     if not token:
         raise HTTPException(status_code=404, detail="Token not found")
     
     if not token.is_frozen:
         raise HTTPException(status_code=400, detail="Token is not frozen")
     
-    # Unfreeze the token
+    # Unfreeze the token; the audit log lands in the same commit
     token.is_frozen = False
     token.updated_at = datetime.now()
-    db.commit()
-    
-    # Create audit log
-    create_audit_log(
-        db=db,
+    db.add(AuditLog(
         action_type="unfreeze",
         token_hash=token_hash,
         moderator_id=moderator.id,
         action_details="Token unfrozen by moderator"
-    )
+    ))
+    await db.commit()
     
     return {"message": "Token unfrozen successfully"}
 
 @router.post("/ban-user")
 async def ban_user(
     ban_request: BanRequest,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator),
-    token_manager: TokenManager = Depends(lambda: TokenManager(
-        secret_key="your-secret-key",
-        encryption_key="your-encryption-key-string"
-    ))
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator),
+    token_manager: TokenManager = Depends(get_token_manager)
 ):
     # Find the user associated with this token
-    token_mapping = db.query(TokenMapping).filter(TokenMapping.token_hash == ban_request.token_hash).first()
+    token_mapping = (await db.execute(select(TokenMapping).where(TokenMapping.token_hash == ban_request.token_hash))).scalars().first()
     if not token_mapping:
         # Try to find the token in messages
-        message = db.query(Message).filter(Message.token_hash == ban_request.token_hash).first()
+        message = (await db.execute(select(Message).where(Message.token_hash == ban_request.token_hash))).scalars().first()
         if not message:
             raise HTTPException(status_code=404, detail="Token not found")
-        user = db.query(User).filter(User.id == message.sender_id).first()
+        user = await db.get(User, message.sender_id)
     else:
-        user = db.query(User).filter(User.id == token_mapping.user_id).first()
+        user = await db.get(User, token_mapping.user_id)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Load user with bans relationship
-    user = db.query(User).options(joinedload(User.bans)).filter(User.id == user.id).first()
-    
     # Check if user is already banned
     current_time = datetime.now()
-    active_ban = next(
-        (ban for ban in user.bans if ban.is_active and 
-         (ban.ban_end_time is None or ban.ban_end_time > current_time)),
-        None
-    )
-    
-    if active_ban and ban_request.ban_type != 'warning':
+    if user.has_active_ban(current_time) and ban_request.ban_type != 'warning':
         raise HTTPException(
             status_code=400,
-            detail=f"User is already banned until {format_datetime(active_ban.ban_end_time)}"
+            detail=f"User is already banned until {format_datetime(user.active_ban_until)}"
         )
 
     try:
         # For warnings, just create an audit log
         if ban_request.ban_type == 'warning':
-            audit_log = AuditLog(
+            await create_audit_log(
                 action_type="warning_issued",
                 moderator_id=moderator.id,
                 user_id=user.id,
                 action_details=f"Warning issued: {ban_request.ban_reason}",
                 token_hash=ban_request.token_hash
             )
-            db.add(audit_log)
-            db.commit()
             return {"status": "warning issued successfully"}
 
         # Calculate ban end time based on ban type
@@ -266,7 +246,8 @@ async def ban_user(
         # Create ban record with only the fields that exist in the model
         ban = UserBan(
             user_id=user.id,
-            ban_reason=f"{ban_request.ban_type}: {ban_request.ban_reason}",
+            ban_type=ban_request.ban_type,
+            ban_reason=ban_request.ban_reason,
             ban_start_time=current_time,
             ban_end_time=ban_end_time,
             is_active=True,
@@ -274,12 +255,13 @@ async def ban_user(
         )
         
         db.add(ban)
+        user.set_ban_state(True, ban_end_time)
         
         # Update all user's tokens to frozen status
-        user_tokens = db.query(TokenMapping).filter(
+        user_tokens = (await db.execute(select(TokenMapping).where(
             TokenMapping.user_id == user.id,
             TokenMapping.is_frozen == False
-        ).all()
+        ))).scalars().all()
         
         for token in user_tokens:
             token.is_frozen = True
@@ -295,19 +277,20 @@ async def ban_user(
         )
         db.add(audit_log)
         
-        db.commit()
-        db.refresh(user)
-        
         # Mark the message as resolved
-        message = db.query(Message).filter(Message.token_hash == ban_request.token_hash).first()
+        message = (await db.execute(select(Message).where(Message.token_hash == ban_request.token_hash))).scalars().first()
         if message:
             message.is_flagged = False
-            db.commit()
+            await record_inbox_change(db, message)
+        
+        await db.commit()
+        ban_index.add(ban)
+        principal_cache.invalidate_user(user.id)
         
         return {"status": "user banned successfully"}
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=500,
             detail=f"Failed to ban user: {str(e)}"
@@ -315,15 +298,21 @@ async def ban_user(
 
 @router.get("/banned-users")
 async def get_banned_users(
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    response: Response,
+    page: Page = Depends(),
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
-    """Get list of currently banned users"""
+    """Get a page of currently banned users"""
     current_time = datetime.now()
-    active_bans = db.query(UserBan).filter(
-        UserBan.is_active == True,
-        (UserBan.ban_end_time > current_time) | (UserBan.ban_end_time == None)  # Include permanent bans
-    ).all()
+    active_bans = (await db.execute(page.apply(
+        select(UserBan).options(selectinload(UserBan.user)).where(
+            UserBan.is_active == True,
+            (UserBan.ban_end_time > current_time) | (UserBan.ban_end_time == None)  # Include permanent bans
+        ),
+        UserBan.created_at, UserBan.id
+    ))).scalars().all()
+    active_bans = page.paginate(active_bans, response.headers)
     
     return [
         {
@@ -331,6 +320,7 @@ async def get_banned_users(
             "username": ban.user.username,
             "ban_start_time": format_datetime(ban.ban_start_time),
             "ban_end_time": format_datetime(ban.ban_end_time),
+            "ban_type": ban.ban_type,
             "ban_reason": ban.ban_reason,
             "banned_token_hash": ban.banned_token_hash,
             "is_permanent": ban.ban_end_time is None
@@ -341,45 +331,51 @@ async def get_banned_users(
 @router.post("/unban-user/{user_id}")
 async def unban_user(
     user_id: int,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
-    """Remove an active ban from a user"""
-    # Get active ban
+    """Remove every active ban from a user"""
+    # Get active bans; all of them go, or the user would stay blocked by the others
     current_time = datetime.now()
-    active_ban = db.query(UserBan).filter(
+    active_bans = (await db.execute(select(UserBan).options(selectinload(UserBan.user)).where(
         UserBan.user_id == user_id,
         UserBan.is_active == True,
         (UserBan.ban_end_time > current_time) | (UserBan.ban_end_time == None)
-    ).first()
+    ))).scalars().all()
     
-    if not active_ban:
+    if not active_bans:
         raise HTTPException(status_code=404, detail="No active ban found for this user")
     
-    # Deactivate ban
-    active_ban.is_active = False
+    # Deactivate bans
+    for active_ban in active_bans:
+        active_ban.is_active = False
+    active_bans[0].user.set_ban_state(False)
     
     # Unfreeze all user's tokens
-    user_tokens = db.query(TokenMapping).filter(
+    user_tokens = (await db.execute(select(TokenMapping).where(
         TokenMapping.user_id == user_id,
         TokenMapping.is_frozen == True
-    ).all()
+    ))).scalars().all()
     
     for token in user_tokens:
         token.is_frozen = False
         token.updated_at = current_time
     
-    # Create audit log
-    audit_log = AuditLog(
-        action_type="unban",
-        moderator_id=moderator.id,
-        user_id=user_id,
-        action_details=f"Ban removed by moderator {moderator.username}",
-        token_hash=active_ban.banned_token_hash
-    )
-    db.add(audit_log)
+    # Create audit logs
+    db.add_all([
+        AuditLog(
+            action_type="unban",
+            moderator_id=moderator.id,
+            user_id=user_id,
+            action_details=f"Ban removed by moderator {moderator.username}",
+            token_hash=active_ban.banned_token_hash
+        )
+        for active_ban in active_bans
+    ])
     
-    db.commit()
+    await db.commit()
+    ban_index.discard([active_ban.id for active_ban in active_bans])
+    principal_cache.invalidate_user(user_id)
     
     return {"message": "User unbanned successfully"}
 
@@ -387,49 +383,52 @@ async def unban_user(
 async def warn_user(
     token_hash: str,
     warning_reason: str,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
     """Issue a warning to a user based on token hash"""
     # First try to find the token in TokenMapping
-    token = db.query(TokenMapping).filter(TokenMapping.token_hash == token_hash).first()
+    token = (await db.execute(select(TokenMapping).where(TokenMapping.token_hash == token_hash))).scalars().first()
     if not token:
         # If not found in TokenMapping, check if it's a message token
-        message = db.query(Message).filter(Message.token_hash == token_hash).first()
+        message = (await db.execute(select(Message).where(Message.token_hash == token_hash))).scalars().first()
         if not message:
             raise HTTPException(status_code=404, detail="Token not found")
-        user = message.sender
+        user_id = message.sender_id
     else:
-        user = token.user
+        user_id = token.user_id
     
     # Create audit log for warning
-    audit_log = AuditLog(
+    await create_audit_log(
         action_type="warn",
         token_hash=token_hash,
         moderator_id=moderator.id,
-        user_id=user.id,
-        action_details=f"Warning issued to user {user.id}: {warning_reason}"
+        user_id=user_id,
+        action_details=f"Warning issued to user {user_id}: {warning_reason}"
     )
-    db.add(audit_log)
-    db.commit()
     
     return {
         "message": "Warning issued successfully",
         "warning_reason": warning_reason,
-        "user_id": user.id
+        "user_id": user_id
     }
 
 @router.get("/user-warnings/{user_id}")
 async def get_user_warnings(
     user_id: int,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
     """Get all warnings issued to a user"""
-    warnings = db.query(AuditLog).filter(
-        AuditLog.user_id == user_id,
-        AuditLog.action_type == "warn"
-    ).order_by(AuditLog.created_at.desc()).all()
+    warnings = (await db.execute(
+        select(AuditLog)
+        .options(selectinload(AuditLog.moderator))
+        .where(
+            AuditLog.user_id == user_id,
+            AuditLog.action_type == "warn"
+        )
+        .order_by(AuditLog.created_at.desc())
+    )).scalars().all()
     
     return [
         {
@@ -444,26 +443,22 @@ async def get_user_warnings(
 @router.get("/check-ban-status/{user_id}")
 async def check_ban_status(
     user_id: int,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
     """Check the current ban status of a user"""
     current_time = datetime.now()
     
     # Get all bans for the user
-    all_bans = db.query(UserBan).filter(
-        UserBan.user_id == user_id
-    ).order_by(UserBan.created_at.desc()).all()
+    all_bans = (await db.execute(
+        select(UserBan).where(UserBan.user_id == user_id).order_by(UserBan.created_at.desc())
+    )).scalars().all()
     
-    # Get active bans
+    # Get active bans; expired ones are deactivated by the ban sweeper, so
+    # report them as inactive here without writing from a read path
     active_bans = [ban for ban in all_bans if ban.is_active and 
                   (ban.ban_end_time is None or ban.ban_end_time > current_time)]
-    
-    # Check for expired bans that should be deactivated
-    for ban in all_bans:
-        if ban.is_active and ban.ban_end_time and ban.ban_end_time <= current_time:
-            ban.is_active = False
-            db.commit()
+    active_ban_ids = {ban.id for ban in active_bans}
     
     return {
         "user_id": user_id,
@@ -471,11 +466,11 @@ async def check_ban_status(
         "all_bans": [
             {
                 "id": ban.id,
-                "ban_type": ban.ban_reason.split(":")[0] if ":" in ban.ban_reason else "unknown",
+                "ban_type": ban.ban_type,
                 "ban_reason": ban.ban_reason,
                 "ban_start_time": format_datetime(ban.ban_start_time),
                 "ban_end_time": format_datetime(ban.ban_end_time),
-                "is_active": ban.is_active,
+                "is_active": ban.id in active_ban_ids,
                 "is_permanent": ban.ban_end_time is None,
                 "time_until_expiry": (ban.ban_end_time - current_time).total_seconds() if ban.ban_end_time else None
             }
@@ -484,7 +479,7 @@ async def check_ban_status(
         "active_bans": [
             {
                 "id": ban.id,
-                "ban_type": ban.ban_reason.split(":")[0] if ":" in ban.ban_reason else "unknown",
+                "ban_type": ban.ban_type,
                 "ban_reason": ban.ban_reason,
                 "ban_start_time": format_datetime(ban.ban_start_time),
                 "ban_end_time": format_datetime(ban.ban_end_time),
@@ -498,15 +493,15 @@ async def check_ban_status(
 @router.post("/resolve-message/{message_id}")
 async def resolve_message(
     message_id: int,
-    db: Session = Depends(get_db),
-    moderator: User = Depends(verify_moderator)
+    db: AsyncSession = Depends(get_db),
+    moderator: Principal = Depends(verify_moderator)
 ):
     """Mark a flagged message as resolved"""
-    message = db.query(Message).filter(Message.id == message_id).first()
+    message = await db.get(Message, message_id)
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
     message.is_resolved = True
-    db.commit()
+    await db.commit()
     
     return {"status": "message resolved successfully"} 
\ No newline at end of file
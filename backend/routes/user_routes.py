@@ -3,15 +3,19 @@ User routes for the application.
 Handles user-related endpoints like getting user info, listing receivers, etc.
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 from pydantic import BaseModel
 import datetime
 
 from database.database import get_db
+from database.pagination import Page
 from database.models import User, AuditLog, TokenMapping
 from auth.jwt_auth import get_current_user
+from auth.session_manager import Principal
+from auth.rbac import Permission, require
 
 router = APIRouter(
     prefix="/users",
@@ -29,7 +33,7 @@ class UserResponse(BaseModel):
         from_attributes = True
 
 @router.get("/me", response_model=UserResponse)
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: Principal = Depends(get_current_user)):
     """Get information about the currently logged in user"""
     return {
         "id": current_user.id,
@@ -41,28 +45,21 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
 
 @router.get("/receivers")
 async def get_receivers(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    response: Response,
+    page: Page = Depends(),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(require(Permission.LIST_RECEIVERS))
 ):
-    """Get list of approved receivers"""
-    # Check if user is approved and is a sender
-    if not current_user.is_approved:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="User not approved"
-        )
-    
-    if current_user.role != "sender":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Only senders can view receivers"
-        )
-    
+    """Get a page of approved receivers"""
     # Get all approved receivers
-    receivers = db.query(User).filter(
-        User.role == "receiver",
-        User.is_approved == True
-    ).all()
+    receivers = (await db.execute(page.apply(
+        select(User).where(
+            User.role == "receiver",
+            User.is_approved == True
+        ),
+        User.created_at, User.id
+    ))).scalars().all()
+    receivers = page.paginate(receivers, response.headers)
     
     return [
         {
@@ -75,24 +72,25 @@ async def get_receivers(
 
 @router.get("/token-status")
 async def get_user_token_status(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Get the status of the user's current token"""
     # Check if user is banned
-    if current_user.banned_until and current_user.banned_until > datetime.datetime.utcnow():
+    if current_user.has_active_ban():
+        banned_until = current_user.active_ban_until
         return {
             "status": "banned",
-            "banned_until": current_user.banned_until,
-            "message": f"Banned until {current_user.banned_until}"
+            "banned_until": banned_until,
+            "message": f"Banned until {banned_until}" if banned_until else "Banned permanently"
         }
     
     # Check for warnings
-    warning = db.query(AuditLog).filter(
+    warning = (await db.execute(select(AuditLog).where(
         AuditLog.user_id == current_user.id,
         AuditLog.action_type == "warn",
         AuditLog.created_at >= datetime.datetime.utcnow() - datetime.timedelta(days=7)  # Last 7 days
-    ).first()
+    ))).scalars().first()
     
     if warning:
         return {
@@ -102,10 +100,10 @@ async def get_user_token_status(
         }
     
     # Check for frozen tokens
-    frozen_token = db.query(TokenMapping).filter(
+    frozen_token = (await db.execute(select(TokenMapping).where(
         TokenMapping.user_id == current_user.id,
         TokenMapping.is_frozen == True
-    ).first()
+    ))).scalars().first()
     
     if frozen_token:
         return {
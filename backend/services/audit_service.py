@@ -0,0 +1,582 @@
+"""
+Audit log writer for WhisperChain+.
+
+This file implements:
+1. Buffering of audit entries in memory
+2. Group commit of buffered entries as one multi-row INSERT
+3. A durable append-only fallback file when the database write fails
+4. Replay of the fallback file at startup
+5. Flush on shutdown
+6. The hash chain and Merkle checkpoints over committed audit logs
+
+Audit rows written as part of an action's own transaction (bans, unbans,
+approvals) stay in that transaction; they cost no extra commit.
+
+Entries that are not tied to a request transaction go through the module-
+level `audit_writer`. submit() buffers an entry and returns immediately; the
+buffer is flushed when it reaches `batch_size` entries or `flush_interval`
+seconds after the first buffered entry. write() returns once its entry is
+committed (or spilled to the fallback file): with no flush in flight it
+commits at once, otherwise it joins the batch the running flush takes
+next. Concurrent writers thus share commits without waiting out a timer.
+"""
+
+import asyncio
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import threading
+from collections import deque
+from typing import Deque, List, Optional, Sequence, Set, Tuple
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.db_session import session_scope
+from database.models import AuditCheckpoint, AuditGap, AuditLog
+
+AUDIT_FALLBACK_PATH = os.getenv("AUDIT_FALLBACK_PATH", "./audit_fallback.jsonl")
+
+_Entry = Tuple[dict, Optional[asyncio.Future]]
+
+def _resolve(future: asyncio.Future, error: Optional[BaseException]) -> None:
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+class AuditWriter:
+    """
+    Buffered, batch-committing writer of AuditLog rows.
+
+    The buffer holds at most `capacity` entries; an entry submitted while it
+    is full is appended to the fallback file rather than dropped. Each batch
+    takes the whole buffer at once, so concurrent flushes never write the
+    same entry twice. File writes and fsync run off the event loop.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 100,
+        flush_interval: float = 0.05,
+        capacity: int = 10000,
+        fallback_path: str = AUDIT_FALLBACK_PATH
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.fallback_path = fallback_path
+        self._buffer: Deque[_Entry] = deque()
+        self._lock = threading.Lock()
+        # Serializes fallback-file access; never held together with the buffer lock
+        self._file_lock = threading.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: Set[asyncio.Future] = set()
+        self._flushing = 0  # Flushes in progress; writers arriving meanwhile follow
+        self.batches = 0
+        self.written = 0
+        self.spilled = 0
+
+    @staticmethod
+    def _row(action_type, token_hash, moderator_id, user_id, action_details) -> dict:
+        return {
+            "action_type": action_type,
+            "token_hash": token_hash,
+            "moderator_id": moderator_id,
+            "user_id": user_id,
+            "action_details": action_details,
+            "created_at": datetime.datetime.utcnow()
+        }
+
+    def _enqueue(self, row: dict, future: Optional[asyncio.Future]) -> bool:
+        """Buffer one entry; returns False when the buffer is full"""
+        with self._lock:
+            if len(self._buffer) >= self.capacity:
+                return False
+            self._buffer.append((row, future))
+            return True
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Flush now if a batch is full, otherwise arm the flush timer"""
+        if len(self._buffer) >= self.batch_size:
+            self._spawn_flush()
+            return
+        with self._lock:
+            if self._timer is not None and self._timer_loop is loop and not loop.is_closed():
+                return
+            self._timer_loop = loop
+            self._timer = loop.call_later(self.flush_interval, self._on_timer)
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+        self._spawn_flush()
+
+    def _track(self, future: asyncio.Future) -> None:
+        self._tasks.add(future)
+        future.add_done_callback(self._tasks.discard)
+
+    def _spawn_flush(self) -> None:
+        self._track(asyncio.ensure_future(self.flush()))
+
+    def submit(self, action_type: str, token_hash: str, moderator_id: Optional[int] = None,
+               user_id: Optional[int] = None, action_details: Optional[str] = None) -> None:
+        """Buffer an entry without waiting for it to be written"""
+        row = self._row(action_type, token_hash, moderator_id, user_id, action_details)
+        loop = asyncio.get_running_loop()
+        if not self._enqueue(row, None):
+            self._track(loop.run_in_executor(None, self._spill, [row]))
+            return
+        self._schedule_flush(loop)
+
+    async def write(self, action_type: str, token_hash: str, moderator_id: Optional[int] = None,
+                    user_id: Optional[int] = None, action_details: Optional[str] = None) -> None:
+        """Buffer an entry and return once it is committed or in the fallback file"""
+        row = self._row(action_type, token_hash, moderator_id, user_id, action_details)
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            full = len(self._buffer) >= self.capacity
+            if not full:
+                self._buffer.append((row, future))
+                # Checked under the lock a finishing flush takes, so a follower is never stranded
+                lead = self._flushing == 0
+        if full:
+            await asyncio.to_thread(self._spill, [row])
+            return
+        if lead:
+            await self.flush()
+        await future
+
+    async def flush(self) -> int:
+        """
+        Write buffered entries, one transaction per batch taken, until the
+        buffer is empty; returns how many were written.
+        """
+        written = 0
+        with self._lock:
+            self._flushing += 1
+        try:
+            while True:
+                with self._lock:
+                    entries = list(self._buffer)
+                    self._buffer.clear()
+                    if not entries:
+                        self._flushing -= 1
+                        return written
+                # A cancelled flush must not abandon entries it already took
+                await asyncio.shield(self._write_batch(entries))
+                written += len(entries)
+        except BaseException:
+            with self._lock:
+                self._flushing -= 1
+            raise
+
+    async def _write_batch(self, entries: List[_Entry]) -> None:
+        rows = [row for row, _ in entries]
+        error = None
+        try:
+            await self._insert(rows)
+            self.batches += 1
+            self.written += len(rows)
+        except Exception:
+            try:
+                await asyncio.to_thread(self._spill, rows)
+            except Exception as e:
+                error = e
+        for _, future in entries:
+            if future is None:
+                continue
+            try:
+                # The waiter may belong to another event loop
+                future.get_loop().call_soon_threadsafe(_resolve, future, error)
+            except RuntimeError:
+                pass  # Its loop is gone, so nobody is waiting
+
+    async def _insert(self, rows: List[dict]) -> None:
+        async with session_scope() as db:
+            await db.execute(insert(AuditLog), rows)
+
+    def _spill(self, rows: List[dict]) -> None:
+        """Append rows to the fallback file and fsync before returning"""
+        with self._file_lock:
+            with open(self.fallback_path, "a") as f:
+                for row in rows:
+                    f.write(json.dumps({**row, "created_at": row["created_at"].isoformat()}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.spilled += len(rows)
+
+    async def replay_fallback(self) -> int:
+        """
+        Insert the entries left in the fallback file. The file is moved aside
+        first so spills during the replay are kept for the next one; a failed
+        replay leaves it in place to retry.
+        """
+        replay_path = self.fallback_path + ".replay"
+        with self._file_lock:
+            if os.path.exists(self.fallback_path) and not os.path.exists(replay_path):
+                os.replace(self.fallback_path, replay_path)
+        if not os.path.exists(replay_path):
+            return 0
+        with open(replay_path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for row in rows:
+            row["created_at"] = datetime.datetime.fromisoformat(row["created_at"])
+        if rows:
+            await self._insert(rows)
+        os.remove(replay_path)
+        return len(rows)
+
+    async def start(self) -> None:
+        try:
+            await self.replay_fallback()
+        except Exception as e:
+            print(f"Audit fallback replay error: {str(e)}")
+
+    async def stop(self) -> None:
+        """Cancel the pending timer and flush whatever is still buffered"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+
+    def clear(self) -> None:
+        """Drop buffered entries without writing them"""
+        with self._lock:
+            self._buffer.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._buffer),
+            "batches": self.batches,
+            "written": self.written,
+            "spilled": self.spilled
+        }
+
+audit_writer = AuditWriter()
+
+GENESIS_HASH = "0" * 64
+# Largest id range one verification request may cover
+MAX_VERIFY_RANGE = 10000
+
+def compute_entry_hash(prev_hash: str, log: AuditLog) -> str:
+    """sha256 over the previous entry hash and the canonical form of the row"""
+    payload = json.dumps(
+        [
+            log.id,
+            log.action_type,
+            log.token_hash,
+            log.moderator_id,
+            log.user_id,
+            log.action_details,
+            log.created_at.isoformat() if log.created_at else None
+        ],
+        separators=(",", ":")
+    )
+    return hashlib.sha256(bytes.fromhex(prev_hash) + payload.encode()).hexdigest()
+
+# Leaves and inner nodes are domain-separated so a leaf can never pass as a node
+def _leaf(entry_hash: Optional[str]) -> bytes:
+    return hashlib.sha256(b"\x00" + bytes.fromhex(entry_hash or "")).digest()
+
+def _node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+def _merkle_levels(entry_hashes: Sequence[Optional[str]]) -> List[List[bytes]]:
+    """Every level of the tree, leaves first; an unpaired node is carried up"""
+    level = [_leaf(entry_hash) for entry_hash in entry_hashes]
+    levels = [level]
+    while len(level) > 1:
+        level = [
+            _node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+        levels.append(level)
+    return levels
+
+def merkle_root(entry_hashes: Sequence[Optional[str]]) -> str:
+    return _merkle_levels(entry_hashes)[-1][0].hex()
+
+def merkle_proof(entry_hashes: Sequence[Optional[str]], index: int) -> List[Tuple[str, str]]:
+    """The (side, sibling hash) pairs from leaf `index` up to the root"""
+    proof = []
+    for level in _merkle_levels(entry_hashes)[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(("left" if sibling < index else "right", level[sibling].hex()))
+        index //= 2
+    return proof
+
+def verify_inclusion(entry_hash: str, proof: Sequence[Tuple[str, str]], root: str) -> bool:
+    """Check a proof from merkle_proof() in one hash per tree level"""
+    node = _leaf(entry_hash)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        node = _node(sibling, node) if side == "left" else _node(node, sibling)
+    return node.hex() == root
+
+class AuditLedger:
+    """
+    Seals committed audit logs into a hash chain and checkpoints it.
+
+    Each sealed row stores sha256(previous entry hash || row), in id order,
+    starting from GENESIS_HASH. Every `checkpoint_size` sealed rows get an
+    AuditCheckpoint holding the Merkle root of their entry hashes and the
+    chain hashes at both ends. A range is verified by recomputing the chain
+    from the checkpoint before it, so the cost is the range plus at most
+    two checkpoints rather than the whole table. Sealing is deterministic,
+    so two workers sealing at once write identical hashes.
+
+    A row that commits after a higher id was sealed cannot join the chain
+    without rewriting it. It is recorded as an AuditGap holding the hash of
+    the row alone, and verification checks it against that record instead
+    of reporting the chain as broken.
+    """
+
+    def __init__(self, checkpoint_size: int = 1024, batch_size: int = 1000, seal_interval: float = 1.0):
+        self.checkpoint_size = checkpoint_size
+        self.batch_size = batch_size
+        self.seal_interval = seal_interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def seal(self, db: Optional[AsyncSession] = None) -> int:
+        """
+        Hash every unsealed row, record late rows as gaps and write the
+        checkpoints that became full; returns rows sealed.
+        """
+        sealed = 0
+        async with session_scope(db) as db:
+            last = (await db.execute(
+                select(AuditLog.id, AuditLog.entry_hash)
+                .where(AuditLog.entry_hash != None)
+                .order_by(AuditLog.id.desc())
+                .limit(1)
+            )).first()
+            after_id, prev_hash = last if last else (0, GENESIS_HASH)
+            await self._record_gaps(after_id, db)
+            while True:
+                rows = (await db.execute(
+                    select(AuditLog)
+                    .where(AuditLog.id > after_id)
+                    .order_by(AuditLog.id)
+                    .limit(self.batch_size)
+                )).scalars().all()
+                if not rows:
+                    break
+                hashes = []
+                for row in rows:
+                    prev_hash = compute_entry_hash(prev_hash, row)
+                    hashes.append({"id": row.id, "entry_hash": prev_hash})
+                await db.execute(update(AuditLog), hashes)
+                sealed += len(rows)
+                after_id = rows[-1].id
+            await self._checkpoint(db)
+        return sealed
+
+    async def _record_gaps(self, before_id: int, db: AsyncSession) -> int:
+        """Record unsealed rows below the chain head that have no gap yet"""
+        late = (await db.execute(
+            select(AuditLog)
+            .outerjoin(AuditGap, AuditGap.log_id == AuditLog.id)
+            .where(AuditLog.entry_hash == None, AuditLog.id < before_id, AuditGap.id == None)
+            .order_by(AuditLog.id)
+        )).scalars().all()
+        if late:
+            await db.execute(insert(AuditGap), [
+                {"log_id": row.id, "entry_hash": compute_entry_hash(GENESIS_HASH, row)}
+                for row in late
+            ])
+        return len(late)
+
+    async def _checkpoint(self, db: AsyncSession) -> int:
+        last = (await db.execute(
+            select(AuditCheckpoint).order_by(AuditCheckpoint.last_id.desc()).limit(1)
+        )).scalars().first()
+        after_id, prev_hash = (last.last_id, last.chain_hash) if last else (0, GENESIS_HASH)
+        written = 0
+        while True:
+            leaves = (await db.execute(
+                select(AuditLog.id, AuditLog.entry_hash)
+                .where(AuditLog.id > after_id, AuditLog.entry_hash != None)
+                .order_by(AuditLog.id)
+                .limit(self.checkpoint_size)
+            )).all()
+            if len(leaves) < self.checkpoint_size:
+                return written
+            checkpoint = AuditCheckpoint(
+                first_id=leaves[0].id,
+                last_id=leaves[-1].id,
+                entry_count=len(leaves),
+                prev_hash=prev_hash,
+                chain_hash=leaves[-1].entry_hash,
+                merkle_root=merkle_root([leaf.entry_hash for leaf in leaves])
+            )
+            db.add(checkpoint)
+            written += 1
+            after_id, prev_hash = checkpoint.last_id, checkpoint.chain_hash
+
+    async def verify_range(self, first_id: int, last_id: Optional[int] = None,
+                           db: Optional[AsyncSession] = None) -> dict:
+        """
+        Recompute the chain over [first_id, last_id] (to the end by default)
+        and the Merkle root of every checkpoint overlapping it. Stops at the
+        first row that does not match. Unsealed rows at the tail are counted,
+        not failed; so are recorded gaps whose row still matches its hash. Any
+        other sealed row after an unsealed one is a failure.
+        """
+        report = {
+            "valid": True,
+            "first_id": first_id,
+            "last_id": last_id,
+            "verified": 0,
+            "checkpoints": 0,
+            "unsealed": 0,
+            "gaps": 0,
+            "failed_id": None,
+            "error": None
+        }
+
+        def fail(row_id: int, error: str) -> dict:
+            report.update(valid=False, failed_id=row_id, error=error)
+            return report
+
+        async with session_scope(db) as db:
+            if last_id is None:
+                last_id = report["last_id"] = (await db.execute(select(func.max(AuditLog.id)))).scalar() or 0
+            anchor = (await db.execute(
+                select(AuditCheckpoint)
+                .where(AuditCheckpoint.last_id < first_id)
+                .order_by(AuditCheckpoint.last_id.desc())
+                .limit(1)
+            )).scalars().first()
+            after_id, prev_hash = (anchor.last_id, anchor.chain_hash) if anchor else (0, GENESIS_HASH)
+            checkpoints = deque((await db.execute(
+                select(AuditCheckpoint)
+                .where(AuditCheckpoint.last_id >= first_id, AuditCheckpoint.first_id <= last_id)
+                .order_by(AuditCheckpoint.first_id)
+            )).scalars().all())
+            end_id = max(last_id, checkpoints[-1].last_id) if checkpoints else last_id
+            gaps = dict((await db.execute(
+                select(AuditGap.log_id, AuditGap.entry_hash)
+                .where(AuditGap.log_id > after_id, AuditGap.log_id <= end_id)
+            )).all())
+            leaves: List[str] = []
+            sealed = True
+            while after_id < end_id:
+                rows = (await db.execute(
+                    select(AuditLog)
+                    .where(AuditLog.id > after_id, AuditLog.id <= end_id)
+                    .order_by(AuditLog.id)
+                    .limit(self.batch_size)
+                )).scalars().all()
+                if not rows:
+                    break
+                for row in rows:
+                    if row.entry_hash is None:
+                        if row.id in gaps:
+                            if compute_entry_hash(GENESIS_HASH, row) != gaps[row.id]:
+                                return fail(row.id, "gap entry hash mismatch")
+                            if first_id <= row.id <= last_id:
+                                report["gaps"] += 1
+                            continue
+                        sealed = False
+                        if first_id <= row.id <= last_id:
+                            report["unsealed"] += 1
+                        continue
+                    if not sealed:
+                        return fail(row.id, "sealed entry follows an unsealed one")
+                    checkpoint = checkpoints[0] if checkpoints else None
+                    if checkpoint is not None and checkpoint.first_id <= row.id:
+                        if row.id == checkpoint.first_id and prev_hash != checkpoint.prev_hash:
+                            return fail(row.id, "chain does not match checkpoint start")
+                    expected = compute_entry_hash(prev_hash, row)
+                    if row.entry_hash != expected:
+                        return fail(row.id, "entry hash mismatch")
+                    prev_hash = expected
+                    if first_id <= row.id <= last_id:
+                        report["verified"] += 1
+                    if checkpoint is not None and checkpoint.first_id <= row.id:
+                        leaves.append(expected)
+                        if row.id == checkpoint.last_id:
+                            if (len(leaves) != checkpoint.entry_count
+                                    or expected != checkpoint.chain_hash
+                                    or merkle_root(leaves) != checkpoint.merkle_root):
+                                return fail(row.id, f"checkpoint {checkpoint.id} does not match")
+                            checkpoints.popleft()
+                            leaves = []
+                            report["checkpoints"] += 1
+                after_id = rows[-1].id
+        if checkpoints:
+            return fail(checkpoints[0].first_id, f"checkpoint {checkpoints[0].id} is missing entries")
+        return report
+
+    async def prove_inclusion(self, entry_id: int, db: Optional[AsyncSession] = None) -> Optional[dict]:
+        """
+        Merkle path from an entry to its checkpoint root, or None if the
+        entry is not checkpointed yet. prev_hash lets the caller recompute
+        entry_hash from the row itself.
+        """
+        async with session_scope(db) as db:
+            checkpoint = (await db.execute(
+                select(AuditCheckpoint)
+                .where(AuditCheckpoint.first_id <= entry_id, AuditCheckpoint.last_id >= entry_id)
+            )).scalars().first()
+            if checkpoint is None:
+                return None
+            leaves = (await db.execute(
+                select(AuditLog.id, AuditLog.entry_hash)
+                .where(
+                    AuditLog.id >= checkpoint.first_id,
+                    AuditLog.id <= checkpoint.last_id,
+                    AuditLog.entry_hash != None
+                )
+                .order_by(AuditLog.id)
+            )).all()
+        ids = [leaf.id for leaf in leaves]
+        index = bisect.bisect_left(ids, entry_id)
+        if index == len(ids) or ids[index] != entry_id:
+            return None
+        hashes = [leaf.entry_hash for leaf in leaves]
+        return {
+            "entry_id": entry_id,
+            "entry_hash": hashes[index],
+            "prev_hash": hashes[index - 1] if index else checkpoint.prev_hash,
+            "checkpoint_id": checkpoint.id,
+            "leaf_index": index,
+            "merkle_root": checkpoint.merkle_root,
+            "proof": merkle_proof(hashes, index)
+        }
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.seal()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Audit sealer error: {str(e)}")
+            await asyncio.sleep(self.seal_interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+audit_ledger = AuditLedger()
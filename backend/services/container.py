@@ -0,0 +1,79 @@
+"""
+Service container for WhisperChain+.
+
+This file implements:
+1. Application-lifespan construction of TokenManager, KeyManager and ModerationService
+2. Cache warming at startup
+3. Typed FastAPI dependencies for the shared token and key managers
+4. Cleanup on shutdown
+
+Each service is built once per process, so its derived keys and
+per-instance caches survive across requests instead of being rebuilt by
+every request's dependency.
+"""
+
+import os
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.db_session import session_scope
+from database.models import User
+from encryption.key_management import KeyManager, public_key_cache
+from encryption.token_manager import TokenManager
+from backend.moderation import ModerationService
+from backend.services.moderation_service import ban_index
+
+TOKEN_SECRET_KEY = os.getenv("TOKEN_SECRET_KEY", "your-secret-key")
+TOKEN_ENCRYPTION_KEY = os.getenv("TOKEN_ENCRYPTION_KEY", "your-encryption-key-string")
+
+class ServiceContainer:
+    """Process-wide service instances, built once"""
+
+    def __init__(self, secret_key: str = TOKEN_SECRET_KEY, encryption_key: str = TOKEN_ENCRYPTION_KEY):
+        self.token_manager = TokenManager(secret_key=secret_key, encryption_key=encryption_key)
+        self.key_manager = KeyManager()
+        self.moderation_service = ModerationService(self.token_manager)
+
+    async def warm(self, db: Optional[AsyncSession] = None) -> int:
+        """
+        Fill the caches the hot paths read: the ban index, the keystore
+        connection and the parsed public keys of approved receivers.
+        Returns the number of public keys cached.
+        """
+        await ban_index.ensure_loaded(db)
+        self.key_manager.keystore.count()  # Opens the keystore connection
+        warmed = 0
+        async with session_scope(db) as db:
+            rows = (await db.execute(
+                select(User.id, User.public_key)
+                .where(User.role == "receiver", User.is_approved == True)
+                .order_by(User.id.desc())
+                .limit(public_key_cache.max_size)
+            )).all()
+        for user_id, public_key_pem in rows:
+            try:
+                public_key_cache.prime(user_id, public_key_pem)
+                warmed += 1
+            except Exception:
+                # A malformed key is reported when it is actually used
+                continue
+        return warmed
+
+    async def start(self) -> None:
+        try:
+            await self.warm()
+        except Exception as e:
+            print(f"Service warm-up error: {str(e)}")
+
+    async def stop(self) -> None:
+        """Wipe unlocked private keys and close the keystore"""
+        self.key_manager.clear_session_key()
+        self.key_manager.keystore.close()
+
+services = ServiceContainer()
+
+def get_token_manager() -> TokenManager:
+    return services.token_manager
+
+def get_key_manager() -> KeyManager:
+    return services.key_manager
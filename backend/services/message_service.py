@@ -7,4 +7,196 @@ This file implements:
 3. Message delivery
 4. Message flagging
 5. Message cleanup
-""" 
\ No newline at end of file
+"""
+import asyncio
+import json
+from typing import Callable, Dict, Iterable, Iterator, Optional, Set
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.models import Message, MessageBody, User
+from encryption.message_crypto import join_envelope
+
+SERIALIZE_CHUNK_SIZE = 100
+
+def inbox_query(recipient_id: int):
+    """
+    One joined, column-projected query for a recipient's inbox.
+    Rows come back as plain tuples:
+    (id, sender_name, encrypted_content, encrypted_body, created_at, read, seq).
+    Paginate with Page.apply(stmt, Message.created_at, Message.id).
+    """
+    return (
+        select(
+            Message.id,
+            User.username,
+            Message.encrypted_content,
+            MessageBody.encrypted_body,
+            Message.created_at,
+            Message.read,
+            Message.seq,
+        )
+        .outerjoin(User, User.id == Message.sender_id)
+        .outerjoin(MessageBody, MessageBody.id == Message.body_id)
+        .where(Message.recipient_id == recipient_id)
+    )
+
+def serialize_inbox_row(row) -> str:
+    message_id, sender_name, encrypted_content, encrypted_body, created_at, read, seq = row
+    return json.dumps({
+        "id": message_id,
+        "sender_name": sender_name or "Unknown",
+        "encrypted_content": join_envelope(encrypted_content, encrypted_body),  # Frontend will decrypt this
+        "created_at": created_at.isoformat() if created_at else None,
+        "read": bool(read),
+        "seq": seq,
+    })
+
+def inbox_changes_query(recipient_id: int, since: int, limit: int):
+    """
+    Messages delivered to or changed in a recipient's inbox after `since`,
+    oldest change first. Served from the (recipient_id, change_seq) index.
+    """
+    return (
+        select(
+            Message.id,
+            User.username,
+            Message.encrypted_content,
+            MessageBody.encrypted_body,
+            Message.created_at,
+            Message.read,
+            Message.seq,
+            Message.change_seq,
+            Message.is_flagged,
+        )
+        .outerjoin(User, User.id == Message.sender_id)
+        .outerjoin(MessageBody, MessageBody.id == Message.body_id)
+        .where(Message.recipient_id == recipient_id, Message.change_seq > since)
+        .order_by(Message.change_seq)
+        .limit(limit)
+    )
+
+def serialize_change_row(row) -> dict:
+    message_id, sender_name, encrypted_content, encrypted_body, created_at, read, seq, change_seq, is_flagged = row
+    return {
+        "id": message_id,
+        "sender_name": sender_name or "Unknown",
+        "encrypted_content": join_envelope(encrypted_content, encrypted_body),
+        "created_at": created_at.isoformat() if created_at else None,
+        "read": bool(read),
+        "is_flagged": bool(is_flagged),
+        "seq": seq,
+        "change_seq": change_seq,
+    }
+
+def message_content(message: Message) -> str:
+    """A loaded message's full ciphertext; eager-load Message.body with it"""
+    return join_envelope(message.encrypted_content, message.body.encrypted_body if message.body_id else None)
+
+async def next_inbox_seq(db: AsyncSession, recipient_id: int) -> Optional[int]:
+    """
+    Allocate the next sequence number of a recipient's inbox.
+
+    The increment is a single UPDATE ... RETURNING, so concurrent writers to
+    the same inbox serialize on the user row and never share a number.
+    Returns None if the recipient does not exist.
+    """
+    return (await db.execute(
+        update(User)
+        .where(User.id == recipient_id)
+        .values(inbox_seq=User.inbox_seq + 1)
+        .returning(User.inbox_seq)
+        .execution_options(synchronize_session=False)
+    )).scalar_one_or_none()
+
+async def record_inbox_change(db: AsyncSession, message: Message) -> None:
+    """Stamp a read/flag state change so /messages/inbox/changes reports it"""
+    message.change_seq = await next_inbox_seq(db, message.recipient_id)
+
+def stream_json_array(
+    rows: Iterable,
+    serialize: Callable[[object], str] = serialize_inbox_row,
+    chunk_size: int = SERIALIZE_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Serialize rows as a JSON array, `chunk_size` rows per yielded chunk, so
+    no full response document or per-row model objects are ever built.
+    """
+    yield b"["
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(serialize(row))
+        if len(chunk) == chunk_size:
+            yield (("" if first else ",") + ",".join(chunk)).encode()
+            first = False
+            chunk = []
+    if chunk:
+        yield (("" if first else ",") + ",".join(chunk)).encode()
+    yield b"]"
+
+class InboxSubscription:
+    """One connected client: a bounded queue bound to the loop that reads it"""
+
+    def __init__(self, user_id: int, queue_size: int):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.loop = asyncio.get_running_loop()
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+class InboxHub:
+    """
+    In-process pub/sub that pushes new messages to connected recipients.
+
+    Publishing never blocks the sender. Each subscription has a bounded
+    queue; when a slow client lets it fill up, the backlog is dropped and
+    replaced by a single "resync" event, after which the client catches up
+    through /messages/inbox/changes. Only clients connected to this process
+    are reached; others fall back to polling the changes endpoint.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscriptions: Dict[int, Set[InboxSubscription]] = {}
+
+    def subscribe(self, user_id: int) -> InboxSubscription:
+        subscription = InboxSubscription(user_id, self.queue_size)
+        self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: InboxSubscription) -> None:
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+
+    def connection_count(self, user_id: Optional[int] = None) -> int:
+        if user_id is not None:
+            return len(self._subscriptions.get(user_id, ()))
+        return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, user_id: int, event: dict) -> None:
+        """Queue an event for every connection of a user"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        for subscription in list(self._subscriptions.get(user_id, ())):
+            if subscription.loop is loop:
+                self._offer(subscription, event)
+            else:
+                subscription.loop.call_soon_threadsafe(self._offer, subscription, event)
+
+    @staticmethod
+    def _offer(subscription: InboxSubscription, event: dict) -> None:
+        try:
+            subscription.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Backpressure: drop the backlog rather than grow without bound
+            while not subscription.queue.empty():
+                subscription.queue.get_nowait()
+            subscription.queue.put_nowait({"type": "resync"})
+
+inbox_hub = InboxHub()
@@ -7,4 +7,237 @@ This file implements:
 3. User management
 4. System monitoring
 5. Audit log management
-""" 
\ No newline at end of file
+"""
+
+import asyncio
+import datetime
+import heapq
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.db_session import session_scope
+from database.models import User, UserBan
+from auth.session_manager import principal_cache
+
+class BanEntry(NamedTuple):
+    """Immutable snapshot of an active UserBan row"""
+    id: int
+    user_id: int
+    banned_token_hash: str
+    ban_type: str
+    ban_reason: str
+    ban_end_time: Optional[datetime.datetime]
+
+    @classmethod
+    def from_ban(cls, ban: UserBan) -> "BanEntry":
+        return cls(ban.id, ban.user_id, ban.banned_token_hash, ban.ban_type, ban.ban_reason, ban.ban_end_time)
+
+    def is_expired(self, now: datetime.datetime) -> bool:
+        return self.ban_end_time is not None and self.ban_end_time <= now
+
+class _BanState:
+    """One generation of the ban index; swapped wholesale on reload"""
+
+    def __init__(self):
+        self.by_id: Dict[int, BanEntry] = {}
+        self.by_user: Dict[int, Dict[int, BanEntry]] = {}
+        self.by_token: Dict[str, Dict[int, BanEntry]] = {}
+        self.expiry_heap: List[Tuple[datetime.datetime, int]] = []
+
+    def insert(self, entry: BanEntry) -> None:
+        self.remove(entry.id)
+        self.by_id[entry.id] = entry
+        self.by_user.setdefault(entry.user_id, {})[entry.id] = entry
+        self.by_token.setdefault(entry.banned_token_hash, {})[entry.id] = entry
+        if entry.ban_end_time is not None:
+            heapq.heappush(self.expiry_heap, (entry.ban_end_time, entry.id))
+
+    def remove(self, ban_id: int) -> None:
+        entry = self.by_id.pop(ban_id, None)
+        if entry is None:
+            return
+        for bucket, key in ((self.by_user, entry.user_id), (self.by_token, entry.banned_token_hash)):
+            entries = bucket.get(key)
+            if entries is not None:
+                entries.pop(ban_id, None)
+                if not entries:
+                    del bucket[key]
+        # Heap entries for removed bans are skipped lazily when popped
+
+class BanIndex:
+    """
+    In-process index of active bans by user id and by banned token hash.
+
+    Lookups never touch the database. Expiry times sit in a min-heap so a
+    background sweeper can deactivate expired bans in batches; the sweeper
+    also reloads the index so bans issued by other workers become visible
+    within one sweep interval. ban_user/unban_user update it directly.
+    """
+
+    def __init__(self, sweep_interval: float = 5.0, batch_size: int = 500):
+        self.sweep_interval = sweep_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._state = _BanState()
+        self._loaded = False
+        self._pending: Optional[List[Tuple[str, object]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self, db: Optional[AsyncSession] = None) -> None:
+        """Replace the index contents with the active bans in the database"""
+        with self._lock:
+            # Changes made while the query runs are replayed onto the new state
+            self._pending = []
+        try:
+            async with session_scope(db) as db:
+                entries = [
+                    BanEntry.from_ban(ban)
+                    for ban in (await db.execute(
+                        select(UserBan).where(UserBan.is_active == True)
+                    )).scalars()
+                ]
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        state = _BanState()
+        for entry in entries:
+            state.insert(entry)
+        with self._lock:
+            for operation, value in self._pending:
+                if operation == "add":
+                    state.insert(value)
+                else:
+                    state.remove(value)
+            self._pending = None
+            # Users whose bans changed elsewhere may have a stale cached principal
+            old = self._state.by_user
+            changed = {
+                user_id for user_id in set(old) | set(state.by_user)
+                if old.get(user_id, {}).keys() != state.by_user.get(user_id, {}).keys()
+            } if self._loaded else set()
+            self._state = state
+            self._loaded = True
+        for user_id in changed:
+            principal_cache.invalidate_user(user_id)
+
+    async def ensure_loaded(self, db: Optional[AsyncSession] = None) -> None:
+        if not self._loaded:
+            await self.load(db)
+
+    def clear(self) -> None:
+        """Drop everything; the next ensure_loaded() reloads from the database"""
+        with self._lock:
+            self._state = _BanState()
+            self._loaded = False
+
+    def add(self, ban: UserBan) -> None:
+        """Index a newly committed ban"""
+        entry = BanEntry.from_ban(ban)
+        with self._lock:
+            self._state.insert(entry)
+            if self._pending is not None:
+                self._pending.append(("add", entry))
+
+    def discard(self, ban_ids: Iterable[int]) -> None:
+        """Forget bans that were deactivated"""
+        with self._lock:
+            for ban_id in ban_ids:
+                self._state.remove(ban_id)
+                if self._pending is not None:
+                    self._pending.append(("discard", ban_id))
+
+    @staticmethod
+    def _pick(entries: Optional[Dict[int, BanEntry]], now: Optional[datetime.datetime]) -> Optional[BanEntry]:
+        if not entries:
+            return None
+        now = now or datetime.datetime.now()
+        live = [entry for entry in entries.values() if not entry.is_expired(now)]
+        if not live:
+            return None
+        # Report the ban that lasts longest; permanent bans win
+        return max(live, key=lambda entry: entry.ban_end_time or datetime.datetime.max)
+
+    def user_ban(self, user_id: int, now: Optional[datetime.datetime] = None) -> Optional[BanEntry]:
+        """Return the user's active ban, if any"""
+        return self._pick(self._state.by_user.get(user_id), now)
+
+    def token_ban(self, token_hash: str, now: Optional[datetime.datetime] = None) -> Optional[BanEntry]:
+        """Return the active ban placed on a token, if any"""
+        return self._pick(self._state.by_token.get(token_hash), now)
+
+    def pop_expired(self, now: Optional[datetime.datetime] = None) -> List[BanEntry]:
+        """Remove and return the indexed bans whose end time has passed"""
+        now = now or datetime.datetime.now()
+        expired = []
+        with self._lock:
+            state = self._state
+            while state.expiry_heap and state.expiry_heap[0][0] <= now:
+                end_time, ban_id = heapq.heappop(state.expiry_heap)
+                entry = state.by_id.get(ban_id)
+                if entry is not None and entry.ban_end_time == end_time:
+                    state.remove(ban_id)
+                    expired.append(entry)
+                    if self._pending is not None:
+                        self._pending.append(("discard", ban_id))
+        return expired
+
+    async def sweep(self, db: Optional[AsyncSession] = None) -> int:
+        """
+        Deactivate expired bans in batches and clear the denormalized ban
+        state of users left without an active ban.
+        Returns how many bans were deactivated.
+        """
+        expired = self.pop_expired()
+        if not expired:
+            return 0
+        async with session_scope(db) as db:
+            for start in range(0, len(expired), self.batch_size):
+                batch = expired[start:start + self.batch_size]
+                user_ids = list({entry.user_id for entry in batch})
+                await db.execute(
+                    update(UserBan)
+                    .where(UserBan.id.in_([entry.id for entry in batch]))
+                    .values(is_active=False)
+                    .execution_options(synchronize_session=False)
+                )
+                still_banned = select(UserBan.user_id).where(
+                    UserBan.user_id.in_(user_ids),
+                    UserBan.is_active == True
+                )
+                await db.execute(
+                    update(User)
+                    .where(User.id.in_(user_ids), User.id.not_in(still_banned))
+                    .values(is_banned=False, active_ban_until=None)
+                    .execution_options(synchronize_session=False)
+                )
+        for user_id in {entry.user_id for entry in expired}:
+            principal_cache.invalidate_user(user_id)
+        return len(expired)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+                await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Ban sweeper error: {str(e)}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+ban_index = BanIndex()
@@ -7,4 +7,125 @@ This file implements:
 3. Token expiration
 4. Token revocation
 5. Token usage tracking
-""" 
\ No newline at end of file
+"""
+
+import asyncio
+import datetime
+import time
+from typing import Optional
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.db_session import session_scope, insert_ignore
+from database.models import Round, TokenMapping, User, UserBan
+from encryption.token_manager import (
+    TokenManager,
+    ROUND_DURATION_SECONDS,
+    current_round_id,
+    round_start_time,
+)
+
+class RoundScheduler:
+    """
+    Opens rounds and mints every approved sender's token before the round starts.
+
+    Tokens for round N+1 are bulk-inserted `lead_seconds` before its boundary,
+    so the first send of a round finds its token instead of creating it.
+    """
+
+    def __init__(self, token_manager: TokenManager, lead_seconds: float = 15.0):
+        self.token_manager = token_manager
+        self.lead_seconds = min(lead_seconds, ROUND_DURATION_SECONDS)
+        self._task: Optional[asyncio.Task] = None
+
+    async def prepare_round(self, round_id: int, db: Optional[AsyncSession] = None) -> int:
+        """
+        Create the round row and mint tokens for all approved, unbanned senders.
+        Idempotent; returns the number of tokens minted.
+        """
+        async with session_scope(db) as db:
+            start_time = round_start_time(round_id)
+            await db.execute(insert_ignore(db, Round.__table__).values(
+                id=round_id,
+                start_time=start_time,
+                end_time=start_time + datetime.timedelta(seconds=ROUND_DURATION_SECONDS),
+                is_active=False
+            ))
+
+            sender_ids = list((await db.execute(select(User.id).where(
+                User.role == "sender",
+                User.is_approved == True,
+                ~User.bans.any(UserBan.is_active == True),
+                ~User.tokens.any(TokenMapping.round_id == round_id)
+            ))).scalars())
+            if not sender_ids:
+                return 0
+
+            expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+            token_hashes = self.token_manager.generate_token_hashes(sender_ids, round_id)
+            encrypted_ids = self.token_manager.encrypt_user_ids(sender_ids)
+            rows = [
+                {
+                    "token_hash": token_hash,
+                    "encrypted_user_id": encrypted_id,
+                    "round_id": round_id,
+                    "expires_at": expires_at,
+                    "user_id": user_id,
+                }
+                for user_id, token_hash, encrypted_id in zip(sender_ids, token_hashes, encrypted_ids)
+            ]
+            # One executemany for the whole round
+            result = await db.execute(insert_ignore(db, TokenMapping.__table__), rows)
+            return result.rowcount
+
+    async def activate_round(self, round_id: int, db: Optional[AsyncSession] = None) -> None:
+        """Mark a round as the active one"""
+        async with session_scope(db) as db:
+            await db.execute(
+                update(Round)
+                .where(Round.is_active == True, Round.id != round_id)
+                .values(is_active=False)
+                .execution_options(synchronize_session=False)
+            )
+            await db.execute(
+                update(Round)
+                .where(Round.id == round_id)
+                .values(is_active=True)
+                .execution_options(synchronize_session=False)
+            )
+
+    async def open_round(self, round_id: int) -> int:
+        """Prepare and activate a round in one transaction"""
+        async with session_scope() as db:
+            minted = await self.prepare_round(round_id, db=db)
+            await self.activate_round(round_id, db=db)
+            return minted
+
+    async def run(self) -> None:
+        """Keep the current round open and the next one minted ahead of its boundary"""
+        while True:
+            try:
+                round_id = current_round_id()
+                await self.open_round(round_id)
+
+                next_start = (round_id + 1) * ROUND_DURATION_SECONDS
+                await asyncio.sleep(max(0.0, next_start - self.lead_seconds - time.time()))
+                await self.prepare_round(round_id + 1)
+                await asyncio.sleep(max(0.0, next_start - time.time()))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Round scheduler error: {str(e)}")
+                await asyncio.sleep(1)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
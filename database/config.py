@@ -7,4 +7,20 @@ This file defines:
 3. Configuration validation
 4. Default values
 5. Security settings
-""" 
\ No newline at end of file
+"""
+
+import os
+
+# Database connection URL, overridable for tests and deployments
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./users.db")
+
+def to_async_url(url: str) -> str:
+    """Map a sync database URL onto its async driver"""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgresql:"):
+        return "postgresql+asyncpg:" + url[len("postgresql:"):]
+    return url
+
+# Async driver URL used by the request handlers (aiosqlite, or asyncpg for Postgres)
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", to_async_url(SQLALCHEMY_DATABASE_URL))
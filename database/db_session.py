@@ -7,4 +7,39 @@ This file implements:
 3. Transaction management
 4. Error handling
 5. Session cleanup
-""" 
\ No newline at end of file
+"""
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import AsyncSessionLocal
+
+@asynccontextmanager
+async def session_scope(db: Optional[AsyncSession] = None) -> AsyncIterator[AsyncSession]:
+    """
+    Provide a transactional scope around a unit of work.
+
+    When a request-scoped session is passed in, it is yielded as-is and the
+    caller stays responsible for the single commit at the end of the request.
+    Without one, a fresh session is opened, committed on success, rolled back
+    on error and closed.
+    """
+    if db is not None:
+        yield db
+        return
+
+    async with AsyncSessionLocal() as session:
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+
+def insert_ignore(db: AsyncSession, table):
+    """Build an INSERT that silently skips rows violating a unique constraint"""
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table).on_conflict_do_nothing()
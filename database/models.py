@@ -4,13 +4,15 @@ The database models:
 Models:
 - User: Stores core user information for authentication and messaging
 - Message: Stores messages between users with encryption and metadata
+- MessageBody: Stores the shared encrypted body of a multi-recipient message
 - TokenMapping: Stores pseudonymous token mappings for anonymous messaging
 - MessageToken: Tracks token usage per message
+- Round: Stores the fixed-length rounds tokens are issued for
 - Uses SQLAlchemy ORM for database interactions
 """
 
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, UniqueConstraint
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, UniqueConstraint, Index, text
+from sqlalchemy.orm import relationship, synonym
 from sqlalchemy.sql import func
 from database.database import Base
 import datetime
@@ -24,10 +26,18 @@ class UserBan(Base):
     banned_token_hash = Column(String, nullable=False)  # The token that caused the ban
     ban_start_time = Column(DateTime, default=datetime.datetime.utcnow)
     ban_end_time = Column(DateTime, nullable=True)  # Changed to nullable for permanent bans
+    ban_type = Column(String, nullable=False, default="unknown", index=True)  # 'freeze', 'temp_5min' or 'temp_1hour'
     ban_reason = Column(Text, nullable=False)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
+    __table_args__ = (
+        Index('ix_user_bans_user_id_is_active', 'user_id', 'is_active'),
+        Index('ix_user_bans_banned_token_hash_is_active', 'banned_token_hash', 'is_active'),
+        # Keyset pagination of /moderator/banned-users
+        Index('ix_user_bans_is_active_created_at_id', 'is_active', 'created_at', 'id'),
+    )
+    
     # Relationships
     user = relationship("User", back_populates="bans")
 
@@ -40,19 +50,42 @@ class User(Base):
     role = Column(String, nullable=False)  # 'sender', 'receiver', 'moderator', or 'admin'
     is_approved = Column(Boolean, default=False)
     status = Column(String, default="pending")  # "pending", "approved", or "rejected"
-    banned_until = Column(DateTime, nullable=True)  # For temporary bans
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Denormalized ban state, kept in sync by every ban and unban so ban checks
+    # are a column read. A banned user with no end time is banned permanently.
+    is_banned = Column(Boolean, default=False, nullable=False, index=True)
+    active_ban_until = Column("banned_until", DateTime, nullable=True)
+    banned_until = synonym("active_ban_until")
+    # Last sequence number handed out for this user's inbox; see Message.seq
+    inbox_seq = Column(Integer, default=0, server_default="0", nullable=False)
+    # Python-side default keeps sub-second precision for keyset pagination;
+    # func.now() is only second-resolution on SQLite
+    created_at = Column(DateTime(timezone=True), default=datetime.datetime.utcnow, server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
+    __table_args__ = (
+        # Keyset pagination of /admin/pending-users and /users/receivers
+        Index('ix_users_status_created_at_id', 'status', 'created_at', 'id'),
+        Index('ix_users_role_created_at_id', 'role', 'created_at', 'id'),
+    )
+    
     # Relationships
     sent_messages = relationship("Message", foreign_keys="Message.sender_id", back_populates="sender")
     received_messages = relationship("Message", foreign_keys="Message.recipient_id", back_populates="recipient")
     tokens = relationship("TokenMapping", back_populates="user")
     bans = relationship("UserBan", back_populates="user")
 
-    def is_banned(self) -> bool:
-        """Check if user has any active bans"""
-        return any(ban.is_active for ban in self.bans)
+    def has_active_ban(self, now: Optional[datetime.datetime] = None) -> bool:
+        """Check the denormalized ban state without loading the bans relationship"""
+        if not self.is_banned:
+            return False
+        if self.active_ban_until is None:
+            return True
+        return self.active_ban_until > (now or datetime.datetime.now())
+    
+    def set_ban_state(self, banned: bool, until: Optional[datetime.datetime] = None) -> None:
+        """Update the denormalized ban columns; called on every ban and unban"""
+        self.is_banned = banned
+        self.active_ban_until = until if banned else None
     
     def get_active_ban(self) -> Optional["UserBan"]:
         """Get the user's active ban if any"""
@@ -71,11 +104,36 @@ class Message(Base):
     is_resolved = Column(Boolean, default=False)  # For moderator resolution
     flag_reason = Column(Text, nullable=True)  # Reason for flagging
     token_hash = Column(String, nullable=True)  # Hash of the token used to send the message
+    # Per-recipient sequence numbers: seq is assigned once on delivery, change_seq
+    # is bumped on every read/flag state change so clients can sync deltas
+    seq = Column(Integer, nullable=True)
+    change_seq = Column(Integer, nullable=True)
+    # Multi-recipient messages: encrypted_content holds only this recipient's
+    # wrapped key and the encrypted body is shared through message_bodies
+    body_id = Column(Integer, ForeignKey("message_bodies.id"), nullable=True, index=True)
+    
+    __table_args__ = (
+        # Keyset pagination of the inbox and the flagged message queues
+        Index('ix_messages_recipient_id_created_at_id', 'recipient_id', 'created_at', 'id'),
+        Index('ix_messages_is_flagged_created_at_id', 'is_flagged', 'created_at', 'id'),
+        Index('ix_messages_recipient_id_change_seq', 'recipient_id', 'change_seq'),
+    )
     
     # Relationships
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
     recipient = relationship("User", foreign_keys=[recipient_id], back_populates="received_messages")
     message_token = relationship("MessageToken", back_populates="message", uselist=False)
+    body = relationship("MessageBody", back_populates="messages")
+
+class MessageBody(Base):
+    __tablename__ = "message_bodies"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    encrypted_body = Column(Text, nullable=False)  # Encrypted once for every recipient
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    
+    # Relationships
+    messages = relationship("Message", back_populates="body")
 
 class TokenMapping(Base):
     __tablename__ = "token_mappings"
@@ -101,6 +159,14 @@ class TokenMapping(Base):
     user = relationship("User", back_populates="tokens")
     message_tokens = relationship("MessageToken", back_populates="token_mapping")
 
+class Round(Base):
+    __tablename__ = "rounds"
+    
+    id = Column(Integer, primary_key=True, index=True)  # Same value as TokenMapping.round_id
+    start_time = Column(DateTime, nullable=True)
+    end_time = Column(DateTime, nullable=True)
+    is_active = Column(Boolean, default=False)
+
 class MessageToken(Base):
     __tablename__ = "message_tokens"
     
@@ -123,7 +189,42 @@ class AuditLog(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # The user who received the action
     action_details = Column(Text, nullable=True)  # Additional details like ban duration
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # sha256 over the previous entry's hash and this row; set when the row is sealed
+    entry_hash = Column(String(64), nullable=True)
+    
+    __table_args__ = (
+        # Keyset pagination of /admin/audit-logs
+        Index('ix_audit_logs_created_at_id', 'created_at', 'id'),
+        # Lets the sealer find rows that committed after a higher id was sealed
+        Index(
+            'ix_audit_logs_unsealed_id', 'id',
+            sqlite_where=text('entry_hash IS NULL'),
+            postgresql_where=text('entry_hash IS NULL')
+        ),
+    )
     
     # Relationships
     moderator = relationship("User", foreign_keys=[moderator_id])
-    user = relationship("User", foreign_keys=[user_id])
\ No newline at end of file
+    user = relationship("User", foreign_keys=[user_id])
+
+class AuditCheckpoint(Base):
+    """Merkle root over the entry hashes of a contiguous run of sealed audit logs"""
+    __tablename__ = "audit_checkpoints"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    first_id = Column(Integer, nullable=False, unique=True)
+    last_id = Column(Integer, nullable=False, unique=True)
+    entry_count = Column(Integer, nullable=False)
+    prev_hash = Column(String(64), nullable=False)  # Entry hash just before first_id
+    chain_hash = Column(String(64), nullable=False)  # Entry hash of last_id
+    merkle_root = Column(String(64), nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class AuditGap(Base):
+    """An audit log that committed after a higher id was sealed, so the chain skips it"""
+    __tablename__ = "audit_gaps"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    log_id = Column(Integer, ForeignKey("audit_logs.id"), nullable=False, unique=True)
+    entry_hash = Column(String(64), nullable=False)  # sha256 over GENESIS_HASH and the row alone
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -0,0 +1,90 @@
+"""
+Keyset pagination for list endpoints.
+
+Pages are ordered by (created_at, id) and addressed by an opaque cursor
+naming the last row of the previous page, so every page is an index range
+scan of at most `limit` rows no matter how large the table grows.
+The cursor for the next page is returned in the X-Next-Cursor header and is
+absent on the last page; response bodies stay plain lists.
+"""
+
+import base64
+import datetime
+import json
+from typing import Callable, List, MutableMapping, Optional, Sequence, Tuple, TypeVar
+from fastapi import HTTPException, Query, status
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+T = TypeVar("T")
+
+def encode_cursor(created_at: Optional[datetime.datetime], row_id: int) -> str:
+    """Pack a (created_at, id) position into an opaque, URL-safe token"""
+    raw = json.dumps([created_at.isoformat() if created_at else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime.datetime], int]:
+    """Unpack a cursor from encode_cursor(); raises 400 on anything else"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return (datetime.datetime.fromisoformat(created_at) if created_at else None), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
+
+class Page:
+    """
+    Pagination dependency: `page: Page = Depends()`.
+
+    1. apply() adds the keyset predicate, ordering and limit to a select
+    2. paginate() trims the look-ahead row and sets the next cursor header,
+       usually on the injected `response: Response`
+    """
+
+    def __init__(
+        self,
+        cursor: Optional[str] = Query(None, description="Opaque cursor from X-Next-Cursor"),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+    ):
+        self.cursor = cursor
+        self.limit = limit
+        self.position = decode_cursor(cursor) if cursor else None
+
+    def apply(self, stmt, created_at_column, id_column, descending: bool = False):
+        if self.position is not None:
+            created_at, row_id = self.position
+            if descending:
+                stmt = stmt.where(or_(
+                    created_at_column < created_at,
+                    and_(created_at_column == created_at, id_column < row_id)
+                ))
+            else:
+                stmt = stmt.where(or_(
+                    created_at_column > created_at,
+                    and_(created_at_column == created_at, id_column > row_id)
+                ))
+        if descending:
+            stmt = stmt.order_by(created_at_column.desc(), id_column.desc())
+        else:
+            stmt = stmt.order_by(created_at_column, id_column)
+        # One extra row tells us whether another page exists
+        return stmt.limit(self.limit + 1)
+
+    def paginate(
+        self,
+        rows: Sequence[T],
+        headers: MutableMapping[str, str],
+        key: Callable[[T], Tuple[Optional[datetime.datetime], int]] = lambda row: (row.created_at, row.id)
+    ) -> List[T]:
+        """Drop the look-ahead row and, if there was one, write the next cursor into `headers`"""
+        rows = list(rows)
+        if len(rows) > self.limit:
+            rows = rows[:self.limit]
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(*key(rows[-1]))
+        return rows
@@ -0,0 +1,101 @@
+"""
+Crypto executor for WhisperChain+.
+
+CPU-heavy cryptography (RSA-OAEP, PEM parsing, PBKDF2) is run off the event
+loop through one shared, bounded executor so a slow decrypt never stalls
+concurrent requests on the same worker.
+
+Configuration:
+- CRYPTO_EXECUTOR: "thread" (default) or "process"
+- CRYPTO_WORKERS: pool size, defaults to the CPU count
+- CRYPTO_MAX_QUEUE: calls allowed to wait for a free worker before
+  CryptoExecutorBusy is raised
+
+OpenSSL releases the GIL during these operations, so threads already run
+them in parallel. The process pool isolates them fully, but every argument
+and result must be picklable: pass PEM strings and bytes, not key objects.
+Work that has to return a key object goes through run_threaded(), which
+always uses threads.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+class CryptoExecutorBusy(Exception):
+    """Raised when the executor's queue is full"""
+
+class CryptoExecutor:
+    def __init__(self, kind: str = "thread", max_workers: Optional[int] = None, max_queue: int = 64):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown crypto executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 2
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._thread_executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _get_executor(self, threaded: bool = False) -> Executor:
+        with self._lock:
+            if threaded and self.kind == "process":
+                if self._thread_executor is None:
+                    self._thread_executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="crypto")
+                return self._thread_executor
+            if self._executor is None:
+                if self.kind == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="crypto")
+            return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) in the pool and await its result"""
+        return await self._submit(self._get_executor(), fn, *args, **kwargs)
+
+    async def run_threaded(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Like run(), but on threads even in process mode, for unpicklable results"""
+        return await self._submit(self._get_executor(threaded=True), fn, *args, **kwargs)
+
+    async def _submit(self, executor: Executor, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                raise CryptoExecutorBusy("Too many cryptographic operations in progress")
+            self._in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, functools.partial(fn, *args, **kwargs)
+            )
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": self._in_flight
+        }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executors = (self._executor, self._thread_executor)
+            self._executor = self._thread_executor = None
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+crypto_executor = CryptoExecutor(
+    kind=os.getenv("CRYPTO_EXECUTOR", "thread"),
+    max_workers=int(os.getenv("CRYPTO_WORKERS", "0")) or None,
+    max_queue=int(os.getenv("CRYPTO_MAX_QUEUE", "64"))
+)
@@ -7,4 +7,380 @@ This file implements:
 3. Hybrid encryption
 4. Key wrapping
 5. Cryptographic validation
-""" 
\ No newline at end of file
+
+Every ciphertext is a self-describing envelope:
+
+    magic "WC" | version (1 byte) | suite id (1 byte)
+    | key length (2 bytes, big-endian) | wrapped key or ephemeral public key
+    | nonce length (1 byte) | nonce | body
+
+Suites:
+- SUITE_RSA_OAEP_AES_CBC: AES-256-CBC body, key wrapped with RSA-OAEP-SHA256
+- SUITE_X25519_AES_GCM: ephemeral X25519 agreement, HKDF-SHA256, AES-256-GCM,
+  with the envelope header as associated data
+
+Messages written before envelopes existed (iv[0:16] + rsa_key[16:272] + body)
+carry no header and are still opened as the RSA suite.
+
+Large bodies use the streaming suites (SUITE_RSA_STREAM, SUITE_X25519_STREAM):
+the same key wrap, but the body is a sequence of AES-256-GCM segments of
+`segment_size` plaintext bytes, each with its own tag. Segment nonces are
+nonce_prefix (7 bytes) | counter (4 bytes) | final flag (1 byte), so
+segments cannot be reordered, dropped or truncated without detection.
+seal_stream()/open_stream() work on iterators at constant memory.
+
+Multi-recipient messages use SUITE_RSA_MULTI / SUITE_X25519_MULTI: the body
+is encrypted once with AES-256-GCM under a random content key and stored
+once. Each recipient gets its own header whose key field wraps that content
+key (RSA-OAEP, or an ephemeral X25519 public key followed by the content key
+sealed under the HKDF-derived key); every header carries the same body
+nonce. A recipient's ciphertext is its header followed by the shared body.
+"""
+
+import os
+import struct
+from typing import Iterable, Iterator, List, Sequence, Tuple
+from cryptography.hazmat.primitives import hashes, padding, serialization
+from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = b"WC"
+ENVELOPE_VERSION = 1
+SUITE_RSA_OAEP_AES_CBC = 1
+SUITE_X25519_AES_GCM = 2
+SUITE_RSA_STREAM = 3
+SUITE_X25519_STREAM = 4
+SUITE_RSA_MULTI = 5
+SUITE_X25519_MULTI = 6
+SUITES = (
+    SUITE_RSA_OAEP_AES_CBC,
+    SUITE_X25519_AES_GCM,
+    SUITE_RSA_STREAM,
+    SUITE_X25519_STREAM,
+    SUITE_RSA_MULTI,
+    SUITE_X25519_MULTI,
+)
+
+STREAM_SEGMENT_SIZE = 64 * 1024
+# Upper bound on the segment size a streamed header may declare
+STREAM_MAX_SEGMENT_SIZE = 1024 * 1024
+STREAM_NONCE_PREFIX_SIZE = 7
+GCM_TAG_SIZE = 16
+# The shared body cannot bind a per-recipient header, so it binds this instead
+MULTI_ASSOCIATED_DATA = MAGIC + b" multi-recipient"
+# Each X25519 wrap uses a fresh key, so a fixed nonce is never reused
+_MULTI_WRAP_NONCE = bytes(12)
+
+LEGACY_IV_SIZE = 16
+LEGACY_WRAPPED_KEY_SIZE = 256  # RSA-2048
+
+_OAEP = asym_padding.OAEP(
+    mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+class EnvelopeError(ValueError):
+    """Raised for malformed envelopes or a key that does not match the suite"""
+
+class Envelope:
+    def __init__(self, suite: int, key: bytes, nonce: bytes, body: bytes, version: int = ENVELOPE_VERSION):
+        self.version = version
+        self.suite = suite
+        self.key = key
+        self.nonce = nonce
+        self.body = body
+
+    def header(self) -> bytes:
+        return (
+            MAGIC
+            + struct.pack(">BBH", self.version, self.suite, len(self.key)) + self.key
+            + struct.pack(">B", len(self.nonce)) + self.nonce
+        )
+
+    def to_bytes(self) -> bytes:
+        return self.header() + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Envelope":
+        if data[:2] != MAGIC or len(data) < 7:
+            raise EnvelopeError("Not an envelope")
+        version, suite, key_length = struct.unpack(">BBH", data[2:6])
+        if version != ENVELOPE_VERSION:
+            raise EnvelopeError(f"Unsupported envelope version: {version}")
+        offset = 6 + key_length
+        if len(data) < offset + 1:
+            raise EnvelopeError("Truncated envelope")
+        key = data[6:offset]
+        nonce_length = data[offset]
+        nonce = data[offset + 1:offset + 1 + nonce_length]
+        if len(nonce) != nonce_length:
+            raise EnvelopeError("Truncated envelope")
+        return cls(suite, key, nonce, data[offset + 1 + nonce_length:], version)
+
+    @classmethod
+    def from_legacy(cls, data: bytes) -> "Envelope":
+        """Describe a pre-envelope RSA ciphertext in envelope terms"""
+        key_end = LEGACY_IV_SIZE + LEGACY_WRAPPED_KEY_SIZE
+        return cls(SUITE_RSA_OAEP_AES_CBC, data[LEGACY_IV_SIZE:key_end], data[:LEGACY_IV_SIZE], data[key_end:], version=0)
+
+def parse_envelope(data: bytes) -> Envelope:
+    """Parse a ciphertext, treating anything without a valid header as legacy RSA"""
+    if data[:2] == MAGIC:
+        try:
+            envelope = Envelope.from_bytes(data)
+            if envelope.suite in SUITES:
+                return envelope
+        except EnvelopeError:
+            pass
+        # A legacy IV can start with the magic bytes by chance
+    return Envelope.from_legacy(data)
+
+def _x25519_key(shared_secret: bytes, ephemeral_public: bytes, recipient_public: bytes) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"whisperchain x25519-aes-gcm" + ephemeral_public + recipient_public
+    ).derive(shared_secret)
+
+def _raw_public(public_key: X25519PublicKey) -> bytes:
+    return public_key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+def seal(plaintext: bytes, public_key) -> bytes:
+    """Encrypt for a recipient; the suite follows from the key type"""
+    if isinstance(public_key, X25519PublicKey):
+        ephemeral = X25519PrivateKey.generate()
+        ephemeral_public = _raw_public(ephemeral.public_key())
+        key = _x25519_key(ephemeral.exchange(public_key), ephemeral_public, _raw_public(public_key))
+        envelope = Envelope(SUITE_X25519_AES_GCM, ephemeral_public, os.urandom(12), b"")
+        envelope.body = AESGCM(key).encrypt(envelope.nonce, plaintext, envelope.header())
+        return envelope.to_bytes()
+
+    if isinstance(public_key, RSAPublicKey):
+        aes_key = os.urandom(32)
+        iv = os.urandom(16)
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        encryptor = Cipher(algorithms.AES(aes_key), modes.CBC(iv)).encryptor()
+        body = encryptor.update(padder.update(plaintext) + padder.finalize()) + encryptor.finalize()
+        return Envelope(SUITE_RSA_OAEP_AES_CBC, public_key.encrypt(aes_key, _OAEP), iv, body).to_bytes()
+
+    raise EnvelopeError(f"Unsupported public key type: {type(public_key).__name__}")
+
+def open_envelope(data: bytes, private_key) -> bytes:
+    """Decrypt an envelope (or legacy RSA ciphertext) with the recipient's private key"""
+    envelope = parse_envelope(data)
+    try:
+        return _open(envelope, private_key)
+    except Exception:
+        if envelope.version == 0 or not isinstance(private_key, RSAPrivateKey):
+            raise
+        # Possibly a legacy ciphertext whose IV happens to parse as a header
+        return _open(Envelope.from_legacy(data), private_key)
+
+def _open(envelope: Envelope, private_key) -> bytes:
+    if envelope.suite in (SUITE_RSA_STREAM, SUITE_X25519_STREAM):
+        return b"".join(open_stream([envelope.header(), envelope.body], private_key))
+
+    if envelope.suite in (SUITE_RSA_MULTI, SUITE_X25519_MULTI):
+        content_key = _unwrap_content_key(envelope, private_key)
+        return AESGCM(content_key).decrypt(envelope.nonce, envelope.body, MULTI_ASSOCIATED_DATA)
+
+    if envelope.suite == SUITE_X25519_AES_GCM:
+        if not isinstance(private_key, X25519PrivateKey):
+            raise EnvelopeError("Message was encrypted for an X25519 key")
+        ephemeral_public = X25519PublicKey.from_public_bytes(envelope.key)
+        key = _x25519_key(
+            private_key.exchange(ephemeral_public),
+            envelope.key,
+            _raw_public(private_key.public_key())
+        )
+        return AESGCM(key).decrypt(envelope.nonce, envelope.body, envelope.header())
+
+    if not isinstance(private_key, RSAPrivateKey):
+        raise EnvelopeError("Message was encrypted for an RSA key")
+    aes_key = private_key.decrypt(envelope.key, _OAEP)
+    decryptor = Cipher(algorithms.AES(aes_key), modes.CBC(envelope.nonce)).decryptor()
+    padded = decryptor.update(envelope.body) + decryptor.finalize()
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    return unpadder.update(padded) + unpadder.finalize()
+
+def envelope_suite(data: bytes) -> int:
+    """Suite id of a ciphertext; legacy ciphertexts report the RSA suite"""
+    return parse_envelope(data).suite
+
+def _wrap_key(public_key) -> Tuple[bytes, bytes]:
+    """Return (content key, key field) for a recipient's public key"""
+    if isinstance(public_key, X25519PublicKey):
+        ephemeral = X25519PrivateKey.generate()
+        ephemeral_public = _raw_public(ephemeral.public_key())
+        return _x25519_key(ephemeral.exchange(public_key), ephemeral_public, _raw_public(public_key)), ephemeral_public
+    if isinstance(public_key, RSAPublicKey):
+        content_key = os.urandom(32)
+        return content_key, public_key.encrypt(content_key, _OAEP)
+    raise EnvelopeError(f"Unsupported public key type: {type(public_key).__name__}")
+
+def _unwrap_key(envelope: Envelope, private_key) -> bytes:
+    if envelope.suite == SUITE_X25519_STREAM:
+        if not isinstance(private_key, X25519PrivateKey):
+            raise EnvelopeError("Message was encrypted for an X25519 key")
+        ephemeral_public = X25519PublicKey.from_public_bytes(envelope.key)
+        return _x25519_key(private_key.exchange(ephemeral_public), envelope.key, _raw_public(private_key.public_key()))
+    if not isinstance(private_key, RSAPrivateKey):
+        raise EnvelopeError("Message was encrypted for an RSA key")
+    return private_key.decrypt(envelope.key, _OAEP)
+
+def _wrap_content_key(content_key: bytes, public_key) -> Tuple[int, bytes]:
+    """Return (suite, key field) carrying an existing content key to one recipient"""
+    if isinstance(public_key, X25519PublicKey):
+        ephemeral = X25519PrivateKey.generate()
+        ephemeral_public = _raw_public(ephemeral.public_key())
+        key = _x25519_key(ephemeral.exchange(public_key), ephemeral_public, _raw_public(public_key))
+        return SUITE_X25519_MULTI, ephemeral_public + AESGCM(key).encrypt(_MULTI_WRAP_NONCE, content_key, None)
+    if isinstance(public_key, RSAPublicKey):
+        return SUITE_RSA_MULTI, public_key.encrypt(content_key, _OAEP)
+    raise EnvelopeError(f"Unsupported public key type: {type(public_key).__name__}")
+
+def _unwrap_content_key(envelope: Envelope, private_key) -> bytes:
+    if envelope.suite == SUITE_X25519_MULTI:
+        if not isinstance(private_key, X25519PrivateKey):
+            raise EnvelopeError("Message was encrypted for an X25519 key")
+        ephemeral_public, wrapped = envelope.key[:32], envelope.key[32:]
+        key = _x25519_key(
+            private_key.exchange(X25519PublicKey.from_public_bytes(ephemeral_public)),
+            ephemeral_public,
+            _raw_public(private_key.public_key())
+        )
+        return AESGCM(key).decrypt(_MULTI_WRAP_NONCE, wrapped, None)
+    if not isinstance(private_key, RSAPrivateKey):
+        raise EnvelopeError("Message was encrypted for an RSA key")
+    return private_key.decrypt(envelope.key, _OAEP)
+
+def seal_multi(plaintext: bytes, public_keys: Sequence) -> Tuple[bytes, List[bytes]]:
+    """
+    Encrypt once for many recipients.
+    Returns (shared body, one header per public key, in order); recipient
+    i opens headers[i] + body with open_envelope().
+    """
+    content_key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(12)
+    body = AESGCM(content_key).encrypt(nonce, plaintext, MULTI_ASSOCIATED_DATA)
+    headers = []
+    for public_key in public_keys:
+        suite, key_field = _wrap_content_key(content_key, public_key)
+        headers.append(Envelope(suite, key_field, nonce, b"").header())
+    return body, headers
+
+def _segment_nonce(prefix: bytes, counter: int, final: bool) -> bytes:
+    if counter >= 2 ** 32:
+        raise EnvelopeError("Stream has too many segments")
+    return prefix + struct.pack(">IB", counter, 1 if final else 0)
+
+def encrypt_segments(
+    chunks: Iterable[bytes],
+    key: bytes,
+    nonce_prefix: bytes,
+    associated_data: bytes,
+    segment_size: int = STREAM_SEGMENT_SIZE
+) -> Iterator[bytes]:
+    """
+    Re-chunk plaintext into segments and yield each sealed segment.
+    A full segment is only sealed once more input arrives, so the last
+    one can be marked final.
+    """
+    aead = AESGCM(key)
+    buffer = bytearray()
+    counter = 0
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) > segment_size:
+            yield aead.encrypt(_segment_nonce(nonce_prefix, counter, False), bytes(buffer[:segment_size]), associated_data)
+            del buffer[:segment_size]
+            counter += 1
+    yield aead.encrypt(_segment_nonce(nonce_prefix, counter, True), bytes(buffer), associated_data)
+
+def decrypt_segments(
+    chunks: Iterable[bytes],
+    key: bytes,
+    nonce_prefix: bytes,
+    associated_data: bytes,
+    segment_size: int = STREAM_SEGMENT_SIZE
+) -> Iterator[bytes]:
+    """
+    Verify and yield plaintext one segment at a time.
+    Raises cryptography.exceptions.InvalidTag on any tampering, reordering
+    or truncation; plaintext already yielded was individually authenticated.
+    """
+    aead = AESGCM(key)
+    sealed_size = segment_size + GCM_TAG_SIZE
+    buffer = bytearray()
+    counter = 0
+    for chunk in chunks:
+        buffer += chunk
+        # Only a segment followed by more data can be a non-final one
+        while len(buffer) > sealed_size:
+            yield aead.decrypt(_segment_nonce(nonce_prefix, counter, False), bytes(buffer[:sealed_size]), associated_data)
+            del buffer[:sealed_size]
+            counter += 1
+    yield aead.decrypt(_segment_nonce(nonce_prefix, counter, True), bytes(buffer), associated_data)
+
+def seal_stream(chunks: Iterable[bytes], public_key, segment_size: int = STREAM_SEGMENT_SIZE) -> Iterator[bytes]:
+    """Encrypt an iterable of plaintext chunks; yields the header, then sealed segments"""
+    if not 0 < segment_size <= STREAM_MAX_SEGMENT_SIZE:
+        raise ValueError(f"segment_size must be between 1 and {STREAM_MAX_SEGMENT_SIZE}")
+    content_key, key_field = _wrap_key(public_key)
+    suite = SUITE_X25519_STREAM if isinstance(public_key, X25519PublicKey) else SUITE_RSA_STREAM
+    nonce_prefix = os.urandom(STREAM_NONCE_PREFIX_SIZE)
+    # The segment size travels in the nonce field after the prefix
+    header = Envelope(suite, key_field, nonce_prefix + struct.pack(">I", segment_size), b"").header()
+    yield header
+    yield from encrypt_segments(chunks, content_key, nonce_prefix, header, segment_size)
+
+def _read_exact(chunks: Iterator[bytes], buffer: bytearray, size: int) -> bytes:
+    """Take exactly `size` bytes from buffer, refilling it from chunks"""
+    while len(buffer) < size:
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise EnvelopeError("Truncated envelope")
+        buffer += chunk
+    data = bytes(buffer[:size])
+    del buffer[:size]
+    return data
+
+def open_stream(chunks: Iterable[bytes], private_key) -> Iterator[bytes]:
+    """Decrypt a seal_stream() ciphertext given as an iterable of arbitrary chunks"""
+    chunks = iter(chunks)
+    buffer = bytearray()
+    # Fixed prefix first, so a non-stream envelope fails before any more is read
+    prefix = _read_exact(chunks, buffer, 6)
+    version, suite, key_length = struct.unpack(">BBH", prefix[2:])
+    if (
+        prefix[:2] != MAGIC
+        or version != ENVELOPE_VERSION
+        or suite not in (SUITE_RSA_STREAM, SUITE_X25519_STREAM)
+    ):
+        raise EnvelopeError("Not a streamed envelope")
+    key_field = _read_exact(chunks, buffer, key_length)
+    nonce_length = _read_exact(chunks, buffer, 1)[0]
+    if nonce_length != STREAM_NONCE_PREFIX_SIZE + 4:
+        raise EnvelopeError("Not a streamed envelope")
+    nonce = _read_exact(chunks, buffer, nonce_length)
+    (segment_size,) = struct.unpack(">I", nonce[STREAM_NONCE_PREFIX_SIZE:])
+    # The header is untrusted; a huge segment size would defeat bounded memory
+    if not 0 < segment_size <= STREAM_MAX_SEGMENT_SIZE:
+        raise EnvelopeError(f"Unsupported stream segment size: {segment_size}")
+
+    envelope = Envelope(suite, key_field, nonce, bytes(buffer), version)
+    header = envelope.header()
+    nonce_prefix = nonce[:STREAM_NONCE_PREFIX_SIZE]
+    content_key = _unwrap_key(envelope, private_key)
+
+    def body() -> Iterator[bytes]:
+        yield envelope.body
+        yield from chunks
+
+    yield from decrypt_segments(body(), content_key, nonce_prefix, header, segment_size)
@@ -6,20 +6,95 @@ This module provides:
 2. Key management and storage
 3. Message encryption/decryption utilities
 4. Session key generation and management
+
+Session mode is opt-in. A sender/recipient pair wraps one session key with
+RSA-OAEP once (open_session/accept_session); every later message takes its
+key from a symmetric HKDF-SHA256 ratchet over that session key, so neither
+end performs an RSA operation per message. Each step derives the next chain
+key and a one-time AES-256-GCM message key, and the old chain key is
+overwritten; the session key itself is not retained, and there is no getter
+for it. Sessions expire after `session_ttl` seconds or `max_messages`
+messages, whichever comes first, and at most `max_sessions` are kept, least
+recently used evicted first. Session messages are:
+
+    counter (4 bytes, big-endian) | nonce (12 bytes) | AES-GCM ciphertext
+
+with the session id and counter as associated data.
 """
 
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import os
 import base64
-from typing import Tuple, Dict
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple, Dict, Optional
 import json
+from encryption.crypto_executor import crypto_executor
+from encryption.key_management import public_key_cache
+
+SESSION_TTL_SECONDS = 3600.0
+SESSION_MAX_MESSAGES = 1000
+MAX_SESSIONS = 1024
+MAX_SKIPPED_KEYS = 32  # Message keys kept for out-of-order delivery
+
+_OAEP = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+class SessionExpiredError(KeyError):
+    """No usable session: never opened, evicted, expired or out of messages"""
+
+def _ratchet_step(chain_key: bytes, counter: int) -> Tuple[bytes, bytes]:
+    """Return (next chain key, message key) for one step of the ratchet"""
+    output = HKDF(
+        algorithm=hashes.SHA256(),
+        length=64,
+        salt=None,
+        info=b"whisperchain session ratchet" + struct.pack(">I", counter)
+    ).derive(chain_key)
+    return output[:32], output[32:]
+
+class RatchetSession:
+    """
+    One end of a session: the current chain key and how far it has advanced.
+    The session key only seeds the chain; no earlier chain key is kept, so
+    the session's state cannot rederive keys of messages already sent.
+    """
+
+    def __init__(self, session_key: bytes):
+        self.chain_key = session_key
+        self.counter = 0
+        self.created_at = time.monotonic()
+        self.skipped: "OrderedDict[int, bytes]" = OrderedDict()
+
+    def advance(self) -> bytes:
+        """Step the ratchet; returns the message key for the current counter"""
+        self.chain_key, message_key = _ratchet_step(self.chain_key, self.counter)
+        self.counter += 1
+        return message_key
 
 class E2EEncryption:
-    def __init__(self):
-        self.session_keys: Dict[str, bytes] = {}  # Store session keys for active sessions
+    def __init__(
+        self,
+        session_ttl: float = SESSION_TTL_SECONDS,
+        max_messages: int = SESSION_MAX_MESSAGES,
+        max_sessions: int = MAX_SESSIONS
+    ):
+        self.session_ttl = session_ttl
+        self.max_messages = max_messages
+        self.max_sessions = max_sessions
+        # Active sessions by session id, least recently used first
+        self.session_keys: "OrderedDict[str, RatchetSession]" = OrderedDict()
+        self._lock = threading.Lock()
 
     def generate_session_key(self) -> bytes:
         """Generate a random AES session key"""
@@ -34,7 +109,7 @@ class E2EEncryption:
         session_key = self.generate_session_key()
         
         # Load recipient's public key
-        public_key = serialization.load_pem_public_key(recipient_public_key.encode())
+        public_key = public_key_cache.load(recipient_public_key)
         
         # Encrypt the session key with recipient's public key
         encrypted_session_key = public_key.encrypt(
@@ -112,6 +187,14 @@ class E2EEncryption:
         # Unpad the message
         return self._unpad_message(padded_message).decode()
 
+    async def encrypt_message_async(self, message: str, recipient_public_key: str) -> Tuple[str, str]:
+        """encrypt_message() on the crypto executor"""
+        return await crypto_executor.run(self.encrypt_message, message, recipient_public_key)
+
+    async def decrypt_message_async(self, encrypted_message: str, encrypted_session_key: str, private_key_pem: str) -> str:
+        """decrypt_message() on the crypto executor"""
+        return await crypto_executor.run(self.decrypt_message, encrypted_message, encrypted_session_key, private_key_pem)
+
     def _pad_message(self, message: bytes) -> bytes:
         """Pad the message to be a multiple of 16 bytes"""
         padding_length = 16 - (len(message) % 16)
@@ -124,14 +207,110 @@ class E2EEncryption:
         return padded_message[:-padding_length]
 
     def store_session_key(self, session_id: str, session_key: bytes):
-        """Store a session key for later use"""
-        self.session_keys[session_id] = session_key
-
-    def get_session_key(self, session_id: str) -> bytes:
-        """Retrieve a stored session key"""
-        return self.session_keys.get(session_id)
+        """Store a session key for later use, starting a fresh ratchet from it"""
+        with self._lock:
+            self.session_keys[session_id] = RatchetSession(session_key)
+            self.session_keys.move_to_end(session_id)
+            while len(self.session_keys) > self.max_sessions:
+                self.session_keys.popitem(last=False)
 
     def clear_session_key(self, session_id: str):
         """Remove a stored session key"""
-        if session_id in self.session_keys:
-            del self.session_keys[session_id] 
\ No newline at end of file
+        with self._lock:
+            self.session_keys.pop(session_id, None)
+
+    def _live_session(self, session_id: str) -> Optional[RatchetSession]:
+        """The session if it is still within its lifetime and message budget; call with the lock held"""
+        session = self.session_keys.get(session_id)
+        if session is None:
+            return None
+        if (
+            time.monotonic() - session.created_at >= self.session_ttl
+            or session.counter >= self.max_messages
+        ):
+            del self.session_keys[session_id]
+            return None
+        self.session_keys.move_to_end(session_id)
+        return session
+
+    def open_session(self, session_id: str, recipient_public_key: str) -> str:
+        """
+        Start a session as the sender.
+        Returns the RSA-wrapped session key (base64) to deliver to the
+        recipient once, for accept_session().
+        """
+        session_key = self.generate_session_key()
+        public_key = public_key_cache.load(recipient_public_key)
+        encrypted_session_key = public_key.encrypt(session_key, _OAEP)
+        self.store_session_key(session_id, session_key)
+        return base64.b64encode(encrypted_session_key).decode()
+
+    def accept_session(self, session_id: str, encrypted_session_key: str, private_key_pem: str):
+        """Start a session as the recipient from the sender's wrapped session key"""
+        private_key = serialization.load_pem_private_key(
+            private_key_pem.encode(),
+            password=None
+        )
+        session_key = private_key.decrypt(base64.b64decode(encrypted_session_key), _OAEP)
+        self.store_session_key(session_id, session_key)
+
+    def has_session(self, session_id: str) -> bool:
+        """Whether encrypt_session_message() can be used without reopening"""
+        with self._lock:
+            return self._live_session(session_id) is not None
+
+    def encrypt_session_message(self, session_id: str, message: str) -> str:
+        """
+        Encrypt with the next key of the session's ratchet; no RSA operation.
+        Raises SessionExpiredError when the session has to be reopened.
+        """
+        with self._lock:
+            session = self._live_session(session_id)
+            if session is None:
+                raise SessionExpiredError(session_id)
+            counter = session.counter
+            message_key = session.advance()
+        header = struct.pack(">I", counter)
+        nonce = os.urandom(12)
+        ciphertext = AESGCM(message_key).encrypt(nonce, message.encode(), session_id.encode() + header)
+        return base64.b64encode(header + nonce + ciphertext).decode()
+
+    def decrypt_session_message(self, session_id: str, encrypted_message: str) -> str:
+        """
+        Decrypt a session message, advancing the ratchet as far as needed.
+        Keys of skipped messages are kept (up to MAX_SKIPPED_KEYS) so
+        out-of-order messages still decrypt; each key works only once. The
+        session only moves forward once the message authenticates.
+        """
+        data = base64.b64decode(encrypted_message)
+        header, nonce, ciphertext = data[:4], data[4:16], data[16:]
+        (counter,) = struct.unpack(">I", header)
+        associated_data = session_id.encode() + header
+        with self._lock:
+            session = self._live_session(session_id)
+            if session is None:
+                raise SessionExpiredError(session_id)
+            if counter < session.counter:
+                message_key = session.skipped.get(counter)
+                if message_key is None:
+                    raise ValueError("Session message key already used or discarded")
+                plaintext = AESGCM(message_key).decrypt(nonce, ciphertext, associated_data)
+                del session.skipped[counter]
+                return plaintext.decode()
+            
+            if counter >= self.max_messages:
+                raise SessionExpiredError(session_id)
+            if counter - session.counter > MAX_SKIPPED_KEYS:
+                raise ValueError("Session message is too far ahead")
+            chain_key, skipped = session.chain_key, []
+            for step in range(session.counter, counter + 1):
+                chain_key, message_key = _ratchet_step(chain_key, step)
+                skipped.append((step, message_key))
+            plaintext = AESGCM(message_key).decrypt(nonce, ciphertext, associated_data)
+            
+            session.chain_key, session.counter = chain_key, counter + 1
+            for step, key in skipped[:-1]:
+                session.skipped[step] = key
+            while len(session.skipped) > MAX_SKIPPED_KEYS:
+                session.skipped.popitem(last=False)
+        return plaintext.decode() 
\ No newline at end of file
@@ -6,22 +6,239 @@ Handles RSA key pair generation, encryption, and storage.
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, x25519
 from cryptography.hazmat.primitives import serialization
 import base64
+import hashlib
+import hmac
 import os
+import threading
+import time
+from collections import OrderedDict
 from typing import Tuple, Optional, Dict
-import json
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.models import User
+from encryption.crypto_executor import CryptoExecutorBusy, crypto_executor
+from encryption.keystore import KeyStore, keystore as default_keystore
+
+PBKDF2_ITERATIONS = 100000
+
+def derive_password_key(password: str, salt: bytes) -> bytes:
+    """Derive the Fernet key protecting a private key (PBKDF2-SHA256)"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=PBKDF2_ITERATIONS,
+    )
+    return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+
+def public_key_fingerprint(public_key_pem: str) -> str:
+    """SHA-256 fingerprint of a PEM public key, insensitive to surrounding whitespace"""
+    return hashlib.sha256(public_key_pem.strip().encode('utf-8')).hexdigest()
+
+class PublicKeyCache:
+    """
+    LRU cache of parsed public key objects keyed by SHA-256 fingerprint.
+
+    Saves the ASN.1 parse on every encryption to a known key. A second map
+    remembers which fingerprint each user id currently has, so server-side
+    paths can skip re-reading users.public_key too. Both are bounded by
+    `max_size` and `ttl_seconds`; a user's entry is dropped as soon as
+    User.public_key is assigned.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 3600.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._keys: "OrderedDict[str, Tuple[object, float]]" = OrderedDict()
+        self._users: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, entries: OrderedDict, key):
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return value
+
+    def _put(self, entries: OrderedDict, key, value) -> None:
+        entries[key] = (value, time.monotonic() + self.ttl_seconds)
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def load(self, public_key_pem: str):
+        """Return the parsed key for a PEM, parsing it only on a miss"""
+        fingerprint = public_key_fingerprint(public_key_pem)
+        with self._lock:
+            public_key = self._get(self._keys, fingerprint)
+            if public_key is not None:
+                self.hits += 1
+                return public_key
+            self.misses += 1
+        public_key = serialization.load_pem_public_key(public_key_pem.encode('utf-8'))
+        with self._lock:
+            self._put(self._keys, fingerprint, public_key)
+        return public_key
+
+    async def for_user(self, db: AsyncSession, user_id: int):
+        """Parsed public key of a user, or None if the user does not exist"""
+        with self._lock:
+            fingerprint = self._get(self._users, user_id)
+            public_key = self._get(self._keys, fingerprint) if fingerprint else None
+            if public_key is not None:
+                self.hits += 1
+                return public_key
+        public_key_pem = (await db.execute(select(User.public_key).where(User.id == user_id))).scalar()
+        if public_key_pem is None:
+            return None
+        public_key = self.load(public_key_pem)
+        with self._lock:
+            self._put(self._users, user_id, public_key_fingerprint(public_key_pem))
+        return public_key
+
+    def prime(self, user_id: int, public_key_pem: str) -> None:
+        """Cache a user's key from an already-fetched PEM, e.g. when warming at startup"""
+        self.load(public_key_pem)
+        with self._lock:
+            self._put(self._users, user_id, public_key_fingerprint(public_key_pem))
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+            self._users.clear()
+
+    def stats(self) -> dict:
+        return {"keys": len(self._keys), "users": len(self._users), "hits": self.hits, "misses": self.misses}
+
+public_key_cache = PublicKeyCache()
+
+@event.listens_for(User.public_key, "set")
+def _invalidate_changed_public_key(target, value, oldvalue, initiator):
+    if target.id is not None and value != oldvalue:
+        public_key_cache.invalidate_user(target.id)
+
+class UnlockedKey:
+    """A private key unlocked for one user, plus what is needed to re-check the password"""
+
+    def __init__(self, private_key, check: bytes):
+        self.private_key = private_key
+        self.check = check
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    def wipe(self) -> None:
+        """Drop the references; the parsed key object itself cannot be overwritten"""
+        self.private_key = None
+        self.check = b""
+
+class UnlockedKeyCache:
+    """
+    Per-user cache of unlocked private keys, so a receiver pays PBKDF2 once
+    per session instead of once per decrypt.
+
+    An entry is only returned for the same encrypted key and password it was
+    unlocked with, checked against an HMAC-SHA256 under a random key held
+    only by this cache rather than re-running PBKDF2; without that key the
+    stored check cannot be used to test password guesses. Entries expire `ttl_seconds` after unlocking or `idle_seconds`
+    after last use, at most `max_entries` are kept, and every evicted entry
+    is wiped.
+    """
+
+    def __init__(self, ttl_seconds: float = 900.0, idle_seconds: float = 300.0, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.idle_seconds = idle_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[object, UnlockedKey]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        self._check_key = os.urandom(32)
+        self.hits = 0
+        self.misses = 0
+
+    def _check(self, encrypted_key: str, password: str) -> bytes:
+        return hmac.new(self._check_key, encrypted_key.encode() + b"\0" + password.encode(), hashlib.sha256).digest()
+
+    def _expired(self, entry: UnlockedKey, now: float) -> bool:
+        return now - entry.created_at >= self.ttl_seconds or now - entry.last_used >= self.idle_seconds
+
+    def _drop(self, user_id) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            entry.wipe()
+
+    def _sweep(self, now: float) -> None:
+        """Drop expired entries at most once per idle period; call with the lock held"""
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + min(self.idle_seconds, self.ttl_seconds)
+        for user_id in [user_id for user_id, entry in self._entries.items() if self._expired(entry, now)]:
+            self._drop(user_id)
+
+    def put(self, user_id, private_key, encrypted_key: str = "", password: str = "") -> None:
+        with self._lock:
+            self._sweep(time.monotonic())
+            self._drop(user_id)
+            self._entries[user_id] = UnlockedKey(private_key, self._check(encrypted_key, password))
+            while len(self._entries) > self.max_entries:
+                _, entry = self._entries.popitem(last=False)
+                entry.wipe()
+
+    def get(self, user_id, encrypted_key: Optional[str] = None, password: Optional[str] = None):
+        """
+        The user's unlocked key, or None. With encrypted_key and password,
+        only returns it if they match what it was unlocked with.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            entry = self._entries.get(user_id)
+            if entry is None or self._expired(entry, now):
+                self._drop(user_id)
+                self.misses += 1
+                return None
+            if password is not None and not hmac.compare_digest(entry.check, self._check(encrypted_key or "", password)):
+                self.misses += 1
+                return None
+            entry.last_used = now
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry.private_key
+
+    def clear(self, user_id=None) -> None:
+        """Wipe one user's entry, or every entry"""
+        with self._lock:
+            for key in ([user_id] if user_id is not None else list(self._entries)):
+                self._drop(key)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+unlocked_key_cache = UnlockedKeyCache()
 
 class KeyManager:
-    def __init__(self):
+    def __init__(self, keystore: Optional[KeyStore] = None, unlocked_keys: Optional[UnlockedKeyCache] = None):
         self.key_size = 2048  # RSA key size in bits
-        self._session_key: Optional[bytes] = None
-        self._session_private_key: Optional[bytes] = None
-        self.user_keys_cache: Dict[str, object] = {}  # Cache for user keys
+        self.unlocked_keys = unlocked_keys or unlocked_key_cache  # Shared by every instance
+        self.keystore = keystore or default_keystore  # Indexed store with a bounded LRU
 
-    def generate_key_pair(self):
-        """Generate RSA key pair"""
+    def generate_key_pair(self, key_type: str = "rsa"):
+        """Generate an RSA key pair, or an X25519 one for the elliptic-curve suite"""
+        if key_type == "x25519":
+            private_key = x25519.X25519PrivateKey.generate()
+            return private_key.public_key(), private_key
         private_key = rsa.generate_private_key(
             public_exponent=65537,
             key_size=self.key_size
@@ -33,14 +250,10 @@ class KeyManager:
         """Encrypt private key with password"""
         # Convert password to key using PBKDF2
         salt = os.urandom(16)
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        
+        key = derive_password_key(password, salt)
+        return self._seal_private_key(private_key, key, salt)
+
+    def _seal_private_key(self, private_key, key: bytes, salt: bytes) -> str:
         # Serialize private key
         private_key_pem = private_key.private_bytes(
             encoding=serialization.Encoding.PEM,
@@ -56,34 +269,72 @@ class KeyManager:
         combined = salt + encrypted_key
         return base64.b64encode(combined).decode('utf-8')
 
-    def decrypt_private_key(self, encrypted_key: str, password: str):
-        """Decrypt private key with password"""
+    def decrypt_private_key(self, encrypted_key: str, password: str, user_id=None):
+        """
+        Decrypt private key with password.
+        With a user_id, the unlocked key is cached for the session and later
+        calls with the same key and password skip PBKDF2.
+        """
+        if user_id is not None:
+            private_key = self.unlocked_keys.get(user_id, encrypted_key, password)
+            if private_key is not None:
+                return private_key
         try:
             # Decode combined data
             combined = base64.b64decode(encrypted_key)
             salt = combined[:16]
-            encrypted_key = combined[16:]
             
             # Derive key from password
-            kdf = PBKDF2HMAC(
-                algorithm=hashes.SHA256(),
-                length=32,
-                salt=salt,
-                iterations=100000,
-            )
-            key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-            
-            # Decrypt with Fernet
-            f = Fernet(key)
-            private_key_pem = f.decrypt(encrypted_key)
-            
-            # Load private key
-            return serialization.load_pem_private_key(
-                private_key_pem,
-                password=None
-            )
+            key = derive_password_key(password, salt)
+            private_key = self._open_private_key(combined[16:], key)
+        except Exception as e:
+            raise Exception(f"Failed to decrypt private key: {str(e)}")
+        if user_id is not None:
+            self.set_session_key(user_id, private_key, encrypted_key, password)
+        return private_key
+
+    def _open_private_key(self, encrypted_key: bytes, key: bytes):
+        # Decrypt with Fernet
+        f = Fernet(key)
+        private_key_pem = f.decrypt(encrypted_key)
+        
+        # Load private key
+        return serialization.load_pem_private_key(
+            private_key_pem,
+            password=None
+        )
+
+    async def encrypt_private_key_async(self, private_key, password: str) -> str:
+        """encrypt_private_key() with the PBKDF2 derivation on the crypto executor"""
+        salt = os.urandom(16)
+        key = await crypto_executor.run(derive_password_key, password, salt)
+        return self._seal_private_key(private_key, key, salt)
+
+    async def decrypt_private_key_async(self, encrypted_key: str, password: str, user_id=None):
+        """decrypt_private_key() with the PBKDF2 derivation and PEM parsing on the crypto executor"""
+        if user_id is not None:
+            private_key = self.unlocked_keys.get(user_id, encrypted_key, password)
+            if private_key is not None:
+                return private_key
+        try:
+            combined = base64.b64decode(encrypted_key)
+            salt = combined[:16]
+            key = await crypto_executor.run(derive_password_key, password, salt)
+            private_key = await crypto_executor.run_threaded(self._open_private_key, combined[16:], key)
+        except CryptoExecutorBusy:
+            raise
         except Exception as e:
             raise Exception(f"Failed to decrypt private key: {str(e)}")
+        if user_id is not None:
+            self.set_session_key(user_id, private_key, encrypted_key, password)
+        return private_key
+
+    async def verify_key_password_async(self, encrypted_private_key: str, password: str, user_id=None) -> bool:
+        try:
+            await self.decrypt_private_key_async(encrypted_private_key, password, user_id)
+            return True
+        except Exception:
+            return False
 
     def get_public_key_pem(self, public_key) -> str:
         """Convert public key to PEM format with proper headers"""
@@ -106,9 +357,9 @@ class KeyManager:
             print(f"Error formatting public key: {str(e)}")
             raise Exception(f"Failed to format public key: {str(e)}")
 
-    def generate_and_encrypt_key_pair(self, password: str) -> dict:
+    def generate_and_encrypt_key_pair(self, password: str, key_type: str = "rsa") -> dict:
         """Generate key pair and encrypt the private key with password"""
-        public_key, private_key = self.generate_key_pair()
+        public_key, private_key = self.generate_key_pair(key_type)
         encrypted_private_key = self.encrypt_private_key(private_key, password)
         public_key_pem = self.get_public_key_pem(public_key)
         
@@ -120,18 +371,7 @@ class KeyManager:
     def store_user_key(self, user_id: str, encrypted_private_key: str, public_key: str) -> bool:
         """Store encrypted private key and public key for a user"""
         try:
-            key_data = {
-                "encrypted_private_key": encrypted_private_key,
-                "public_key": public_key
-            }
-            
-            # Store key data in a file named after the user ID
-            key_file_path = f"user_keys/{user_id}.json"
-            os.makedirs(os.path.dirname(key_file_path), exist_ok=True)
-            
-            with open(key_file_path, 'w') as f:
-                json.dump(key_data, f)
-                
+            self.keystore.put(user_id, encrypted_private_key, public_key)
             return True
         except Exception as e:
             print(f"Error storing user key: {str(e)}")
@@ -140,41 +380,27 @@ class KeyManager:
     def get_user_key(self, user_id: str) -> Optional[dict]:
         """Get encrypted private key and public key for a user"""
         try:
-            # First check if key is in cache
-            if user_id in self.user_keys_cache:
-                return self.user_keys_cache[user_id]
-            
-            # If not in cache, read from file
-            key_file_path = f"user_keys/{user_id}.json"
-            if not os.path.exists(key_file_path):
-                return None
-                
-            with open(key_file_path, 'r') as f:
-                key_data = json.load(f)
-                
-            # Store in cache for future use
-            self.user_keys_cache[user_id] = key_data
-            return key_data
+            return self.keystore.get(user_id)
         except Exception as e:
             print(f"Error getting user key: {str(e)}")
             return None
     
-    def verify_key_password(self, encrypted_private_key: str, password: str) -> bool:
+    def verify_key_password(self, encrypted_private_key: str, password: str, user_id=None) -> bool:
         """Verify if the password can decrypt the private key"""
         try:
-            self.decrypt_private_key(encrypted_private_key, password)
+            self.decrypt_private_key(encrypted_private_key, password, user_id)
             return True
         except Exception:
             return False
     
-    def set_session_key(self, private_key: bytes):
-        """Store private key in memory for session duration"""
-        self._session_private_key = private_key
+    def set_session_key(self, user_id, private_key, encrypted_key: str = "", password: str = ""):
+        """Store a user's unlocked private key in memory for the session duration"""
+        self.unlocked_keys.put(user_id, private_key, encrypted_key, password)
 
-    def get_session_key(self) -> Optional[bytes]:
-        """Get private key from memory"""
-        return self._session_private_key
+    def get_session_key(self, user_id):
+        """Get a user's unlocked private key from memory, if it has not expired"""
+        return self.unlocked_keys.get(user_id)
 
-    def clear_session_key(self):
-        """Clear private key from memory"""
-        self._session_private_key = None 
\ No newline at end of file
+    def clear_session_key(self, user_id=None):
+        """Wipe a user's unlocked private key from memory (every user's without one)"""
+        self.unlocked_keys.clear(user_id) 
\ No newline at end of file
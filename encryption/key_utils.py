@@ -1,4 +1,7 @@
-from cryptography.hazmat.primitives.asymmetric import rsa
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Optional, Tuple
+from cryptography.hazmat.primitives.asymmetric import rsa, x25519
 from cryptography.hazmat.primitives import serialization
 
 def generate_rsa_key_pair():
@@ -16,4 +19,113 @@ def generate_rsa_key_pair():
         format=serialization.PrivateFormat.PKCS8,
         encryption_algorithm=serialization.NoEncryption()
     ).decode()
-    return public_pem, private_pem 
\ No newline at end of file
+    return public_pem, private_pem
+
+def generate_x25519_key_pair():
+    """X25519 key pair for the elliptic-curve envelope suite; microseconds to generate"""
+    private_key = x25519.X25519PrivateKey.generate()
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    ).decode()
+    return public_pem, private_pem
+
+class KeyPairPool:
+    """
+    Bounded pool of pre-generated RSA key pairs for registration.
+
+    A background task keeps `target_depth` fresh pairs queued, generating
+    them in a process pool so keygen never runs on the event loop.
+    get() pops a ready pair, or generates one in the executor when the
+    pool has run dry (e.g. during an onboarding burst or before start()).
+    Pairs are handed out exactly once and never persisted.
+    """
+
+    def __init__(self, target_depth: int = 32, workers: int = 2, executor: Optional[Executor] = None):
+        self.target_depth = target_depth
+        self.workers = workers
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._queue: Optional[asyncio.Queue] = None
+        self._low = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "target_depth": self.target_depth,
+            "hits": self.hits,
+            "misses": self.misses,
+            "generated": self.generated
+        }
+
+    async def _generate(self) -> Tuple[str, str]:
+        key_pair = await asyncio.get_running_loop().run_in_executor(self._executor, generate_rsa_key_pair)
+        self.generated += 1
+        return key_pair
+
+    async def get(self) -> Tuple[str, str]:
+        """Return (public_pem, private_pem), from the pool when possible"""
+        if self._queue is not None:
+            try:
+                key_pair = self._queue.get_nowait()
+                self.hits += 1
+                self._low.set()
+                return key_pair
+            except asyncio.QueueEmpty:
+                pass
+        self.misses += 1
+        return await self._generate()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                while self._queue.qsize() < self.target_depth:
+                    batch = min(self.workers, self.target_depth - self._queue.qsize())
+                    for key_pair in await asyncio.gather(*(self._generate() for _ in range(batch))):
+                        try:
+                            self._queue.put_nowait(key_pair)
+                        except asyncio.QueueFull:
+                            break
+                self._low.clear()
+                await self._low.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Key pair pool error: {str(e)}")
+                await asyncio.sleep(1)
+
+    def start(self) -> None:
+        if self._task is None:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._queue = asyncio.Queue(maxsize=self.target_depth)
+            self._low = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._queue = None
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+key_pair_pool = KeyPairPool()
@@ -0,0 +1,168 @@
+"""
+User keystore for WhisperChain+.
+
+Stores every user's encrypted private key and public key in one indexed
+SQLite table instead of one JSON file per user. Reads go through a bounded
+LRU; writes are single transactions, so a crash never leaves a partial key.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional, Tuple
+
+KEYSTORE_PATH = os.getenv("KEYSTORE_PATH", "./user_keys.db")
+LEGACY_KEY_DIR = "user_keys"
+
+class KeyStore:
+    """
+    SQLite-backed store of {"encrypted_private_key", "public_key"} per user id.
+
+    The connection is opened on first use and shared behind a lock. Lookups
+    hit the primary key index; the `cache_size` most recently used entries
+    are served from memory.
+    """
+
+    def __init__(self, path: str = KEYSTORE_PATH, cache_size: int = 1024):
+        self.path = path
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """Open the database on first use; call with the lock held"""
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_keys ("
+                "  user_id TEXT PRIMARY KEY,"
+                "  encrypted_private_key TEXT NOT NULL,"
+                "  public_key TEXT NOT NULL,"
+                "  updated_at REAL NOT NULL"
+                ")"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, user_id: str, key_data: Optional[dict]) -> None:
+        self._cache[user_id] = key_data
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def put(self, user_id, encrypted_private_key: str, public_key: str) -> None:
+        """Insert or replace a user's keys in one transaction"""
+        user_id = str(user_id)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO user_keys VALUES (?, ?, ?, ?)",
+                    (user_id, encrypted_private_key, public_key, time.time())
+                )
+            self._remember(user_id, {"encrypted_private_key": encrypted_private_key, "public_key": public_key})
+
+    def get(self, user_id) -> Optional[dict]:
+        """A user's keys, or None if none are stored"""
+        user_id = str(user_id)
+        with self._lock:
+            if user_id in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(user_id)
+                key_data = self._cache[user_id]
+                return dict(key_data) if key_data else None
+            self.misses += 1
+            row = self._connection().execute(
+                "SELECT encrypted_private_key, public_key FROM user_keys WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            key_data = {"encrypted_private_key": row[0], "public_key": row[1]} if row else None
+            self._remember(user_id, key_data)
+            return dict(key_data) if key_data else None
+
+    def delete(self, user_id) -> bool:
+        user_id = str(user_id)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                deleted = conn.execute("DELETE FROM user_keys WHERE user_id = ?", (user_id,)).rowcount
+            self._cache.pop(user_id, None)
+            return deleted == 1
+
+    def import_keys(self, entries: Iterable[Tuple[str, dict]]) -> int:
+        """
+        Bulk insert or replace (user_id, key_data) pairs in one transaction.
+        Either every entry lands or none does. Returns the number imported.
+        """
+        now = time.time()
+        rows = [
+            (str(user_id), key_data["encrypted_private_key"], key_data["public_key"], now)
+            for user_id, key_data in entries
+        ]
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO user_keys VALUES (?, ?, ?, ?)", rows)
+            for user_id, *_ in rows:
+                self._cache.pop(user_id, None)
+        return len(rows)
+
+    def export_keys(self, batch_size: int = 1000) -> Iterator[Tuple[str, dict]]:
+        """Yield every (user_id, key_data) in user id order, `batch_size` rows per read"""
+        last_id = ""
+        while True:
+            with self._lock:
+                rows = self._connection().execute(
+                    "SELECT user_id, encrypted_private_key, public_key FROM user_keys"
+                    " WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+            for user_id, encrypted_private_key, public_key in rows:
+                yield user_id, {"encrypted_private_key": encrypted_private_key, "public_key": public_key}
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def import_legacy_dir(self, directory: str = LEGACY_KEY_DIR) -> int:
+        """Import the per-user JSON files written before the keystore existed"""
+        if not os.path.isdir(directory):
+            return 0
+
+        def entries():
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".json"):
+                    with open(os.path.join(directory, name)) as f:
+                        yield name[:-len(".json")], json.load(f)
+
+        return self.import_keys(entries())
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connection().execute("SELECT count(*) FROM user_keys").fetchone()[0]
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._cache.clear()
+
+keystore = KeyStore()
@@ -1,18 +1,21 @@
 """
 Message encryption utilities for WhisperChain+.
-Handles message encryption and decryption using RSA and AES.
+Handles message encryption and decryption using the envelopes in crypto_utils.
 """
 
-from cryptography.hazmat.primitives import hashes, serialization, padding
-from cryptography.hazmat.primitives.asymmetric import rsa, padding as asym_padding
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives import serialization
+import asyncio
 import base64
-import os
+from typing import Iterable, Iterator, List, Optional, Tuple
+from encryption.crypto_executor import crypto_executor
+from encryption.crypto_utils import open_envelope, open_stream, seal, seal_multi, seal_stream
+from encryption.key_management import public_key_cache
 
 def encrypt_message(message: str, public_key_pem: str) -> str:
     """
     Encrypt a message using the recipient's public key.
-    Uses hybrid encryption (RSA + AES) for better performance.
+    Uses hybrid encryption in a versioned envelope; the suite follows the key
+    type (RSA-OAEP + AES-CBC for RSA keys, X25519 + AES-GCM for X25519 keys).
     
     Args:
         message (str): The message to encrypt
@@ -22,49 +25,50 @@ def encrypt_message(message: str, public_key_pem: str) -> str:
         str: The encrypted message in base64 format
     """
     try:
-        # Load the public key from PEM format
-        public_key = serialization.load_pem_public_key(
-            public_key_pem.encode('utf-8')
-        )
-        
-        # Generate a random AES key
-        aes_key = os.urandom(32)  # 256 bits
-        
-        # Encrypt the message with AES
-        iv = os.urandom(16)  # Initialization vector
-        cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv))
-        encryptor = cipher.encryptor()
-        
-        # Pad the message
-        padder = padding.PKCS7(algorithms.AES.block_size).padder()
-        padded_data = padder.update(message.encode()) + padder.finalize()
-        
-        # Encrypt the padded message
-        encrypted_message = encryptor.update(padded_data) + encryptor.finalize()
-        
-        # Encrypt the AES key with RSA
-        encrypted_key = public_key.encrypt(
-            aes_key,
-            asym_padding.OAEP(
-                mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        # Load the public key, parsed once per distinct key
+        public_key = public_key_cache.load(public_key_pem)
         
-        # Combine IV, encrypted key, and encrypted message
-        combined = iv + encrypted_key + encrypted_message
+        # Encrypt into a self-describing envelope
+        envelope = seal(message.encode(), public_key)
         
         # Convert to base64
-        return base64.b64encode(combined).decode('utf-8')
+        return base64.b64encode(envelope).decode('utf-8')
         
     except Exception as e:
         print(f"Encryption error details: {str(e)}")
         raise Exception(f"Failed to encrypt message: {str(e)}")
 
+def encrypt_message_multi(message: str, public_key_pems: List[str]) -> Tuple[str, List[str]]:
+    """
+    Encrypt a message once for several recipients.
+    Returns (encrypted body, one encrypted key per public key, in order), all
+    base64. The body is stored once; join_envelope(key, body) rebuilds a
+    recipient's ciphertext for decrypt_message().
+    """
+    try:
+        public_keys = [public_key_cache.load(public_key_pem) for public_key_pem in public_key_pems]
+        body, headers = seal_multi(message.encode(), public_keys)
+        return (
+            base64.b64encode(body).decode('utf-8'),
+            [base64.b64encode(header).decode('utf-8') for header in headers]
+        )
+    except Exception as e:
+        print(f"Encryption error details: {str(e)}")
+        raise Exception(f"Failed to encrypt message: {str(e)}")
+
+def join_envelope(encrypted_key: str, encrypted_body: Optional[str]) -> str:
+    """
+    A recipient's full ciphertext from its stored key and the shared body.
+    Single-recipient messages have no separate body and pass through as-is.
+    """
+    if encrypted_body is None:
+        return encrypted_key
+    return base64.b64encode(base64.b64decode(encrypted_key) + base64.b64decode(encrypted_body)).decode('utf-8')
+
 def decrypt_message(encrypted_data: str, private_key) -> str:
     """
     Decrypt a message using the recipient's private key.
+    Reads both envelopes and the original headerless RSA layout.
     
     Args:
         encrypted_data (str): The encrypted message in base64 format
@@ -77,31 +81,108 @@ def decrypt_message(encrypted_data: str, private_key) -> str:
         # Decode the encrypted data
         combined = base64.b64decode(encrypted_data)
         
-        # Extract IV, encrypted key, and encrypted message
-        iv = combined[:16]
-        encrypted_key = combined[16:272]  # RSA-2048 encrypted key size
-        encrypted_message = combined[272:]
-        
-        # Decrypt the AES key
-        aes_key = private_key.decrypt(
-            encrypted_key,
-            asym_padding.OAEP(
-                mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
-        
-        # Decrypt the message
-        cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv))
-        decryptor = cipher.decryptor()
-        
-        # Decrypt and unpad
-        padded_message = decryptor.update(encrypted_message) + decryptor.finalize()
-        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
-        message = unpadder.update(padded_message) + unpadder.finalize()
-        
-        return message.decode('utf-8')
+        # Open the envelope with the suite it names
+        return open_envelope(combined, private_key).decode('utf-8')
     except Exception as e:
         print(f"Decryption error details: {str(e)}")
-        raise Exception(f"Failed to decrypt message: {str(e)}") 
\ No newline at end of file
+        raise Exception(f"Failed to decrypt message: {str(e)}")
+
+def decrypt_message_with_pem(encrypted_data: str, private_key_pem: str) -> str:
+    """
+    Parse a PEM private key and decrypt a message with it.
+    Takes only strings so it can run in a process pool.
+    """
+    private_key = serialization.load_pem_private_key(
+        private_key_pem.encode('utf-8'),
+        password=None
+    )
+    return decrypt_message(encrypted_data, private_key)
+
+def encrypt_message_stream(chunks: Iterable[bytes], public_key_pem: str) -> Iterator[bytes]:
+    """
+    Encrypt a large body chunk by chunk with segmented AES-GCM.
+    Yields ciphertext pieces; memory use is bounded by the segment size.
+    """
+    return seal_stream(chunks, public_key_cache.load(public_key_pem))
+
+def decrypt_message_stream(chunks: Iterable[bytes], private_key) -> Iterator[bytes]:
+    """
+    Decrypt an encrypt_message_stream() ciphertext chunk by chunk.
+    Each yielded piece is authenticated; truncation raises at the end.
+    """
+    return open_stream(chunks, private_key)
+
+async def encrypt_message_async(message: str, public_key_pem: str) -> str:
+    """encrypt_message() on the crypto executor"""
+    return await crypto_executor.run(encrypt_message, message, public_key_pem)
+
+async def decrypt_message_async(encrypted_data: str, private_key_pem: str) -> str:
+    """decrypt_message_with_pem() on the crypto executor"""
+    return await crypto_executor.run(decrypt_message_with_pem, encrypted_data, private_key_pem)
+
+async def decrypt_message_with_key_async(encrypted_data: str, private_key) -> str:
+    """decrypt_message() with an already-loaded key, on the executor's threads"""
+    return await crypto_executor.run_threaded(decrypt_message, encrypted_data, private_key)
+
+def decrypt_messages(encrypted_items: List[str], private_key) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Decrypt several messages with one already-loaded private key.
+    Returns (plaintext, error) per item, in order; one bad item does not fail the rest.
+    """
+    results = []
+    for encrypted_data in encrypted_items:
+        try:
+            results.append((decrypt_message(encrypted_data, private_key), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+def decrypt_messages_with_pem(encrypted_items: List[str], private_key_pem: str) -> List[Tuple[Optional[str], Optional[str]]]:
+    """decrypt_messages() for process pools: parses the key once per call"""
+    private_key = serialization.load_pem_private_key(
+        private_key_pem.encode('utf-8'),
+        password=None
+    )
+    return decrypt_messages(encrypted_items, private_key)
+
+async def _gather_or_cancel(calls) -> list:
+    """gather() that cancels the remaining calls as soon as one fails"""
+    tasks = [asyncio.ensure_future(call) for call in calls]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Queued chunks never start; their executor slots are released
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def decrypt_messages_async(encrypted_items: List[str], private_key_pem: str) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Decrypt a batch in parallel on the crypto executor.
+
+    The items are split into one chunk per worker. With threads the key is
+    parsed once and shared by every chunk; with processes each chunk parses
+    it once, since key objects cannot cross process boundaries.
+    A key that fails to parse raises; per-item failures are returned.
+    If a chunk is rejected with CryptoExecutorBusy, the other chunks are
+    cancelled before it propagates.
+    """
+    if not encrypted_items:
+        return []
+    chunk_count = min(crypto_executor.max_workers, len(encrypted_items))
+    chunk_size = -(-len(encrypted_items) // chunk_count)
+    chunks = [encrypted_items[i:i + chunk_size] for i in range(0, len(encrypted_items), chunk_size)]
+
+    if crypto_executor.kind == "process":
+        batches = await _gather_or_cancel(
+            crypto_executor.run(decrypt_messages_with_pem, chunk, private_key_pem) for chunk in chunks
+        )
+    else:
+        private_key = await crypto_executor.run_threaded(
+            serialization.load_pem_private_key, private_key_pem.encode('utf-8'), None
+        )
+        batches = await _gather_or_cancel(
+            crypto_executor.run_threaded(decrypt_messages, chunk, private_key) for chunk in chunks
+        )
+    return [result for batch in batches for result in batch]
@@ -14,9 +14,25 @@ from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.backends import default_backend
 import base64
 from database.models import TokenMapping, User, MessageToken
-from database.database import SessionLocal
-from typing import Optional, Tuple
-from sqlalchemy.exc import IntegrityError
+from database.db_session import session_scope, insert_ignore
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+# Rounds are fixed two-minute windows numbered from the Unix epoch
+ROUND_DURATION_SECONDS = 120
+
+def current_round_id(now: Optional[float] = None) -> int:
+    """Return the id of the round containing the given Unix time (default: now)"""
+    if now is None:
+        now = time.time()
+    return int(now / ROUND_DURATION_SECONDS)
+
+def round_start_time(round_id: int) -> datetime.datetime:
+    """Return the local start time of a round"""
+    return datetime.datetime.fromtimestamp(round_id * ROUND_DURATION_SECONDS)
 
 class TokenManager:
     def __init__(self, secret_key: str, encryption_key: str):
@@ -56,6 +72,44 @@ class TokenManager:
         # Combine IV and encrypted data and encode as base64
         return base64.b64encode(iv + encrypted_data).decode()
     
+    def generate_token_hashes(self, user_ids: Sequence[int], round_id: int) -> List[str]:
+        """Generate token hashes for many users in the same round"""
+        suffix = str(round_id)
+        sha256 = hashlib.sha256
+        return [sha256(f"{user_id}{suffix}".encode()).hexdigest() for user_id in user_ids]
+    
+    def encrypt_user_ids(self, user_ids: Sequence[int]) -> List[str]:
+        """
+        Encrypt many user ids in one cipher pass.
+        With the fixed zero IV, CBC over a single block is identical to ECB, so
+        every id that pads to one block is encrypted in one ECB call over the
+        concatenated blocks. Longer ids fall back to encrypt_user_id.
+        """
+        block_size = algorithms.AES.block_size // 8
+        single_block = [user_id for user_id in user_ids if len(str(user_id)) < block_size]
+        
+        encrypted: Dict[int, str] = {}
+        if single_block:
+            padded = b"".join(
+                data + bytes([block_size - len(data)]) * (block_size - len(data))
+                for data in (str(user_id).encode() for user_id in single_block)
+            )
+            encryptor = Cipher(
+                algorithms.AES(self.encryption_key),
+                modes.ECB(),
+                backend=self.backend
+            ).encryptor()
+            ciphertext = encryptor.update(padded) + encryptor.finalize()
+            iv = b'\x00' * block_size
+            for i, user_id in enumerate(single_block):
+                block = ciphertext[i * block_size:(i + 1) * block_size]
+                encrypted[user_id] = base64.b64encode(iv + block).decode()
+        
+        return [
+            encrypted[user_id] if user_id in encrypted else self.encrypt_user_id(user_id)
+            for user_id in user_ids
+        ]
+    
     def decrypt_user_id(self, encrypted_id: str) -> int:
         """Decrypt user.id using AES"""
         # Decode from base64
@@ -83,153 +137,166 @@ class TokenManager:
         # Convert back to integer
         return int(data.decode())
     
-    def get_or_create_token(self, user_id: int, round_id: int) -> Tuple[str, bool]:
+    @staticmethod
+    async def _ban_error(db: AsyncSession, user_id: int, principal=None) -> Optional[str]:
+        """
+        Why the user may not send, or None. Uses the caller's already-resolved
+        principal when given instead of loading the User row again.
+        """
+        user = principal if principal is not None and principal.id == user_id else await db.get(User, user_id)
+        if not user:
+            return "User not found"
+        if user.has_active_ban():
+            return f"User is banned until {user.active_ban_until or 'permanently'}"
+        return None
+    
+    async def get_or_create_token(self, user_id: int, round_id: int, db: Optional[AsyncSession] = None, principal=None) -> Tuple[str, bool]:
         """
         Get existing token for user in round or create new one.
         Returns (token_hash, is_new_token)
         """
-        db = SessionLocal()
-        try:
+        async with session_scope(db) as db:
             # Check if user is banned
-            user = db.query(User).filter(User.id == user_id).first()
-            if not user:
-                raise ValueError("User not found")
-            
-            if user.is_banned():
-                active_ban = user.get_active_ban()
-                raise ValueError(f"User is banned until {active_ban.ban_end_time}. Reason: {active_ban.ban_reason}")
+            error = await self._ban_error(db, user_id, principal)
+            if error:
+                raise ValueError(error)
             
             # Try to get existing token for this user and round
-            token = db.query(TokenMapping).filter(
+            token = (await db.execute(select(TokenMapping).where(
                 TokenMapping.user_id == user_id,
                 TokenMapping.round_id == round_id,
                 TokenMapping.is_frozen == False,
                 TokenMapping.expires_at > datetime.datetime.utcnow()
-            ).first()
+            ))).scalars().first()
             
             if token:
                 return token.token_hash, False
             
-            # Create new token if none exists
+            # Create new token if none exists. The insert skips the row instead of
+            # raising when another request won the race, so a shared request
+            # transaction never has to be rolled back here.
             token_hash = self.generate_token_hash(user_id, round_id)
-            encrypted_user_id = self.encrypt_user_id(user_id)
-            expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
-            
-            try:
-                token_mapping = TokenMapping(
-                    token_hash=token_hash,
-                    encrypted_user_id=encrypted_user_id,
-                    round_id=round_id,
-                    expires_at=expires_at,
-                    user_id=user_id
-                )
-                db.add(token_mapping)
-                db.commit()
+            result = await db.execute(insert_ignore(db, TokenMapping.__table__).values(
+                token_hash=token_hash,
+                encrypted_user_id=self.encrypt_user_id(user_id),
+                round_id=round_id,
+                expires_at=datetime.datetime.utcnow() + datetime.timedelta(hours=24),
+                user_id=user_id
+            ))
+            if result.rowcount:
                 return token_hash, True
-            except IntegrityError:
-                # Handle race condition where token was created by another process
-                db.rollback()
-                token = db.query(TokenMapping).filter(
-                    TokenMapping.user_id == user_id,
-                    TokenMapping.round_id == round_id
-                ).first()
-                return token.token_hash, False
-        finally:
-            db.close()
+            
+            # Handle race condition where token was created by another process
+            token = (await db.execute(select(TokenMapping).where(
+                TokenMapping.user_id == user_id,
+                TokenMapping.round_id == round_id
+            ))).scalars().first()
+            return token.token_hash, False
     
-    def validate_token_for_message(self, token_hash: str, user_id: int) -> Tuple[bool, str]:
+    async def validate_token_for_message(self, token_hash: str, user_id: int, db: Optional[AsyncSession] = None, principal=None) -> Tuple[bool, str]:
         """
         Validate a token for sending a message.
         Returns (is_valid, error_message)
         """
-        db = SessionLocal()
-        try:
+        async with session_scope(db) as db:
             # Check if user is banned
-            user = db.query(User).filter(User.id == user_id).first()
-            if not user:
-                return False, "User not found"
-            
-            if user.is_banned():
-                active_ban = user.get_active_ban()
-                return False, f"User is banned until {active_ban.ban_end_time}. Reason: {active_ban.ban_reason}"
+            error = await self._ban_error(db, user_id, principal)
+            if error:
+                return False, error
             
-            token = db.query(TokenMapping).filter(
-                TokenMapping.token_hash == token_hash,
-                TokenMapping.user_id == user_id,
-                TokenMapping.is_frozen == False,
-                TokenMapping.expires_at > datetime.datetime.utcnow()
-            ).first()
+            if await self.consume_token(token_hash, user_id, db=db):
+                return True, ""
             
-            if not token:
-                return False, "Token not found or expired"
+            # Consumption failed; look the token up only to explain why
+            token = (await db.execute(
+                select(TokenMapping).where(
+                    TokenMapping.token_hash == token_hash,
+                    TokenMapping.user_id == user_id,
+                    TokenMapping.is_frozen == False,
+                    TokenMapping.expires_at > datetime.datetime.utcnow()
+                ).execution_options(populate_existing=True)
+            )).scalars().first()
             
-            if token.is_used:
+            if token and token.is_used:
                 return False, "Token has already been used in this round"
             
-            # Update token usage
-            token.is_used = True
-            token.messages_sent += 1
-            token.last_used_at = datetime.datetime.utcnow()
-            db.commit()
-            
-            return True, ""
-        finally:
-            db.close()
+            return False, "Token not found or expired"
+    
+    async def consume_token(self, token_hash: str, user_id: int, db: Optional[AsyncSession] = None) -> bool:
+        """
+        Atomically mark a token as used for sending a message.
+        A single conditional UPDATE checks ownership, usage, freeze state and
+        expiry, so concurrent senders can never both consume the same token.
+        Returns True only for the caller that actually consumed it.
+        """
+        async with session_scope(db) as db:
+            now = datetime.datetime.utcnow()
+            result = await db.execute(
+                update(TokenMapping)
+                .where(
+                    TokenMapping.token_hash == token_hash,
+                    TokenMapping.user_id == user_id,
+                    TokenMapping.is_used == False,
+                    TokenMapping.is_frozen == False,
+                    TokenMapping.expires_at > now
+                )
+                .values(
+                    is_used=True,
+                    messages_sent=TokenMapping.messages_sent + 1,
+                    last_used_at=now
+                )
+                .execution_options(synchronize_session=False)
+            )
+            return result.rowcount == 1
     
-    def record_message_token(self, message_id: int, token_hash: str) -> bool:
+    async def record_message_token(self, message_id: int, token_hash: str, db: Optional[AsyncSession] = None) -> bool:
         """Record the token usage for a specific message"""
-        db = SessionLocal()
-        try:
-            token = db.query(TokenMapping).filter(
-                TokenMapping.token_hash == token_hash
-            ).first()
+        return await self.record_message_tokens([message_id], token_hash, db=db)
+    
+    async def record_message_tokens(self, message_ids: Sequence[int], token_hash: str, db: Optional[AsyncSession] = None) -> bool:
+        """Record one token's usage for several messages with a single token lookup"""
+        async with session_scope(db) as db:
+            token_id = (await db.execute(
+                select(TokenMapping.id).where(TokenMapping.token_hash == token_hash)
+            )).scalar()
             
-            if not token:
+            if token_id is None:
                 return False
             
-            message_token = MessageToken(
-                message_id=message_id,
-                token_mapping_id=token.id
-            )
-            db.add(message_token)
-            db.commit()
+            db.add_all([
+                MessageToken(message_id=message_id, token_mapping_id=token_id)
+                for message_id in message_ids
+            ])
+            await db.flush()
             return True
-        finally:
-            db.close()
     
-    def freeze_token(self, token_hash: str) -> bool:
+    async def freeze_token(self, token_hash: str, db: Optional[AsyncSession] = None) -> bool:
         """Freeze a token (moderator action)"""
-        db = SessionLocal()
-        try:
-            token = db.query(TokenMapping).filter(
-                TokenMapping.token_hash == token_hash
-            ).first()
-            if token:
-                token.is_frozen = True
-                db.commit()
-                return True
-            return False
-        finally:
-            db.close()
+        async with session_scope(db) as db:
+            result = await db.execute(
+                update(TokenMapping)
+                .where(TokenMapping.token_hash == token_hash)
+                .values(is_frozen=True)
+                .execution_options(synchronize_session=False)
+            )
+            return result.rowcount > 0
     
-    def get_user_from_token(self, token_hash: str) -> Optional[User]:
+    async def get_user_from_token(self, token_hash: str, db: Optional[AsyncSession] = None) -> Optional[User]:
         """Get user from token hash (admin only)"""
-        db = SessionLocal()
-        try:
-            token = db.query(TokenMapping).filter(
-                TokenMapping.token_hash == token_hash
-            ).first()
+        async with session_scope(db) as db:
+            token = (await db.execute(
+                select(TokenMapping)
+                .options(selectinload(TokenMapping.user))
+                .where(TokenMapping.token_hash == token_hash)
+            )).scalars().first()
             return token.user if token else None
-        finally:
-            db.close()
     
-    def get_token_stats(self, token_hash: str) -> dict:
+    async def get_token_stats(self, token_hash: str, db: Optional[AsyncSession] = None) -> dict:
         """Get statistics about a token's usage"""
-        db = SessionLocal()
-        try:
-            token = db.query(TokenMapping).filter(
-                TokenMapping.token_hash == token_hash
-            ).first()
+        async with session_scope(db) as db:
+            token = (await db.execute(
+                select(TokenMapping).where(TokenMapping.token_hash == token_hash)
+            )).scalars().first()
             
             if not token:
                 return None
@@ -245,24 +312,19 @@ class TokenManager:
                 "is_frozen": token.is_frozen,
                 "is_used": token.is_used
             }
-        finally:
-            db.close()
     
-    def freeze_user_tokens(self, user_id: int) -> bool:
+    async def freeze_user_tokens(self, user_id: int, db: Optional[AsyncSession] = None) -> bool:
         """Freeze all active tokens for a user"""
-        db = SessionLocal()
-        try:
+        async with session_scope(db) as db:
             # Freeze all active tokens for the user
-            tokens = db.query(TokenMapping).filter(
-                TokenMapping.user_id == user_id,
-                TokenMapping.is_frozen == False,
-                TokenMapping.expires_at > datetime.datetime.utcnow()
-            ).all()
-            
-            for token in tokens:
-                token.is_frozen = True
-            
-            db.commit()
+            await db.execute(
+                update(TokenMapping)
+                .where(
+                    TokenMapping.user_id == user_id,
+                    TokenMapping.is_frozen == False,
+                    TokenMapping.expires_at > datetime.datetime.utcnow()
+                )
+                .values(is_frozen=True)
+                .execution_options(synchronize_session=False)
+            )
             return True
-        finally:
-            db.close() 
\ No newline at end of file
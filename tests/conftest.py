@@ -0,0 +1,75 @@
+"""
+Shared fixtures for the WhisperChain+ test suite.
+
+Points the application at a throwaway SQLite database before any
+application module is imported, and recreates the schema for every test.
+"""
+
+import os
+import sys
+import tempfile
+
+_db_dir = tempfile.mkdtemp(prefix="whisperchain-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ["KEYSTORE_PATH"] = os.path.join(_db_dir, "user_keys.db")
+os.environ["AUDIT_FALLBACK_PATH"] = os.path.join(_db_dir, "audit_fallback.jsonl")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from database.database import Base, SessionLocal, engine
+from database.models import User
+from auth.jwt_auth import create_access_token
+from backend.main import ADMIN_PASSWORD, ADMIN_USERNAME, app
+from backend.services.moderation_service import ban_index
+from backend.services.audit_service import audit_writer
+from encryption.key_management import unlocked_key_cache
+from auth.session_manager import principal_cache
+
+@pytest.fixture
+def db():
+    """Fresh schema and an open session for a single test"""
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    ban_index.clear()
+    unlocked_key_cache.clear()
+    principal_cache.clear()
+    audit_writer.clear()
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+@pytest.fixture
+def client(db):
+    return TestClient(app)
+
+@pytest.fixture
+def make_user(db):
+    """Create an approved user with the given role"""
+    def _make_user(username: str, role: str = "sender", approved: bool = True) -> User:
+        user = User(
+            username=username,
+            password_hash="x",
+            public_key="public-key",
+            role=role,
+            is_approved=approved,
+            status="approved" if approved else "pending"
+        )
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+        return user
+    return _make_user
+
+def auth_headers(user: User) -> dict:
+    """Bearer header for a user, as issued by /login"""
+    token = create_access_token(data={"sub": user.username, "role": user.role})
+    return {"Authorization": f"Bearer {token}"}
+
+def admin_headers(client: TestClient) -> dict:
+    """Bearer header with the token /admin/login issues"""
+    response = client.post("/admin/login", json={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
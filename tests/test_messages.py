@@ -7,4 +7,444 @@ This file contains tests for:
 3. Message flagging
 4. Message retrieval
 5. Message cleanup
-""" 
\ No newline at end of file
+"""
+
+import asyncio
+import base64
+import itertools
+import os
+import struct
+import threading
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives import padding as sym_padding
+from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from sqlalchemy import event
+
+from conftest import auth_headers
+from backend.services.audit_service import audit_writer
+from backend.services.message_service import InboxHub
+from database.database import AsyncSessionLocal, async_engine
+from database.models import AuditLog, Message, MessageBody, MessageToken, TokenMapping
+from encryption.crypto_executor import CryptoExecutor, CryptoExecutorBusy
+from encryption.e2e_encryption import E2EEncryption, SessionExpiredError, _ratchet_step
+from encryption.crypto_utils import (
+    STREAM_SEGMENT_SIZE,
+    SUITE_RSA_MULTI,
+    SUITE_RSA_OAEP_AES_CBC,
+    SUITE_X25519_MULTI,
+    SUITE_X25519_AES_GCM,
+    SUITE_X25519_STREAM,
+    Envelope,
+    EnvelopeError,
+    envelope_suite,
+    open_envelope,
+)
+from encryption.key_utils import generate_rsa_key_pair, generate_x25519_key_pair
+from encryption.key_management import PublicKeyCache, public_key_cache
+from encryption import message_crypto
+from encryption.message_crypto import (
+    decrypt_message_stream,
+    decrypt_message_with_pem,
+    encrypt_message,
+    encrypt_message_multi,
+    encrypt_message_stream,
+    join_envelope,
+)
+
+def test_send_message_commits_once(client, db, make_user):
+    sender = make_user("sender1")
+    receiver = make_user("receiver1", role="receiver")
+
+    commits = []
+    listener = lambda conn: commits.append(conn)
+    event.listen(async_engine.sync_engine, "commit", listener)
+    try:
+        response = client.post(
+            "/messages/send",
+            json={"recipient_id": receiver.id, "encrypted_content": "ciphertext"},
+            headers=auth_headers(sender)
+        )
+    finally:
+        event.remove(async_engine.sync_engine, "commit", listener)
+
+    assert response.status_code == 200
+    assert len(commits) == 1
+
+    body = response.json()
+    message = db.query(Message).filter(Message.id == body["id"]).one()
+    assert message.token_hash == body["token_hash"]
+    assert asyncio.run(audit_writer.flush()) == 1
+    assert db.query(AuditLog).filter(AuditLog.action_type == "message_sent").count() == 1
+    assert db.query(MessageToken).filter(MessageToken.message_id == message.id).count() == 1
+    assert db.query(TokenMapping).filter(TokenMapping.token_hash == body["token_hash"]).one().is_used
+
+def test_inbox_is_one_query_over_messages(client, db, make_user):
+    receiver = make_user("receiver1", role="receiver")
+    senders = [make_user(f"sender{i}") for i in range(3)]
+    db.add_all([
+        Message(sender_id=sender.id, recipient_id=receiver.id, encrypted_content=f"c{n}")
+        for n, sender in enumerate(senders * 2)
+    ])
+    db.commit()
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", listener)
+    try:
+        response = client.get("/messages/inbox", headers=auth_headers(receiver))
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", listener)
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [item["encrypted_content"] for item in body] == [f"c{n}" for n in range(6)]
+    assert [item["sender_name"] for item in body] == [sender.username for sender in senders * 2]
+    assert not any(item["read"] for item in body)
+    assert len([s for s in statements if "messages" in s]) == 1
+
+def test_inbox_changes_returns_only_deltas(client, db, make_user):
+    receiver = make_user("receiver1", role="receiver")
+    for name in ("sender1", "sender2"):
+        response = client.post(
+            "/messages/send",
+            json={"recipient_id": receiver.id, "encrypted_content": name},
+            headers=auth_headers(make_user(name))
+        )
+        assert response.status_code == 200
+
+    headers = auth_headers(receiver)
+    changes = client.get("/messages/inbox/changes", headers=headers).json()
+    assert [(c["encrypted_content"], c["seq"]) for c in changes["changes"]] == [("sender1", 1), ("sender2", 2)]
+    assert changes["since"] == 2
+    assert client.get("/messages/inbox", headers=headers).headers["X-Inbox-Seq"] == "2"
+
+    first_id = changes["changes"][0]["id"]
+    assert client.get(f"/messages/{first_id}/mark-read", headers=headers).status_code == 200
+
+    changes = client.get("/messages/inbox/changes", params={"since": 2}, headers=headers).json()
+    assert [(c["id"], c["read"], c["change_seq"]) for c in changes["changes"]] == [(first_id, True, 3)]
+    assert client.get("/messages/inbox/changes", params={"since": 3}, headers=headers).json()["changes"] == []
+
+def test_stream_pushes_new_messages_to_the_recipient(client, db, make_user):
+    receiver = make_user("receiver1", role="receiver")
+    sender = make_user("sender1")
+    token = auth_headers(receiver)["Authorization"].split()[1]
+
+    with client.websocket_connect(f"/messages/stream?token={token}") as websocket:
+        response = client.post(
+            "/messages/send",
+            json={"recipient_id": receiver.id, "encrypted_content": "ciphertext"},
+            headers=auth_headers(sender)
+        )
+        assert response.status_code == 200
+
+        event = websocket.receive_json()
+        assert event["type"] == "message"
+        assert event["id"] == response.json()["id"]
+        assert event["encrypted_content"] == "ciphertext"
+        assert event["seq"] == 1
+
+def test_inbox_hub_drops_backlog_for_slow_clients():
+    hub = InboxHub(queue_size=2)
+
+    async def scenario():
+        subscription = hub.subscribe(1)
+        for n in range(3):
+            hub.publish(1, {"type": "message", "id": n})
+        events = [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())]
+        hub.unsubscribe(subscription)
+        return events
+
+    assert asyncio.run(scenario()) == [{"type": "resync"}]
+    assert hub.connection_count() == 0
+
+def test_decrypt_runs_on_the_crypto_executor(client, db, make_user):
+    receiver = make_user("receiver1", role="receiver")
+    public_key, private_key = generate_rsa_key_pair()
+    ciphertext = encrypt_message("hello", public_key)
+
+    response = client.post(
+        "/messages/decrypt",
+        json={"encrypted_message": ciphertext, "key_password": "", "private_key": private_key},
+        headers=auth_headers(receiver)
+    )
+    assert response.status_code == 200
+    assert response.json() == {"decrypted_message": "hello"}
+
+def test_crypto_executor_rejects_work_beyond_its_queue():
+    executor = CryptoExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def scenario():
+        running = [asyncio.ensure_future(executor.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        with pytest.raises(CryptoExecutorBusy):
+            await executor.run(len, "x")
+        release.set()
+        await asyncio.gather(*running)
+        return await executor.run(len, "x")
+
+    assert asyncio.run(scenario()) == 1
+    assert executor.in_flight == 0
+    executor.shutdown()
+
+def test_busy_batch_cancels_its_sibling_chunks(monkeypatch):
+    executor = CryptoExecutor(max_workers=2, max_queue=0)
+    release = threading.Event()
+    _, private_key = generate_rsa_key_pair()
+    monkeypatch.setattr(message_crypto, "crypto_executor", executor)
+    monkeypatch.setattr(message_crypto, "decrypt_messages", lambda chunk, key: release.wait())
+
+    async def scenario():
+        holder = asyncio.ensure_future(executor.run(release.wait))
+        await asyncio.sleep(0.05)
+        with pytest.raises(CryptoExecutorBusy):
+            await message_crypto.decrypt_messages_async(["a", "b"], private_key)
+        in_flight = executor.in_flight
+        release.set()
+        await holder
+        return in_flight
+
+    # Only the unrelated holder is still counted; the admitted chunk was cancelled
+    assert asyncio.run(scenario()) == 1
+    executor.shutdown()
+
+def test_decrypt_batch_keeps_order_and_reports_item_errors(client, db, make_user):
+    receiver = make_user("receiver1", role="receiver")
+    other = make_user("receiver2", role="receiver")
+    sender = make_user("sender1")
+    public_key, private_key = generate_rsa_key_pair()
+    messages = [
+        Message(sender_id=sender.id, recipient_id=receiver.id, encrypted_content=encrypt_message("one", public_key)),
+        Message(sender_id=sender.id, recipient_id=receiver.id, encrypted_content="not-ciphertext"),
+        Message(sender_id=sender.id, recipient_id=other.id, encrypted_content=encrypt_message("theirs", public_key)),
+        Message(sender_id=sender.id, recipient_id=receiver.id, encrypted_content=encrypt_message("two", public_key)),
+    ]
+    db.add_all(messages)
+    db.commit()
+    ids = [message.id for message in messages]
+
+    response = client.post(
+        "/messages/decrypt-batch",
+        json={"private_key": private_key, "message_ids": [ids[3], ids[1], ids[2], ids[0]]},
+        headers=auth_headers(receiver)
+    )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["id"] for result in results] == [ids[3], ids[1], ids[2], ids[0]]
+    assert results[0]["decrypted_message"] == "two"
+    assert "error" in results[1]
+    assert results[2]["error"] == "Message not found"
+    assert results[3]["decrypted_message"] == "one"
+
+    response = client.post(
+        "/messages/decrypt-batch",
+        json={"private_key": "not-a-key", "encrypted_messages": ["x"]},
+        headers=auth_headers(receiver)
+    )
+    assert response.status_code == 400
+
+def test_public_key_cache_parses_once_and_follows_key_changes(db, make_user):
+    receiver = make_user("receiver1", role="receiver")
+    first_public, first_private = generate_rsa_key_pair()
+    second_public, _ = generate_rsa_key_pair()
+    receiver.public_key = first_public
+    db.commit()
+    public_key_cache.clear()
+
+    async def key_for_receiver():
+        async with AsyncSessionLocal() as session:
+            return await public_key_cache.for_user(session, receiver.id)
+
+    first = asyncio.run(key_for_receiver())
+    assert asyncio.run(key_for_receiver()) is first
+    assert public_key_cache.load("\n" + first_public + "\n") is first
+    assert decrypt_message_with_pem(encrypt_message("hi", first_public), first_private) == "hi"
+
+    # Assigning a new key drops the user's cached fingerprint
+    receiver.public_key = second_public
+    db.commit()
+    assert asyncio.run(key_for_receiver()) is not first
+
+def test_public_key_cache_is_bounded():
+    cache = PublicKeyCache(max_size=1)
+    first_public, _ = generate_rsa_key_pair()
+    second_public, _ = generate_rsa_key_pair()
+
+    first = cache.load(first_public)
+    assert cache.load(first_public) is first
+    cache.load(second_public)
+    assert cache.load(first_public) is not first
+    assert (cache.hits, cache.misses) == (1, 3)
+
+def _legacy_encrypt(message: str, public_key_pem: str) -> str:
+    """The pre-envelope layout: iv + RSA-wrapped key + AES-CBC body"""
+    public_key = serialization.load_pem_public_key(public_key_pem.encode())
+    aes_key, iv = os.urandom(32), os.urandom(16)
+    padder = sym_padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(aes_key), modes.CBC(iv)).encryptor()
+    body = encryptor.update(padder.update(message.encode()) + padder.finalize()) + encryptor.finalize()
+    wrapped = public_key.encrypt(aes_key, asym_padding.OAEP(
+        mgf=asym_padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None
+    ))
+    return base64.b64encode(iv + wrapped + body).decode()
+
+def test_envelopes_cover_both_suites_and_legacy_ciphertexts():
+    rsa_public, rsa_private = generate_rsa_key_pair()
+    x25519_public, x25519_private = generate_x25519_key_pair()
+
+    rsa_ciphertext = encrypt_message("hello", rsa_public)
+    x25519_ciphertext = encrypt_message("hello", x25519_public)
+    assert envelope_suite(base64.b64decode(rsa_ciphertext)) == SUITE_RSA_OAEP_AES_CBC
+    assert envelope_suite(base64.b64decode(x25519_ciphertext)) == SUITE_X25519_AES_GCM
+    assert len(base64.b64decode(x25519_ciphertext)) < len(base64.b64decode(rsa_ciphertext)) - 200
+
+    assert decrypt_message_with_pem(rsa_ciphertext, rsa_private) == "hello"
+    assert decrypt_message_with_pem(x25519_ciphertext, x25519_private) == "hello"
+    assert decrypt_message_with_pem(_legacy_encrypt("hello", rsa_public), rsa_private) == "hello"
+
+    tampered = bytearray(base64.b64decode(x25519_ciphertext))
+    tampered[-1] ^= 1
+    with pytest.raises(Exception):
+        decrypt_message_with_pem(base64.b64encode(bytes(tampered)).decode(), x25519_private)
+    with pytest.raises(Exception):
+        decrypt_message_with_pem(x25519_ciphertext, rsa_private)
+
+def test_streamed_messages_round_trip_in_segments():
+    x25519_public, x25519_private = generate_x25519_key_pair()
+    private_key = serialization.load_pem_private_key(x25519_private.encode(), password=None)
+    body = os.urandom(200_000)
+    pieces = (body[i:i + 7_000] for i in range(0, len(body), 7_000))
+
+    ciphertext = b"".join(encrypt_message_stream(pieces, x25519_public))
+    assert envelope_suite(ciphertext) == SUITE_X25519_STREAM
+
+    # Feed the ciphertext back in odd-sized chunks
+    chunks = (ciphertext[i:i + 5_000] for i in range(0, len(ciphertext), 5_000))
+    segments = list(decrypt_message_stream(chunks, private_key))
+    assert len(segments) == 4 and max(map(len, segments)) == STREAM_SEGMENT_SIZE
+    assert b"".join(segments) == body
+    assert open_envelope(ciphertext, private_key) == body
+
+    with pytest.raises(InvalidTag):
+        list(decrypt_message_stream([ciphertext[:-STREAM_SEGMENT_SIZE]], private_key))
+
+    # Headers are checked before the body is buffered
+    endless = lambda first: itertools.chain([first], itertools.repeat(b"x" * 4096))
+    with pytest.raises(EnvelopeError):
+        next(decrypt_message_stream(endless(ciphertext[:3] + bytes([SUITE_X25519_AES_GCM]) + ciphertext[4:6]), private_key))
+    header = Envelope.from_bytes(ciphertext)
+    oversized = Envelope(header.suite, header.key, header.nonce[:-4] + struct.pack(">I", 2 ** 32 - 1), b"")
+    with pytest.raises(EnvelopeError):
+        next(decrypt_message_stream(endless(oversized.header()), private_key))
+
+def test_multi_recipient_envelope_encrypts_the_body_once():
+    rsa_public, rsa_private = generate_rsa_key_pair()
+    x25519_public, x25519_private = generate_x25519_key_pair()
+    message = "hello everyone" * 100
+
+    body, keys = encrypt_message_multi(message, [rsa_public, x25519_public])
+    assert len(base64.b64decode(body)) == len(message) + 16
+    assert all(len(base64.b64decode(key)) < 300 for key in keys)
+
+    rsa_ciphertext, x25519_ciphertext = (join_envelope(key, body) for key in keys)
+    assert envelope_suite(base64.b64decode(rsa_ciphertext)) == SUITE_RSA_MULTI
+    assert envelope_suite(base64.b64decode(x25519_ciphertext)) == SUITE_X25519_MULTI
+    assert decrypt_message_with_pem(rsa_ciphertext, rsa_private) == message
+    assert decrypt_message_with_pem(x25519_ciphertext, x25519_private) == message
+    assert join_envelope("ciphertext", None) == "ciphertext"
+
+    with pytest.raises(Exception):
+        decrypt_message_with_pem(join_envelope(keys[0], body), x25519_private)
+
+def test_send_multi_stores_one_body_in_one_commit(client, db, make_user):
+    sender = make_user("sender1")
+    receivers = [make_user(f"receiver{i}", role="receiver") for i in range(3)]
+    key_pairs = [generate_x25519_key_pair() for _ in receivers]
+    body, keys = encrypt_message_multi("hello", [public for public, _ in key_pairs])
+
+    commits = []
+    listener = lambda conn: commits.append(conn)
+    event.listen(async_engine.sync_engine, "commit", listener)
+    try:
+        response = client.post(
+            "/messages/send-multi",
+            json={
+                "encrypted_body": body,
+                "recipients": [
+                    {"recipient_id": receiver.id, "encrypted_key": key}
+                    for receiver, key in zip(receivers, keys)
+                ]
+            },
+            headers=auth_headers(sender)
+        )
+    finally:
+        event.remove(async_engine.sync_engine, "commit", listener)
+
+    assert response.status_code == 200
+    assert len(commits) == 1
+    assert db.query(MessageBody).count() == 1
+    assert db.query(Message).count() == 3
+    assert db.query(MessageToken).count() == 3
+    assert asyncio.run(audit_writer.flush()) == 1
+    assert db.query(AuditLog).filter(AuditLog.action_type == "message_sent").count() == 1
+
+    for receiver, (_, private_key) in zip(receivers, key_pairs):
+        inbox = client.get("/messages/inbox", headers=auth_headers(receiver)).json()
+        assert [item["seq"] for item in inbox] == [1]
+        assert decrypt_message_with_pem(inbox[0]["encrypted_content"], private_key) == "hello"
+
+    # An unknown recipient rolls the whole send back
+    response = client.post(
+        "/messages/send-multi",
+        json={"encrypted_body": body, "recipients": [{"recipient_id": 999, "encrypted_key": keys[0]}]},
+        headers=auth_headers(make_user("sender2"))
+    )
+    assert response.status_code == 404
+    assert db.query(MessageBody).count() == 1
+
+def test_session_ratchet_skips_rsa_and_expires_by_message_count():
+    public_key, private_key = generate_rsa_key_pair()
+    sender = E2EEncryption(max_messages=3, max_sessions=1)
+    recipient = E2EEncryption(max_messages=3)
+
+    recipient.accept_session("s1:r1", sender.open_session("s1:r1", public_key), private_key)
+    first, second, third = (sender.encrypt_session_message("s1:r1", f"m{n}") for n in range(3))
+    assert len({first, second, third}) == 3
+
+    # Out of order works once per message; tampering does not advance the session
+    assert recipient.decrypt_session_message("s1:r1", second) == "m1"
+    tampered = bytearray(base64.b64decode(third))
+    tampered[-1] ^= 1
+    with pytest.raises(InvalidTag):
+        recipient.decrypt_session_message("s1:r1", base64.b64encode(bytes(tampered)).decode())
+    assert recipient.decrypt_session_message("s1:r1", first) == "m0"
+    with pytest.raises(ValueError):
+        recipient.decrypt_session_message("s1:r1", first)
+    assert recipient.decrypt_session_message("s1:r1", third) == "m2"
+
+    # The message budget is spent, and sessions are evicted beyond max_sessions
+    with pytest.raises(SessionExpiredError):
+        sender.encrypt_session_message("s1:r1", "m3")
+    sender.open_session("s1:r1", public_key)
+    sender.open_session("s1:r2", public_key)
+    assert not sender.has_session("s1:r1")
+
+def test_ratchet_session_keeps_no_earlier_key_material():
+    e2e = E2EEncryption()
+    session_key = os.urandom(32)
+    e2e.store_session_key("s1", session_key)
+    first_chain_key, first_message_key = _ratchet_step(session_key, 0)
+    e2e.encrypt_session_message("s1", "one")
+    e2e.encrypt_session_message("s1", "two")
+
+    session = e2e.session_keys["s1"]
+    held = [value for value in vars(session).values() if isinstance(value, bytes)]
+    held += list(session.skipped.values())
+    assert held == [_ratchet_step(first_chain_key, 1)[0]]
+    assert not {session_key, first_chain_key, first_message_key} & set(held)
+    assert not hasattr(e2e, "get_session_key")
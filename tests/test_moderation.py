@@ -7,4 +7,246 @@ This file contains tests for:
 3. User management
 4. Audit logging
 5. System monitoring
-""" 
\ No newline at end of file
+"""
+import asyncio
+import datetime
+import os
+import threading
+
+from sqlalchemy import event
+
+from conftest import admin_headers, auth_headers
+from backend.services.audit_service import MAX_VERIFY_RANGE, AuditLedger, AuditWriter, verify_inclusion
+from backend.services.moderation_service import BanIndex, ban_index
+from auth.session_manager import principal_cache
+from database.database import async_engine
+from database.models import AuditCheckpoint, AuditGap, AuditLog, User, UserBan
+from encryption.token_manager import TokenManager, current_round_id
+
+def test_ban_index_lookups_and_sweep(db, make_user):
+    expired_user = make_user("sender1")
+    banned_user = make_user("sender2")
+    now = datetime.datetime.now()
+    expired = UserBan(user_id=expired_user.id, banned_token_hash="t1", ban_type="temp_5min",
+                      ban_reason="spam", ban_end_time=now - datetime.timedelta(minutes=1))
+    permanent = UserBan(user_id=banned_user.id, banned_token_hash="t2", ban_type="freeze", ban_reason="abuse")
+    expired_user.set_ban_state(True, expired.ban_end_time)
+    banned_user.set_ban_state(True)
+    db.add_all([expired, permanent])
+    db.commit()
+
+    index = BanIndex()
+    asyncio.run(index.load())
+
+    assert index.user_ban(expired_user.id) is None
+    assert index.user_ban(banned_user.id).ban_type == "freeze"
+    assert index.token_ban("t2").user_id == banned_user.id
+    assert index.token_ban("t1") is None
+
+    assert asyncio.run(index.sweep()) == 1
+    assert asyncio.run(index.sweep()) == 0
+    db.expire_all()
+    assert not db.get(UserBan, expired.id).is_active
+    assert db.get(UserBan, permanent.id).is_active
+    assert not db.get(User, expired_user.id).is_banned
+    assert db.get(User, banned_user.id).has_active_ban()
+
+def test_ban_and_unban_update_the_send_path(client, db, make_user):
+    sender = make_user("sender1")
+    receiver = make_user("receiver1", role="receiver")
+    moderator = make_user("moderator1", role="moderator")
+    token_manager = TokenManager(secret_key="your-secret-key", encryption_key="your-encryption-key-string")
+    token_hash, _ = asyncio.run(token_manager.get_or_create_token(sender.id, current_round_id()))
+    message = {"recipient_id": receiver.id, "encrypted_content": "ciphertext"}
+
+    response = client.post(
+        "/moderator/ban-user",
+        json={"token_hash": token_hash, "ban_type": "temp_5min", "ban_reason": "spam"},
+        headers=auth_headers(moderator)
+    )
+    assert response.status_code == 200
+
+    db.refresh(sender)
+    assert sender.is_banned
+    assert sender.active_ban_until is not None
+    ban = db.query(UserBan).filter(UserBan.user_id == sender.id).one()
+    assert (ban.ban_type, ban.ban_reason) == ("temp_5min", "spam")
+
+    response = client.post("/messages/send", json=message, headers=auth_headers(sender))
+    assert response.status_code == 403
+    assert response.json()["detail"]["status"] == "banned"
+    assert response.json()["detail"]["ban_type"] == "temp_5min"
+
+    # Unbanning lifts every active ban, not just one of them
+    db.add(UserBan(user_id=sender.id, banned_token_hash="t2", ban_type="freeze", ban_reason="abuse"))
+    db.commit()
+    asyncio.run(ban_index.load())
+    response = client.post(f"/moderator/unban-user/{sender.id}", headers=auth_headers(moderator))
+    assert response.status_code == 200
+    db.refresh(sender)
+    assert not sender.has_active_ban()
+    assert db.query(UserBan).filter(UserBan.user_id == sender.id, UserBan.is_active == True).count() == 0
+
+    response = client.post("/messages/send", json=message, headers=auth_headers(sender))
+    assert response.status_code == 200
+
+def test_bans_from_other_workers_reach_the_send_path(client, db, make_user):
+    sender = make_user("sender1")
+    receiver = make_user("receiver1", role="receiver")
+    headers = auth_headers(sender)
+    index = BanIndex()
+    asyncio.run(index.load())
+    assert client.get("/users/me", headers=headers).status_code == 200
+    assert principal_cache._by_user.get(sender.id)
+
+    # Another worker bans the sender; the cached principal still says unbanned
+    ban = UserBan(user_id=sender.id, banned_token_hash="t1", ban_type="freeze", ban_reason="abuse")
+    db.add(ban)
+    db.get(User, sender.id).set_ban_state(True)
+    db.commit()
+    ban_index.add(ban)
+    response = client.post("/messages/send", json={"recipient_id": receiver.id, "encrypted_content": "x"}, headers=headers)
+    assert response.status_code == 403
+    assert response.json()["detail"]["ban_type"] == "freeze"
+
+    # A reload that finds the new ban drops the stale principal
+    assert principal_cache._by_user.get(sender.id)
+    asyncio.run(index.load())
+    assert principal_cache._by_user.get(sender.id) is None
+
+def test_audit_logs_page_by_cursor(client, db):
+    created_at = datetime.datetime(2026, 1, 1)
+    db.add_all([AuditLog(action_type="warn", token_hash=f"t{i}", created_at=created_at) for i in range(3)])
+    db.add_all([AuditLog(action_type="warn", token_hash=f"t{i}") for i in range(3, 5)])
+    db.commit()
+
+    seen = []
+    cursor = None
+    for _ in range(5):
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/admin/audit-logs", params=params)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        seen += [log["token_hash"] for log in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    # Newest first, ties on created_at broken by id
+    assert seen == ["t4", "t3", "t2", "t1", "t0"]
+    assert client.get("/admin/audit-logs", params={"cursor": "not-a-cursor"}).status_code == 400
+    assert client.get("/admin/audit-logs", params={"limit": 10000}).status_code == 422
+
+def test_audit_writer_group_commits_and_spills_to_fallback(db, tmp_path, monkeypatch):
+    # A long interval shows write() never waits for the timer
+    writer = AuditWriter(batch_size=100, flush_interval=60, fallback_path=str(tmp_path / "audit.jsonl"))
+
+    async def scenario():
+        writes = asyncio.gather(*(writer.write("warn", f"t{i}") for i in range(3)))
+        await asyncio.wait_for(writes, timeout=5)
+
+    commits = []
+    listener = lambda conn: commits.append(conn)
+    event.listen(async_engine.sync_engine, "commit", listener)
+    try:
+        asyncio.run(scenario())
+    finally:
+        event.remove(async_engine.sync_engine, "commit", listener)
+    # The first writer commits alone; the two that arrived meanwhile share the next commit
+    assert len(commits) == 2
+    assert db.query(AuditLog).count() == 3
+
+    # A failed insert is durable in the fallback file and replayed at startup
+    async def database_down(rows):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(writer, "_insert", database_down)
+    asyncio.run(writer.write("freeze", "t3"))
+    assert writer.stats()["spilled"] == 1
+    assert db.query(AuditLog).count() == 3
+    monkeypatch.undo()
+    assert asyncio.run(writer.replay_fallback()) == 1
+    assert db.query(AuditLog).filter(AuditLog.token_hash == "t3").count() == 1
+
+def test_audit_spill_does_not_block_buffering(tmp_path, monkeypatch):
+    writer = AuditWriter(flush_interval=60, fallback_path=str(tmp_path / "audit.jsonl"))
+    in_fsync, release = threading.Event(), threading.Event()
+
+    def slow_fsync(fd):
+        in_fsync.set()
+        release.wait(5)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+    spill = threading.Thread(target=writer._spill, args=([writer._row("warn", "t0", None, None, None)],))
+    spill.start()
+    try:
+        assert in_fsync.wait(5)
+
+        async def buffer_one():
+            writer.submit("warn", "t1")
+            writer.clear()
+
+        # Runs while the spill is still inside fsync
+        buffering = threading.Thread(target=asyncio.run, args=(buffer_one(),))
+        buffering.start()
+        buffering.join(2)
+        assert not buffering.is_alive()
+    finally:
+        release.set()
+        spill.join()
+    assert writer.stats()["spilled"] == 1
+
+def test_audit_ledger_checkpoints_and_localizes_tampering(client, db):
+    db.add_all([AuditLog(action_type="warn", token_hash=f"t{i}") for i in range(10)])
+    db.commit()
+    ledger = AuditLedger(checkpoint_size=4)
+
+    assert asyncio.run(ledger.seal()) == 10
+    assert asyncio.run(ledger.seal()) == 0
+    assert db.query(AuditCheckpoint).count() == 2
+    report = asyncio.run(ledger.verify_range(3, 10))
+    assert report["valid"] and report["verified"] == 8 and report["checkpoints"] == 2
+
+    proof = asyncio.run(ledger.prove_inclusion(6))
+    assert len(proof["proof"]) == 2
+    assert verify_inclusion(proof["entry_hash"], proof["proof"], proof["merkle_root"])
+    assert client.get("/admin/audit-logs/6/proof").status_code == 401
+    assert client.get("/admin/audit-logs/verify").status_code == 401
+    headers = admin_headers(client)
+    assert client.get("/admin/audit-logs/6/proof", headers=headers).json()["merkle_root"] == proof["merkle_root"]
+    assert client.get("/admin/audit-logs/9/proof", headers=headers).status_code == 404
+    too_wide = {"first_id": 1, "last_id": MAX_VERIFY_RANGE + 1}
+    assert client.get("/admin/audit-logs/verify", params=too_wide, headers=headers).status_code == 400
+
+    # Rewriting a sealed row is caught at that row; ranges anchored past it still verify
+    db.query(AuditLog).filter(AuditLog.id == 6).update({"action_details": "edited"})
+    db.commit()
+    report = client.get("/admin/audit-logs/verify", headers=headers).json()
+    assert not report["valid"] and report["failed_id"] == 6
+    assert asyncio.run(ledger.verify_range(9, 10))["valid"]
+
+def test_audit_ledger_records_rows_that_commit_late_as_gaps(db):
+    # Row 3 commits only after row 4 was sealed
+    db.add_all([AuditLog(id=i, action_type="warn", token_hash=f"t{i}") for i in (1, 2, 4)])
+    db.commit()
+    ledger = AuditLedger(checkpoint_size=2)
+    assert asyncio.run(ledger.seal()) == 3
+    db.add(AuditLog(id=3, action_type="ban", token_hash="t3"))
+    db.add(AuditLog(id=5, action_type="warn", token_hash="t5"))
+    db.commit()
+
+    assert asyncio.run(ledger.seal()) == 1
+    assert db.query(AuditGap).filter(AuditGap.log_id == 3).count() == 1
+    report = asyncio.run(ledger.verify_range(1))
+    assert report["valid"] and report["gaps"] == 1 and report["verified"] == 4
+    assert report["checkpoints"] == 2
+    proof = asyncio.run(ledger.prove_inclusion(5))
+    assert verify_inclusion(proof["entry_hash"], proof["proof"], proof["merkle_root"])
+    assert asyncio.run(ledger.seal()) == 0
+    assert db.query(AuditGap).count() == 1
+
+    # The late row is still checked against the hash recorded for it
+    db.query(AuditLog).filter(AuditLog.id == 3).update({"action_details": "edited"})
+    db.commit()
+    report = asyncio.run(ledger.verify_range(1))
+    assert not report["valid"] and report["failed_id"] == 3
@@ -7,4 +7,146 @@ This file contains tests for:
 3. Token expiration
 4. Token revocation
 5. Token usage
-""" 
\ No newline at end of file
+"""
+import asyncio
+import datetime
+import threading
+
+from conftest import auth_headers
+from backend.services.container import ServiceContainer, get_token_manager, services
+from backend.services.token_service import RoundScheduler
+from database.database import AsyncSessionLocal
+from database.models import Round, TokenMapping, UserBan
+from encryption.key_management import public_key_cache
+from encryption.key_utils import generate_rsa_key_pair
+from encryption.token_manager import TokenManager
+
+def _token_manager() -> TokenManager:
+    return TokenManager(secret_key="test-secret", encryption_key="test-encryption-key")
+
+def test_consume_token_is_single_use(db, make_user):
+    sender = make_user("sender1")
+    token_manager = _token_manager()
+    token_hash, is_new = asyncio.run(token_manager.get_or_create_token(sender.id, 1))
+
+    assert is_new
+    assert asyncio.run(token_manager.consume_token(token_hash, sender.id))
+    assert not asyncio.run(token_manager.consume_token(token_hash, sender.id))
+
+    token = db.query(TokenMapping).filter(TokenMapping.token_hash == token_hash).one()
+    assert token.is_used
+    assert token.messages_sent == 1
+
+def test_consume_token_rejects_other_users_and_frozen_tokens(db, make_user):
+    sender = make_user("sender1")
+    other = make_user("sender2")
+    token_manager = _token_manager()
+    token_hash, _ = asyncio.run(token_manager.get_or_create_token(sender.id, 1))
+
+    assert not asyncio.run(token_manager.consume_token(token_hash, other.id))
+
+    asyncio.run(token_manager.freeze_token(token_hash))
+    assert not asyncio.run(token_manager.consume_token(token_hash, sender.id))
+
+def test_consume_token_rejects_expired_tokens(db, make_user):
+    sender = make_user("sender1")
+    token_manager = _token_manager()
+    token_hash, _ = asyncio.run(token_manager.get_or_create_token(sender.id, 1))
+    token = db.query(TokenMapping).filter(TokenMapping.token_hash == token_hash).one()
+    token.expires_at = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    db.commit()
+
+    assert not asyncio.run(token_manager.consume_token(token_hash, sender.id))
+
+def test_concurrent_consumption_is_exactly_once(db, make_user):
+    sender = make_user("sender1")
+    token_manager = _token_manager()
+    token_hash, _ = asyncio.run(token_manager.get_or_create_token(sender.id, 1))
+
+    # Each thread runs its own event loop, so the UPDATEs race across threads
+    thread_count = 16
+    barrier = threading.Barrier(thread_count)
+    results = []
+    errors = []
+
+    async def consume():
+        async with AsyncSessionLocal() as session:
+            consumed = await token_manager.consume_token(token_hash, sender.id, db=session)
+            await session.commit()
+            return consumed
+
+    def worker():
+        try:
+            barrier.wait()
+            results.append(asyncio.run(consume()))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert results.count(True) == 1
+    assert results.count(False) == thread_count - 1
+
+    token = db.query(TokenMapping).filter(TokenMapping.token_hash == token_hash).one()
+    assert token.messages_sent == 1
+
+def test_prepare_round_mints_tokens_for_approved_senders(db, make_user):
+    sender = make_user("sender1")
+    banned = make_user("sender2")
+    make_user("sender3", approved=False)
+    make_user("receiver1", role="receiver")
+    db.add(UserBan(user_id=banned.id, banned_token_hash="x", ban_type="freeze", ban_reason="spam"))
+    db.commit()
+
+    token_manager = _token_manager()
+    scheduler = RoundScheduler(token_manager)
+
+    assert asyncio.run(scheduler.prepare_round(7)) == 1
+    assert asyncio.run(scheduler.prepare_round(7)) == 0
+
+    token = db.query(TokenMapping).filter(TokenMapping.round_id == 7).one()
+    assert token.user_id == sender.id
+    assert token.token_hash == token_manager.generate_token_hash(sender.id, 7)
+    assert token_manager.decrypt_user_id(token.encrypted_user_id) == sender.id
+    assert asyncio.run(token_manager.get_or_create_token(sender.id, 7)) == (token.token_hash, False)
+
+def test_open_round_activates_only_the_current_round(db, make_user):
+    scheduler = RoundScheduler(_token_manager())
+    asyncio.run(scheduler.open_round(7))
+    asyncio.run(scheduler.open_round(8))
+
+    rounds = {round.id: round.is_active for round in db.query(Round).all()}
+    assert rounds == {7: False, 8: True}
+
+def test_encrypt_user_ids_matches_single_encryption():
+    token_manager = _token_manager()
+    user_ids = [1, 42, 123456789012345, 10 ** 16]
+
+    assert token_manager.encrypt_user_ids(user_ids) == [token_manager.encrypt_user_id(i) for i in user_ids]
+
+def test_services_are_shared_across_requests_and_warmed(client, db, make_user, monkeypatch):
+    built = []
+    init = TokenManager.__init__
+    monkeypatch.setattr(TokenManager, "__init__", lambda self, *args, **kwargs: built.append(self) or init(self, *args, **kwargs))
+    receiver = make_user("receiver1", role="receiver")
+    for name in ("sender1", "sender2"):
+        response = client.post(
+            "/messages/send",
+            json={"recipient_id": receiver.id, "encrypted_content": name},
+            headers=auth_headers(make_user(name))
+        )
+        assert response.status_code == 200
+    assert built == []
+    assert get_token_manager() is services.token_manager
+
+    public_key, _ = generate_rsa_key_pair()
+    receiver.public_key = public_key
+    db.commit()
+    public_key_cache.clear()
+    assert asyncio.run(ServiceContainer().warm()) == 1
+    assert public_key_cache.stats()["users"] == 1